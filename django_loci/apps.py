@@ -5,7 +5,10 @@ from django.conf import settings
 from django.core.checks import Warning, register
 from django.utils.translation import gettext_lazy as _
 
-from .base.geocoding_views import geocode
+from . import settings as app_settings
+from .base.geocoding_views import check_geocoding
+from .base.history import load_history_receivers
+from .base.write_behind import load_write_behind
 from .channels.receivers import load_location_receivers
 
 logger = logging.getLogger(__name__)
@@ -14,10 +17,11 @@ logger = logging.getLogger(__name__)
 @register("geocoding", deploy=True)
 def test_geocoding(app_configs=None, **kwargs):
     warnings = []
+    if not app_settings.DJANGO_LOCI_GEOCODE_CHECK:
+        return warnings
     # do not run check during development, testing or if feature is disabled
     if not settings.DEBUG or not getattr(settings, "TESTING", False):
-        location = geocode("Red Square")
-        if not location:
+        if not check_geocoding():
             warnings.append(
                 Warning(
                     "Geocoding service is experiencing issues or is not properly configured"
@@ -35,9 +39,11 @@ class LociConfig(AppConfig):
         """
         this method can be overridden in 3rd party apps
         """
-        from .models import Location
+        from .models import Location, Position, TraceSegment
 
         self.location_model = Location
+        self.position_model = Position
+        self.trace_segment_model = TraceSegment
 
     def ready(self):
         import leaflet
@@ -48,3 +54,8 @@ class LociConfig(AppConfig):
 
     def _load_receivers(self):
         load_location_receivers(sender=self.location_model)
+        load_history_receivers(
+            sender=self.location_model,
+            position_model=getattr(self, "position_model", None),
+        )
+        load_write_behind(self.location_model)
@@ -1,27 +1,57 @@
 import json
-from functools import partialmethod
+from functools import partialmethod, update_wrapper
 
+from asgiref.sync import sync_to_async
 from django import forms
 from django.contrib import admin
 from django.contrib.admin import widgets
 from django.contrib.admin.sites import site
+from django.contrib.auth.views import redirect_to_login
 from django.contrib.contenttypes.admin import GenericStackedInline
 from django.core.exceptions import ValidationError
 from django.http import JsonResponse
 from django.shortcuts import get_object_or_404
-from django.urls import path
+from django.urls import path, reverse
+from django.utils.cache import add_never_cache_headers
 from django.utils.functional import cached_property
 from django.utils.translation import gettext_lazy as _
 from leaflet.admin import LeafletGeoAdmin
 
 from openwisp_utils.admin import TimeReadonlyAdminMixin
 
-from ..base.geocoding_views import geocode_view, reverse_geocode_view
+from .. import settings as app_settings
+from ..base import write_behind
+from ..base.geocoding_views import (
+    async_geocode_view,
+    async_reverse_geocode_view,
+    geocode_view,
+    metrics_view,
+    reverse_geocode_view,
+)
 from ..fields import GeometryField
 from ..widgets import FloorPlanWidget, ImageWidget
 from .models import AbstractFloorPlan, AbstractLocation
 
 
+def async_admin_view(admin_site, view):
+    """
+    async counterpart of ``AdminSite.admin_view``, which
+    supports only sync views (used for GET only endpoints)
+    """
+
+    async def inner(request, *args, **kwargs):
+        if not await sync_to_async(admin_site.has_permission)(request):
+            return redirect_to_login(
+                request.get_full_path(),
+                reverse("admin:login", current_app=admin_site.name),
+            )
+        response = await view(request, *args, **kwargs)
+        add_never_cache_headers(response)
+        return response
+
+    return update_wrapper(inner, view)
+
+
 class ReadOnlyMixin:
     """Mixin for forms to handle field widgets for view-only users."""
 
@@ -153,6 +183,14 @@ class AbstractLocationAdmin(TimeReadonlyAdminMixin, LeafletGeoAdmin):
         # view names makes it much easier to extend
         # without having to change templates
         app_label = "django_loci"
+        if app_settings.DJANGO_LOCI_GEOCODE_ASYNC:
+            geocode = async_admin_view(self.admin_site, async_geocode_view)
+            reverse_geocode = async_admin_view(
+                self.admin_site, async_reverse_geocode_view
+            )
+        else:
+            geocode = self.admin_site.admin_view(geocode_view)
+            reverse_geocode = self.admin_site.admin_view(reverse_geocode_view)
         return [
             path(
                 "<uuid:pk>/json/",
@@ -166,18 +204,24 @@ class AbstractLocationAdmin(TimeReadonlyAdminMixin, LeafletGeoAdmin):
             ),
             path(
                 "geocode/",
-                self.admin_site.admin_view(geocode_view),
+                geocode,
                 name="{0}_location_geocode_api".format(app_label),
             ),
             path(
                 "reverse-geocode/",
-                self.admin_site.admin_view(reverse_geocode_view),
+                reverse_geocode,
                 name="{0}_location_reverse_geocode_api".format(app_label),
             ),
+            path(
+                "geocode/metrics/",
+                self.admin_site.admin_view(metrics_view),
+                name="{0}_location_geocode_metrics".format(app_label),
+            ),
         ] + super().get_urls()
 
     def json_view(self, request, pk):
-        instance = get_object_or_404(self.model, pk=pk)
+        # the latest position may not have been persisted yet
+        instance = write_behind.apply_latest(get_object_or_404(self.model, pk=pk))
         return JsonResponse(
             {
                 "name": instance.name,
@@ -0,0 +1,64 @@
+"""
+Circuit breaker whose state is stored in the django cache,
+which allows sharing it between all the worker processes.
+"""
+
+import time
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitBreaker:
+    """
+    opens after ``threshold`` consecutive failures, once ``reset_timeout``
+    seconds have passed, a single call is let through (half-open state):
+    if it succeeds the breaker closes, otherwise it opens again
+    """
+
+    def __init__(self, cache, key, threshold, reset_timeout):
+        self.cache = cache
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._failures_key = f"{key}.failures"
+        self._opened_key = f"{key}.opened"
+        self._probe_key = f"{key}.probe"
+
+    @property
+    def state(self):
+        opened = self.cache.get(self._opened_key)
+        if opened is None:
+            return CLOSED
+        if time.time() - opened < self.reset_timeout:
+            return OPEN
+        return HALF_OPEN
+
+    @property
+    def failures(self):
+        return self.cache.get(self._failures_key, 0)
+
+    def allow(self):
+        """
+        returns ``True`` if a call to the protected service is allowed
+        """
+        state = self.state
+        if state == CLOSED:
+            return True
+        if state == OPEN:
+            return False
+        # only one process probes the service while half-open
+        return self.cache.add(self._probe_key, 1, timeout=self.reset_timeout)
+
+    def record_success(self):
+        self.cache.delete_many([self._failures_key, self._opened_key, self._probe_key])
+
+    def record_failure(self):
+        try:
+            failures = self.cache.incr(self._failures_key)
+        except ValueError:
+            self.cache.add(self._failures_key, 0, timeout=None)
+            failures = self.cache.incr(self._failures_key)
+        if failures >= self.threshold:
+            self.cache.set(self._opened_key, time.time(), timeout=None)
+            self.cache.delete(self._probe_key)
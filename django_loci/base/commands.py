@@ -0,0 +1,263 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.apps import apps
+from django.contrib.gis.geos import Point
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.timezone import now
+
+from .. import settings as app_settings
+from ..apps import LociConfig
+from . import geocoding_cache, geocoding_views, history, trajectory
+from .rate_limit import RateLimitExceeded
+
+
+class Throttle:
+    """
+    thread safe throttle which allows at most ``rate`` calls per second
+    """
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            current = time.monotonic()
+            delay = self._next - current
+            self._next = max(current, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class BaseGeocodeCommand(BaseCommand):
+    help = (
+        "Geocodes locations which have an address but no geometry "
+        "(or reverse geocodes locations which have a geometry but no address)"
+    )
+    location_model = None
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--reverse",
+            action="store_true",
+            help="fill the address of locations which have a geometry",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=4,
+            help="maximum number of concurrent geocoding requests",
+        )
+        parser.add_argument(
+            "--rate",
+            type=float,
+            default=1.0,
+            help="maximum number of geocoding requests per second (0 = unlimited)",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=100,
+            help="number of locations fetched and updated at once",
+        )
+        parser.add_argument(
+            "--limit",
+            type=int,
+            default=None,
+            help="maximum number of locations to process",
+        )
+        parser.add_argument(
+            "--checkpoint",
+            default=None,
+            help="file used to store progress, allows resuming interrupted runs",
+        )
+
+    def get_location_model(self):
+        if self.location_model:
+            return self.location_model
+        for app_config in apps.get_app_configs():
+            if isinstance(app_config, LociConfig):
+                return app_config.location_model
+        raise CommandError("Could not find the location model")  # pragma: nocover
+
+    def get_queryset(self, reverse):
+        queryset = self.get_location_model().objects.order_by("pk")
+        if reverse:
+            return queryset.filter(address="", geometry__isnull=False)
+        return queryset.filter(geometry__isnull=True).exclude(address="")
+
+    def handle(self, *args, **options):
+        reverse = options["reverse"]
+        if options["workers"] < 1 or options["batch_size"] < 1:
+            raise CommandError("--workers and --batch-size must be positive")
+        self.mode = "reverse_geocode" if reverse else "geocode"
+        self.checkpoint = options["checkpoint"]
+        self.throttle = Throttle(options["rate"])
+        last_pk = self._read_checkpoint()
+        if last_pk:
+            self.stdout.write(f"Resuming after location {last_pk}")
+        queryset = self.get_queryset(reverse)
+        lookup = self._reverse_geocode if reverse else self._geocode
+        fields = ["address" if reverse else "geometry", "modified"]
+        limit = options["limit"]
+        processed = updated = 0
+        completed = False
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=options["workers"]) as executor:
+            while limit is None or processed < limit:
+                size = options["batch_size"]
+                if limit is not None:
+                    size = min(size, limit - processed)
+                batch_qs = queryset.filter(pk__gt=last_pk) if last_pk else queryset
+                batch = list(batch_qs[:size])
+                if not batch:
+                    completed = True
+                    break
+                results = executor.map(lookup, batch)
+                changed = [location for location, ok in zip(batch, results) if ok]
+                self.get_location_model().objects.bulk_update(changed, fields)
+                processed += len(batch)
+                updated += len(changed)
+                last_pk = batch[-1].pk
+                self._write_checkpoint(last_pk)
+                if options["verbosity"] > 1:
+                    self.stdout.write(f"Processed {processed} locations")
+        if completed:
+            self._remove_checkpoint()
+        elapsed = time.monotonic() - start
+        throughput = processed / elapsed if elapsed else 0
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Updated {updated} of {processed} locations "
+                f"in {elapsed:.2f} seconds ({throughput:.2f} locations/s)"
+            )
+        )
+
+    def _wait(self, key):
+        # cached results and local lookups do not consume the rate limit
+        if (
+            geocoding_cache.peek(key) is None
+            and not geocoding_views.is_local_geocoder()
+        ):
+            self.throttle.wait()
+
+    def _lookup(self, func, *args):
+        while True:
+            try:
+                # unlike requests, the command can wait for retries
+                return func(*args, retries=app_settings.DJANGO_LOCI_GEOCODE_RETRIES)
+            except RateLimitExceeded as error:
+                # the limit is shared with the other processes
+                time.sleep(error.retry_after)
+            except geocoding_views.GeocodingUnavailable:
+                # not updated, will be processed by the next run
+                return {}
+
+    def _geocode(self, location):
+        self._wait(geocoding_cache.geocode_key(location.address))
+        result = self._lookup(geocoding_views.cached_geocode, location.address)
+        if not result:
+            return False
+        location.geometry = Point(result["lng"], result["lat"], srid=4326)
+        location.modified = now()
+        return True
+
+    def _reverse_geocode(self, location):
+        point = location.geometry.centroid
+        self._wait(geocoding_cache.reverse_geocode_key(point.y, point.x))
+        result = self._lookup(geocoding_views.cached_reverse_geocode, point.y, point.x)
+        if not result:
+            return False
+        location.address = result["address"][:256]
+        location.modified = now()
+        return True
+
+    def _read_checkpoint(self):
+        if not self.checkpoint or not os.path.exists(self.checkpoint):
+            return None
+        with open(self.checkpoint) as file:
+            data = json.load(file)
+        if data.get("mode") != self.mode:
+            return None
+        return data.get("last_pk")
+
+    def _write_checkpoint(self, last_pk):
+        if not self.checkpoint:
+            return
+        with open(self.checkpoint, "w") as file:
+            json.dump({"mode": self.mode, "last_pk": str(last_pk)}, file)
+
+    def _remove_checkpoint(self):
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+
+
+class BasePrunePositionsCommand(BaseCommand):
+    help = (
+        "Compresses the old positions into trace segments, deletes the "
+        "positions older than the retention period and downsamples the "
+        "old positions (see DJANGO_LOCI_POSITION_HISTORY)"
+    )
+    position_model = None
+    trace_segment_model = None
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--retention",
+            type=int,
+            default=app_settings.DJANGO_LOCI_POSITION_HISTORY_RETENTION,
+            help="number of days positions are kept for (0 = forever)",
+        )
+        parser.add_argument(
+            "--window",
+            type=int,
+            default=2,
+            help=(
+                "number of days of positions downsampled by each run, "
+                "enough for daily runs (0 = all the old positions)"
+            ),
+        )
+
+    def _get_app_model(self, name):
+        if getattr(self, name):
+            return getattr(self, name)
+        for app_config in apps.get_app_configs():
+            if isinstance(app_config, LociConfig):
+                return getattr(app_config, name, None)
+        return None  # pragma: nocover
+
+    def handle(self, *args, **options):
+        model = self._get_app_model("position_model")
+        if model is None:
+            raise CommandError("Could not find the position model")
+        segment_model = self._get_app_model("trace_segment_model")
+        hours = app_settings.DJANGO_LOCI_POSITION_HISTORY_COMPRESS
+        if hours and segment_model is not None:
+            compressed, created = trajectory.compress(
+                model, segment_model, now() - timedelta(hours=hours)
+            )
+            self.stdout.write(
+                f"Compressed {compressed} positions into {created} segments"
+            )
+        deleted = 0
+        if options["retention"]:
+            deleted = history.prune(model, options["retention"])
+            if segment_model is not None:
+                deleted += history.prune(segment_model, options["retention"], "end")
+        downsampled = 0
+        for days, interval in app_settings.DJANGO_LOCI_POSITION_HISTORY_DOWNSAMPLE:
+            downsampled += history.downsample(model, days, interval, options["window"])
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Deleted {deleted} expired positions "
+                f"and {downsampled} downsampled positions"
+            )
+        )
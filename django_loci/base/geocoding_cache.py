@@ -0,0 +1,200 @@
+"""
+Cache layer for geocoding and reverse geocoding results.
+
+Results are stored in the django cache defined by
+``DJANGO_LOCI_GEOCODE_CACHE``, which means any cache backend
+can be used (eg: redis, memcached or a dedicated database table
+through ``django.core.cache.backends.db.DatabaseCache``).
+"""
+
+import asyncio
+import hashlib
+import threading
+
+from django.core.cache import caches
+
+from .. import settings as app_settings
+
+KEY_PREFIX = "loci.geocode"
+_MISSING = object()
+
+
+def get_cache():
+    """
+    returns the cache used to store geocoding results
+    or ``None`` if caching is disabled
+    """
+    if not app_settings.DJANGO_LOCI_GEOCODE_CACHE:
+        return None
+    return caches[app_settings.DJANGO_LOCI_GEOCODE_CACHE]
+
+
+def normalize_address(address):
+    """
+    case and whitespace insensitive representation of an address,
+    so that "Red Square" and " red  square," share the same cache entry
+    """
+    return " ".join(address.casefold().split()).strip(" ,")
+
+
+def snap_coordinates(lat, lng):
+    """
+    snaps coordinates to a grid whose size is defined by
+    ``DJANGO_LOCI_REVERSE_GEOCODE_CACHE_PRECISION`` (decimal places)
+    """
+    precision = app_settings.DJANGO_LOCI_REVERSE_GEOCODE_CACHE_PRECISION
+    return "{0:.{2}f},{1:.{2}f}".format(float(lat), float(lng), precision)
+
+
+def geocode_key(address):
+    digest = hashlib.sha1(normalize_address(address).encode()).hexdigest()
+    return f"{KEY_PREFIX}.address.{digest}"
+
+
+def reverse_geocode_key(lat, lng):
+    return f"{KEY_PREFIX}.coords.{snap_coordinates(lat, lng)}"
+
+
+def _stats_key(kind, outcome):
+    return f"{KEY_PREFIX}.stats.{kind}.{outcome}"
+
+
+def _incr(cache, key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        # key does not exist yet (or has been evicted)
+        if not cache.add(key, 1, timeout=None):
+            cache.incr(key)
+
+
+def get_cached(kind, key):
+    """
+    returns the cached result for ``key``, which may be an empty
+    dict for lookups which did not yield any result (negative caching),
+    or ``None`` if nothing is cached; also updates hit/miss counters
+    """
+    cache = get_cache()
+    if cache is None:
+        return None
+    value = cache.get(key, _MISSING)
+    if value is _MISSING:
+        _incr(cache, _stats_key(kind, "misses"))
+        return None
+    _incr(cache, _stats_key(kind, "hits"))
+    return value
+
+
+def set_cached(key, value):
+    """
+    stores ``value`` (a dict) in the cache, empty results
+    are stored with ``DJANGO_LOCI_GEOCODE_CACHE_NEGATIVE_TIMEOUT``
+    """
+    cache = get_cache()
+    if cache is None:
+        return
+    if value:
+        timeout = app_settings.DJANGO_LOCI_GEOCODE_CACHE_TIMEOUT
+    else:
+        timeout = app_settings.DJANGO_LOCI_GEOCODE_CACHE_NEGATIVE_TIMEOUT
+    cache.set(key, value, timeout=timeout)
+
+
+def acquire_lock(key):
+    """
+    cross process lock based on ``cache.add``, used to let only one
+    worker query the geocoding service for a given key; returns
+    ``True`` if the lock has been acquired (or if locking is disabled)
+    """
+    cache = get_cache()
+    timeout = app_settings.DJANGO_LOCI_GEOCODE_CACHE_LOCK_TIMEOUT
+    if cache is None or not timeout:
+        return True
+    return cache.add(f"{key}.lock", 1, timeout=timeout)
+
+
+def release_lock(key):
+    cache = get_cache()
+    if cache is not None and app_settings.DJANGO_LOCI_GEOCODE_CACHE_LOCK_TIMEOUT:
+        cache.delete(f"{key}.lock")
+
+
+def peek(key):
+    """
+    returns the cached value of ``key`` without updating counters
+    """
+    cache = get_cache()
+    return cache.get(key) if cache is not None else None
+
+
+class SingleFlight:
+    """
+    coalesces concurrent calls sharing the same key: only the first
+    caller executes the function, the others wait for its result
+    """
+
+    class _Call:
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func()
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result
+
+
+class AsyncSingleFlight:
+    """
+    async version of ``SingleFlight``
+    """
+
+    def __init__(self):
+        self._tasks = {}
+
+    async def do(self, key, func):
+        # futures are bound to the event loop which created them
+        key = (id(asyncio.get_running_loop()), key)
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._tasks[key] = task
+            task.add_done_callback(lambda _: self._tasks.pop(key, None))
+        # shielded in order to not cancel the lookup
+        # shared by other callers if this caller is cancelled
+        return await asyncio.shield(task)
+
+
+def get_stats():
+    """
+    returns hit/miss counters of the geocoding cache
+    """
+    cache = get_cache()
+    stats = {}
+    for kind in ("geocode", "reverse_geocode"):
+        for outcome in ("hits", "misses"):
+            value = cache.get(_stats_key(kind, outcome), 0) if cache else 0
+            stats[f"{kind}_{outcome}"] = value
+    return stats
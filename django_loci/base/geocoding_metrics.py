@@ -0,0 +1,134 @@
+"""
+Metrics of the calls to the geocoding service, counters are stored in
+the geocoding cache, hence they are aggregated among all the processes.
+"""
+
+from . import geocoding_cache
+
+KINDS = ("geocode", "reverse_geocode")
+# upper bounds (in seconds) of the buckets of the latency histogram
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+PREFIX = f"{geocoding_cache.KEY_PREFIX}.metrics"
+
+
+def _incr(name, delta=1):
+    cache = geocoding_cache.get_cache()
+    if cache is None:
+        return
+    key = f"{PREFIX}.{name}"
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        if not cache.add(key, delta, timeout=None):
+            cache.incr(key, delta)
+
+
+def record_call(kind, seconds, error=False):
+    """
+    records a call to the geocoding service and its latency
+    """
+    bucket = next((str(bound) for bound in LATENCY_BUCKETS if seconds <= bound), "+Inf")
+    _incr(f"{kind}.requests")
+    _incr(f"{kind}.latency.{bucket}")
+    # the django cache supports only integer increments
+    _incr(f"{kind}.latency_sum_ms", round(seconds * 1000))
+    if error:
+        _incr(f"{kind}.errors")
+
+
+def record_rejection(kind):
+    """
+    records a call rejected by the circuit breaker
+    """
+    _incr(f"{kind}.rejected")
+
+
+def get_metrics(circuit_breaker=None):
+    """
+    returns the counters and the latency histogram of each kind
+    of lookup, plus the state of ``circuit_breaker`` (if given)
+    """
+    cache = geocoding_cache.get_cache()
+    names = []
+    for kind in KINDS:
+        names += [
+            f"{kind}.requests",
+            f"{kind}.errors",
+            f"{kind}.rejected",
+            f"{kind}.latency_sum_ms",
+        ]
+        names += [f"{kind}.latency.{bound}" for bound in LATENCY_BUCKETS]
+        names.append(f"{kind}.latency.+Inf")
+    values = {}
+    if cache is not None:
+        keys = {f"{PREFIX}.{name}": name for name in names}
+        values = {keys[key]: value for key, value in cache.get_many(keys).items()}
+    cache_stats = geocoding_cache.get_stats()
+    metrics = {}
+    for kind in KINDS:
+        buckets = {}
+        count = 0
+        # buckets of the histogram are cumulative
+        for bound in list(LATENCY_BUCKETS) + ["+Inf"]:
+            count += values.get(f"{kind}.latency.{bound}", 0)
+            buckets[str(bound)] = count
+        metrics[kind] = {
+            "requests": values.get(f"{kind}.requests", 0),
+            "errors": values.get(f"{kind}.errors", 0),
+            "rejected": values.get(f"{kind}.rejected", 0),
+            "cache_hits": cache_stats[f"{kind}_hits"],
+            "cache_misses": cache_stats[f"{kind}_misses"],
+            "latency": {
+                "buckets": buckets,
+                "sum": values.get(f"{kind}.latency_sum_ms", 0) / 1000,
+                "count": count,
+            },
+        }
+    if circuit_breaker is not None:
+        metrics["circuit_breaker"] = {
+            "state": circuit_breaker.state,
+            "failures": circuit_breaker.failures,
+        }
+    return metrics
+
+
+def to_prometheus(metrics):
+    """
+    converts the output of ``get_metrics`` to the
+    prometheus text exposition format
+    """
+    prefix = "django_loci_geocoding"
+    lines = []
+    counters = (
+        ("requests", "requests to the geocoding service"),
+        ("errors", "failed requests to the geocoding service"),
+        ("rejected", "requests rejected by the circuit breaker"),
+        ("cache_hits", "lookups served from the cache"),
+        ("cache_misses", "lookups not found in the cache"),
+    )
+    for name, description in counters:
+        lines.append(f"# HELP {prefix}_{name}_total Number of {description}")
+        lines.append(f"# TYPE {prefix}_{name}_total counter")
+        for kind in KINDS:
+            value = metrics[kind][name]
+            lines.append(f'{prefix}_{name}_total{{kind="{kind}"}} {value}')
+    name = f"{prefix}_latency_seconds"
+    lines.append(f"# HELP {name} Latency of the requests to the geocoding service")
+    lines.append(f"# TYPE {name} histogram")
+    for kind in KINDS:
+        latency = metrics[kind]["latency"]
+        for bound, count in latency["buckets"].items():
+            lines.append(f'{name}_bucket{{kind="{kind}",le="{bound}"}} {count}')
+        lines.append(f'{name}_sum{{kind="{kind}"}} {latency["sum"]}')
+        lines.append(f'{name}_count{{kind="{kind}"}} {latency["count"]}')
+    if "circuit_breaker" in metrics:
+        breaker = metrics["circuit_breaker"]
+        name = f"{prefix}_circuit_breaker_open"
+        lines.append(f"# HELP {name} Whether the circuit breaker is open")
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {int(breaker['state'] == 'open')}")
+        name = f"{prefix}_circuit_breaker_failures"
+        lines.append(f"# HELP {name} Consecutive failures of the geocoding service")
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {breaker['failures']}")
+    return "\n".join(lines) + "\n"
@@ -1,50 +1,509 @@
-from django.http import JsonResponse
+import asyncio
+import math
+import time
+import weakref
+from functools import lru_cache
+
+from asgiref.sync import sync_to_async
+from django.core.exceptions import ImproperlyConfigured
+from django.http import HttpResponse, JsonResponse
 from django.utils.module_loading import import_string
+from geopy.exc import GeopyError
 from geopy.extra.rate_limiter import RateLimiter
 
-from ..settings import (
-    DJANGO_LOCI_GEOCODE_API_KEY,
-    DJANGO_LOCI_GEOCODE_FAILURE_DELAY,
-    DJANGO_LOCI_GEOCODE_RETRIES,
-    DJANGO_LOCI_GEOCODER,
-)
-
-geocoder = import_string(f"geopy.geocoders.{DJANGO_LOCI_GEOCODER}")
-if DJANGO_LOCI_GEOCODER != "GoogleV3":
-    geolocator = geocoder(user_agent="django_loci")
-else:
-    geolocator = geocoder(api_key=DJANGO_LOCI_GEOCODE_API_KEY)  # pragma: nocover
-geocode = RateLimiter(
-    geolocator.geocode,
-    max_retries=DJANGO_LOCI_GEOCODE_RETRIES,
-    error_wait_seconds=DJANGO_LOCI_GEOCODE_FAILURE_DELAY,
-)
-reverse_geocode = RateLimiter(
-    geolocator.reverse,
-    max_retries=DJANGO_LOCI_GEOCODE_RETRIES,
-    error_wait_seconds=DJANGO_LOCI_GEOCODE_FAILURE_DELAY,
-)
+from .. import settings as app_settings
+from . import geocoding_cache, geocoding_metrics
+from .circuit_breaker import OPEN, CircuitBreaker
+from .rate_limit import RateLimitExceeded, TokenBucket
 
+CHECK_ADDRESS = "Red Square"
+CHECK_CACHE_KEY = f"{geocoding_cache.KEY_PREFIX}.check"
+CHECK_CACHE_TIMEOUT = 60 * 60 * 24
+LOCK_POLL_INTERVAL = 0.1
+METRIC_KINDS = {"geocode": "geocode", "reverse": "reverse_geocode"}
 
-def geocode_view(request):
+
+class GeocodingUnavailable(Exception):
+    """
+    raised when the geocoding service fails
+    or when the circuit breaker is open
+    """
+
+
+def get_geocoder_class():
+    path = app_settings.DJANGO_LOCI_GEOCODER
+    # short names refer to the geocoders shipped with geopy
+    if "." not in path:
+        path = f"geopy.geocoders.{path}"
+    return import_string(path)
+
+
+def is_local_geocoder():
+    """
+    returns ``True`` if the geocoder does not use the network
+    (eg: the gazetteer geocoder), in which case lookups are not
+    subject to the rate limit and the circuit breaker
+    """
+    return getattr(get_geocoder_class(), "is_local", False)
+
+
+def _build_geolocator(**kwargs):
+    geocoder = get_geocoder_class()
+    if app_settings.DJANGO_LOCI_GEOCODER != "GoogleV3":
+        return geocoder(user_agent="django_loci", **kwargs)
+    return geocoder(
+        api_key=app_settings.DJANGO_LOCI_GEOCODE_API_KEY, **kwargs
+    )  # pragma: nocover
+
+
+@lru_cache(maxsize=None)
+def get_geolocator():
+    """
+    returns the geolocator instance, which is built on first use
+    in order to keep the startup of processes cheap
+    """
+    return _build_geolocator()
+
+
+# geolocators (and their HTTP sessions) of each event loop
+_async_geolocators = weakref.WeakKeyDictionary()
+
+
+def get_async_geolocator():
+    """
+    returns the geolocator of the running event loop, which uses the
+    aiohttp adapter of geopy; it's built once per event loop, so that
+    its HTTP session (and its connections) are reused across requests
+    """
+    loop = asyncio.get_running_loop()
+    geolocator = _async_geolocators.get(loop)
+    if geolocator is not None:
+        return geolocator
+    try:
+        import aiohttp  # noqa
+        from geopy.adapters import AioHTTPAdapter
+    except ImportError:  # pragma: nocover
+        raise ImproperlyConfigured(
+            "DJANGO_LOCI_GEOCODE_ASYNC requires aiohttp, "
+            'install it with: pip install "geopy[aiohttp]"'
+        )
+    geolocator = _build_geolocator(adapter_factory=AioHTTPAdapter)
+    _async_geolocators[loop] = geolocator
+    return geolocator
+
+
+@lru_cache(maxsize=None)
+def _get_rate_limiter(method, max_retries=0):
+    return RateLimiter(
+        getattr(get_geolocator(), method),
+        max_retries=max_retries,
+        error_wait_seconds=app_settings.DJANGO_LOCI_GEOCODE_FAILURE_DELAY,
+        # failures are handled by the circuit breaker
+        swallow_exceptions=False,
+    )
+
+
+def get_circuit_breaker():
+    """
+    returns the circuit breaker protecting the geocoding service
+    or ``None`` if it's disabled
+    """
+    cache = geocoding_cache.get_cache()
+    threshold = app_settings.DJANGO_LOCI_GEOCODE_BREAKER_THRESHOLD
+    if not threshold or cache is None:
+        return None
+    return CircuitBreaker(
+        cache,
+        f"{geocoding_cache.KEY_PREFIX}.breaker",
+        threshold=threshold,
+        reset_timeout=app_settings.DJANGO_LOCI_GEOCODE_BREAKER_RESET_TIMEOUT,
+    )
+
+
+def _before_call(method):
+    if is_local_geocoder():
+        return None, time.monotonic()
+    breaker = get_circuit_breaker()
+    if breaker is not None and breaker.state == OPEN:
+        _reject(method)
+    # the rate limit is consumed before taking the half-open probe,
+    # otherwise a rate limited call would hold the probe
+    consume_rate_limit()
+    if breaker is not None and not breaker.allow():
+        _reject(method)
+    return breaker, time.monotonic()
+
+
+def _reject(method):
+    geocoding_metrics.record_rejection(METRIC_KINDS[method])
+    raise GeocodingUnavailable("circuit breaker open")
+
+
+def _after_call(method, breaker, start, error=None):
+    geocoding_metrics.record_call(
+        METRIC_KINDS[method], time.monotonic() - start, error=bool(error)
+    )
+    if breaker is None:
+        return
+    if error:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+
+
+def consume_rate_limit():
+    """
+    consumes a token of the rate limit shared by all the worker
+    processes, raises ``RateLimitExceeded`` if the limit is reached
+    """
+    rate = app_settings.DJANGO_LOCI_GEOCODE_RATE_LIMIT
+    cache = geocoding_cache.get_cache()
+    if not rate or cache is None:
+        return
+    TokenBucket(
+        cache,
+        f"{geocoding_cache.KEY_PREFIX}.rate_limit",
+        rate=rate,
+        burst=app_settings.DJANGO_LOCI_GEOCODE_RATE_LIMIT_BURST,
+    ).consume()
+
+
+def _lookup(method, query, retries=0, **kwargs):
+    breaker, start = _before_call(method)
+    try:
+        if is_local_geocoder():
+            result = getattr(get_geolocator(), method)(query, **kwargs)
+        else:
+            result = _get_rate_limiter(method, retries)(query, **kwargs)
+    except GeopyError as error:
+        _after_call(method, breaker, start, error)
+        raise GeocodingUnavailable(str(error)) from error
+    _after_call(method, breaker, start)
+    return result
+
+
+def geocode(query, retries=0, **kwargs):
+    """
+    raises ``GeocodingUnavailable`` if the geocoding service fails
+    (after ``retries`` retries, which sleep for
+    ``DJANGO_LOCI_GEOCODE_FAILURE_DELAY`` seconds, hence they shall
+    not be used while serving requests) and ``RateLimitExceeded``
+    if the shared rate limit is reached
+    """
+    return _lookup("geocode", query, retries, **kwargs)
+
+
+def reverse_geocode(query, retries=0, **kwargs):
+    """
+    raises the same exceptions of ``geocode``
+    """
+    return _lookup("reverse", query, retries, **kwargs)
+
+
+_abefore_call = sync_to_async(_before_call, thread_sensitive=False)
+_aafter_call = sync_to_async(_after_call, thread_sensitive=False)
+
+
+async def _async_lookup(method, query, **kwargs):
+    breaker, start = await _abefore_call(method)
+    try:
+        # not retried, requests fail fast
+        result = await getattr(get_async_geolocator(), method)(query, **kwargs)
+    except GeopyError as error:
+        await _aafter_call(method, breaker, start, error)
+        raise GeocodingUnavailable(str(error)) from error
+    await _aafter_call(method, breaker, start)
+    return result
+
+
+async def ageocode(query, **kwargs):
+    return await _async_lookup("geocode", query, **kwargs)
+
+
+async def areverse_geocode(query, **kwargs):
+    return await _async_lookup("reverse", query, **kwargs)
+
+
+def check_geocoding():
+    """
+    returns ``True`` if the geocoding service is working;
+    the probe is bounded by ``DJANGO_LOCI_GEOCODE_CHECK_TIMEOUT``,
+    is not retried and successful results are cached;
+    the service is not probed if the circuit breaker is open
+    """
+    breaker = get_circuit_breaker()
+    if breaker is not None and breaker.state == OPEN:
+        return False
+    cache = geocoding_cache.get_cache()
+    if cache is not None and cache.get(CHECK_CACHE_KEY):
+        return True
+    try:
+        location = get_geolocator().geocode(
+            CHECK_ADDRESS, timeout=app_settings.DJANGO_LOCI_GEOCODE_CHECK_TIMEOUT
+        )
+    except GeopyError:
+        location = None
+    if location is None:
+        return False
+    if cache is not None:
+        cache.set(CHECK_CACHE_KEY, True, timeout=CHECK_CACHE_TIMEOUT)
+    return True
+
+
+def _geocode_result(location):
+    if location is None:
+        return {}
+    return {"lat": location.latitude, "lng": location.longitude}
+
+
+def _reverse_geocode_result(location):
+    if not location:
+        return {}
+    # if multiple locations are returned, use the most relevant result
+    location = location[0] if isinstance(location, list) else location
+    return {"address": str(location.address)}
+
+
+_single_flight = geocoding_cache.SingleFlight()
+_async_single_flight = geocoding_cache.AsyncSingleFlight()
+
+
+def _locked_lookup(key, lookup):
+    """
+    executes ``lookup`` while holding the cache lock of ``key``,
+    if another worker holds the lock, waits for its result
+    """
+    acquired = geocoding_cache.acquire_lock(key)
+    if not acquired:
+        timeout = app_settings.DJANGO_LOCI_GEOCODE_CACHE_LOCK_TIMEOUT
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            time.sleep(LOCK_POLL_INTERVAL)
+            result = geocoding_cache.peek(key)
+            if result is not None:
+                return result
+    try:
+        result = lookup()
+        geocoding_cache.set_cached(key, result)
+    finally:
+        if acquired:
+            geocoding_cache.release_lock(key)
+    return result
+
+
+def _cached_lookup(kind, key, lookup):
+    result = geocoding_cache.get_cached(kind, key)
+    if result is None:
+        # concurrent requests for the same key share one lookup
+        result = _single_flight.do(key, lambda: _locked_lookup(key, lookup))
+    return result
+
+
+def cached_geocode(address, retries=0):
+    """
+    returns ``{"lat": <float>, "lng": <float>}`` for ``address``
+    or an empty dict if the address could not be found;
+    failures of the geocoding service are not cached
+    """
+    return _cached_lookup(
+        "geocode",
+        geocoding_cache.geocode_key(address),
+        lambda: _geocode_result(geocode(address, retries=retries)),
+    )
+
+
+def cached_reverse_geocode(lat, lng, retries=0):
+    """
+    returns ``{"address": <str>}`` for the given coordinates
+    or an empty dict if no address could be found
+    """
+    return _cached_lookup(
+        "reverse_geocode",
+        geocoding_cache.reverse_geocode_key(lat, lng),
+        lambda: _reverse_geocode_result(reverse_geocode((lat, lng), retries=retries)),
+    )
+
+
+_aget_cached = sync_to_async(geocoding_cache.get_cached, thread_sensitive=False)
+_aset_cached = sync_to_async(geocoding_cache.set_cached, thread_sensitive=False)
+_aacquire_lock = sync_to_async(geocoding_cache.acquire_lock, thread_sensitive=False)
+_arelease_lock = sync_to_async(geocoding_cache.release_lock, thread_sensitive=False)
+_apeek = sync_to_async(geocoding_cache.peek, thread_sensitive=False)
+
+
+async def _alocked_lookup(key, lookup):
+    """
+    async version of ``_locked_lookup``
+    """
+    acquired = await _aacquire_lock(key)
+    if not acquired:
+        timeout = app_settings.DJANGO_LOCI_GEOCODE_CACHE_LOCK_TIMEOUT
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            await asyncio.sleep(LOCK_POLL_INTERVAL)
+            result = await _apeek(key)
+            if result is not None:
+                return result
+    try:
+        result = await lookup()
+        await _aset_cached(key, result)
+    finally:
+        if acquired:
+            await _arelease_lock(key)
+    return result
+
+
+async def _acached_lookup(kind, key, lookup):
+    result = await _aget_cached(kind, key)
+    if result is None:
+        result = await _async_single_flight.do(
+            key, lambda: _alocked_lookup(key, lookup)
+        )
+    return result
+
+
+async def acached_geocode(address):
+    """
+    async version of ``cached_geocode``
+    """
+
+    async def lookup():
+        return _geocode_result(await ageocode(address))
+
+    return await _acached_lookup(
+        "geocode", geocoding_cache.geocode_key(address), lookup
+    )
+
+
+async def acached_reverse_geocode(lat, lng):
+    """
+    async version of ``cached_reverse_geocode``
+    """
+
+    async def lookup():
+        return _reverse_geocode_result(await areverse_geocode((lat, lng)))
+
+    return await _acached_lookup(
+        "reverse_geocode", geocoding_cache.reverse_geocode_key(lat, lng), lookup
+    )
+
+
+def _get_address(request):
+    """
+    returns a tuple containing the address and an error response
+    """
     address = request.GET.get("address")
     if address is None:
-        return JsonResponse({"error": "Address parameter not defined"}, status=400)
-    location = geocode(address)
-    if location is None:
-        return JsonResponse({"error": "Not found location with given name"}, status=404)
-    return JsonResponse({"lat": location.latitude, "lng": location.longitude})
+        error = {"error": "Address parameter not defined"}
+        return None, JsonResponse(error, status=400)
+    return address, None
 
 
-def reverse_geocode_view(request):
+def _get_coordinates(request):
+    """
+    returns a tuple containing the coordinates and an error response
+    """
     lat = request.GET.get("lat")
     lng = request.GET.get("lng")
     if not lat or not lng:
-        return JsonResponse({"error": "lat or lng parameter not defined"}, status=400)
-    location = reverse_geocode((lat, lng))
-    if location is None:
+        error = {"error": "lat or lng parameter not defined"}
+        return None, JsonResponse(error, status=400)
+    try:
+        return (float(lat), float(lng)), None
+    except ValueError:
+        error = {"error": "lat or lng parameter not valid"}
+        return None, JsonResponse(error, status=400)
+
+
+def _rate_limited_response(error):
+    response = JsonResponse(
+        {"error": "Too many geocoding requests, please retry later"}, status=429
+    )
+    response["Retry-After"] = math.ceil(error.retry_after)
+    return response
+
+
+def _unavailable_response():
+    response = JsonResponse(
+        {"error": "Geocoding service unavailable, please retry later"}, status=503
+    )
+    response["Retry-After"] = app_settings.DJANGO_LOCI_GEOCODE_BREAKER_RESET_TIMEOUT
+    return response
+
+
+def _geocode_response(location):
+    if not location:
+        return JsonResponse({"error": "Not found location with given name"}, status=404)
+    return JsonResponse(location)
+
+
+def _reverse_geocode_response(location):
+    if not location:
         return JsonResponse({"address": ""}, status=404)
-    # if multiple locations are returned, use the most relevant result
-    location = location[0] if isinstance(location, list) else location
-    address = str(location.address)
-    return JsonResponse({"address": address})
+    return JsonResponse(location)
+
+
+def geocode_view(request):
+    address, error = _get_address(request)
+    if error is not None:
+        return error
+    try:
+        location = cached_geocode(address)
+    except RateLimitExceeded as error:
+        return _rate_limited_response(error)
+    except GeocodingUnavailable:
+        return _unavailable_response()
+    return _geocode_response(location)
+
+
+def reverse_geocode_view(request):
+    coords, error = _get_coordinates(request)
+    if error is not None:
+        return error
+    try:
+        location = cached_reverse_geocode(*coords)
+    except RateLimitExceeded as error:
+        return _rate_limited_response(error)
+    except GeocodingUnavailable:
+        return _unavailable_response()
+    return _reverse_geocode_response(location)
+
+
+async def async_geocode_view(request):
+    address, error = _get_address(request)
+    if error is not None:
+        return error
+    try:
+        location = await acached_geocode(address)
+    except RateLimitExceeded as error:
+        return _rate_limited_response(error)
+    except GeocodingUnavailable:
+        return _unavailable_response()
+    return _geocode_response(location)
+
+
+async def async_reverse_geocode_view(request):
+    coords, error = _get_coordinates(request)
+    if error is not None:
+        return error
+    try:
+        location = await acached_reverse_geocode(*coords)
+    except RateLimitExceeded as error:
+        return _rate_limited_response(error)
+    except GeocodingUnavailable:
+        return _unavailable_response()
+    return _reverse_geocode_response(location)
+
+
+def metrics_view(request):
+    """
+    returns the metrics of the geocoding service, in the prometheus
+    text format if the ``format`` parameter is ``prometheus``
+    """
+    metrics = geocoding_metrics.get_metrics(get_circuit_breaker())
+    if request.GET.get("format") == "prometheus":
+        return HttpResponse(
+            geocoding_metrics.to_prometheus(metrics),
+            content_type="text/plain; version=0.0.4; charset=utf-8",
+        )
+    return JsonResponse(metrics)
@@ -0,0 +1,220 @@
+"""
+Position history of mobile locations.
+
+When ``DJANGO_LOCI_POSITION_HISTORY`` is enabled, each committed save of a
+mobile location appends its position to an in-process buffer which is
+written with ``bulk_create`` once it holds
+``DJANGO_LOCI_POSITION_HISTORY_BATCH_SIZE`` positions, or at most every
+``DJANGO_LOCI_POSITION_HISTORY_FLUSH_INTERVAL`` seconds by a daemon thread.
+
+The history is kept bounded by ``prune`` and ``downsample`` (see the
+``loci_prune_positions`` management command).
+"""
+
+import atexit
+import logging
+import os
+import threading
+from datetime import timedelta
+
+from django.db import close_old_connections, transaction
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils.timezone import now
+
+from .. import settings as app_settings
+from ..signals import locations_moved
+
+logger = logging.getLogger(__name__)
+
+# number of rows deleted by each query of prune and downsample
+DELETE_BATCH_SIZE = 1000
+
+
+class PositionRecorder:
+    def __init__(self, model, batch_size=None, flush_interval=None):
+        self.model = model
+        self.batch_size = (
+            batch_size or app_settings.DJANGO_LOCI_POSITION_HISTORY_BATCH_SIZE
+        )
+        self.flush_interval = (
+            flush_interval or app_settings.DJANGO_LOCI_POSITION_HISTORY_FLUSH_INTERVAL
+        )
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._pid = None
+        self._wake = threading.Event()
+
+    def _ensure_started(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            # threads do not survive forks, the flusher
+            # is started again in each child process
+            if self._pid == pid:
+                return
+            threading.Thread(
+                target=self._run, name="django-loci-history", daemon=True
+            ).start()
+            self._pid = pid
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Could not store the position history")
+            finally:
+                close_old_connections()
+
+    def add(self, location_id, timestamp, geometry):
+        """
+        buffers a position (``geometry`` is stored as its centroid)
+        """
+        position = self.model(
+            location_id=location_id,
+            timestamp=timestamp,
+            geometry=geometry.centroid,
+        )
+        with self._lock:
+            self._buffer.append(position)
+            full = len(self._buffer) >= self.batch_size
+        if self.batch_size <= 1:
+            self.flush()
+            return
+        self._ensure_started()
+        if full:
+            self._wake.set()
+
+    def add_many(self, rows):
+        """
+        buffers many ``(location_id, timestamp, geometry)`` positions
+        """
+        for row in rows:
+            self.add(*row)
+
+    def flush(self):
+        """
+        writes the buffered positions, returns their number
+        """
+        with self._lock:
+            positions, self._buffer = self._buffer, []
+        if positions:
+            self.model.objects.bulk_create(positions, batch_size=self.batch_size)
+        return len(positions)
+
+    def record(self, sender, instance, **kwargs):
+        """
+        ``post_save`` receiver, buffers the position once committed
+        """
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and "geometry" not in update_fields:
+            return
+        if instance.is_mobile and instance.geometry:
+            # read right away, the instance may change before the commit
+            args = (instance.pk, instance.modified, instance.geometry.clone())
+            transaction.on_commit(lambda: self.add(*args), using=kwargs.get("using"))
+
+    def record_many(self, sender, instances, **kwargs):
+        """
+        ``locations_moved`` receiver, see ``record``
+        """
+        rows = [
+            (instance.pk, instance.modified, instance.geometry.clone())
+            for instance in instances
+            if instance.is_mobile and instance.geometry
+        ]
+        if rows:
+            transaction.on_commit(
+                lambda: self.add_many(rows), using=kwargs.get("using")
+            )
+
+
+recorder = None
+
+
+def get_recorder():
+    """
+    returns the ``PositionRecorder`` or ``None`` if the history is disabled
+    """
+    return recorder
+
+
+def load_history_receivers(sender, position_model):
+    """
+    enables the position history (if configured) when called,
+    designed to be called in AppConfig subclasses
+    """
+    global recorder
+    if not app_settings.DJANGO_LOCI_POSITION_HISTORY or position_model is None:
+        return
+    recorder = PositionRecorder(position_model)
+    receiver(post_save, sender=sender, dispatch_uid="loci_record_position")(
+        recorder.record
+    )
+    receiver(locations_moved, sender=sender, dispatch_uid="loci_record_positions")(
+        recorder.record_many
+    )
+    # positions still buffered when the process exits
+    atexit.register(recorder.flush)
+
+
+def _delete(model, pks):
+    deleted = 0
+    for start in range(0, len(pks), DELETE_BATCH_SIZE):
+        end = start + DELETE_BATCH_SIZE
+        batch = pks[start:end]
+        deleted += model.objects.filter(pk__in=batch).delete()[0]
+    return deleted
+
+
+def prune(model, days, field="timestamp"):
+    """
+    deletes the positions (or the rows of ``model`` whose ``field`` is)
+    older than ``days`` days, returns their number
+    """
+    cutoff = now() - timedelta(days=days)
+    queryset = model.objects.filter(**{f"{field}__lt": cutoff})
+    deleted = 0
+    # at most DELETE_BATCH_SIZE primary keys are loaded at once
+    while True:
+        pks = list(queryset.values_list("pk", flat=True)[:DELETE_BATCH_SIZE])
+        if not pks:
+            return deleted
+        deleted += model.objects.filter(pk__in=pks).delete()[0]
+
+
+def downsample(model, days, interval, window=None):
+    """
+    thins the positions older than ``days`` days keeping only the last
+    position of each location for each ``interval`` seconds time bucket,
+    returns the number of deleted positions;
+    if ``window`` is given, only the positions which are less than
+    ``days + window`` days old are processed (the older ones have
+    been thinned by the previous runs)
+    """
+    end = now() - timedelta(days=days)
+    queryset = model.objects.filter(timestamp__lt=end)
+    if window:
+        queryset = queryset.filter(timestamp__gte=end - timedelta(days=window))
+    location_ids = queryset.order_by().values_list("location_id", flat=True)
+    deleted = 0
+    # one location at a time, to keep the positions loaded in memory bounded
+    for location_id in list(location_ids.distinct()):
+        rows = (
+            queryset.filter(location_id=location_id)
+            .order_by("timestamp")
+            .values_list("pk", "timestamp")
+        )
+        pks, previous = [], None
+        for pk, timestamp in rows:
+            bucket = int(timestamp.timestamp()) // interval
+            if previous and previous[1] == bucket:
+                # superseded by a later position of the same bucket
+                pks.append(previous[0])
+            previous = (pk, bucket)
+        deleted += _delete(model, pks)
+    return deleted
@@ -3,17 +3,72 @@ import logging
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.gis.db import models
+from django.contrib.gis.geos import GEOSGeometry
 from django.contrib.humanize.templatetags.humanize import ordinal
 from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
 from openwisp_utils.base import TimeStampedEditableModel
 
 from .. import settings as app_settings
+from ..signals import locations_moved
 
 logger = logging.getLogger(__name__)
 
 
+class LocationQuerySet(models.QuerySet):
+    def bulk_move(self, moves, batch_size=500):
+        """
+        Updates the position of many locations, ``moves`` is an iterable
+        of ``(pk, geometry)`` or ``(pk, geometry, address)`` tuples.
+
+        Each batch is fetched with one query and written with one UPDATE,
+        then ``locations_moved`` is sent once for the whole batch (instead
+        of ``post_save`` for each location). Returns the number of updated
+        locations (locations which do not exist or which have not moved
+        are skipped).
+        """
+        updated = 0
+        moves = list(moves)
+        for start in range(0, len(moves), batch_size):
+            end = start + batch_size
+            # the last move of each location wins
+            batch = moves[start:end]
+            changes = {str(move[0]): move[1:] for move in batch}
+            instances = list(self.filter(pk__in=list(changes)))
+            if not instances:
+                continue
+            fields = {"geometry", "modified"}
+            modified = timezone.now()
+            moved = []
+            for instance in instances:
+                geometry, *address = changes[str(instance.pk)]
+                if not isinstance(geometry, GEOSGeometry):
+                    geometry = GEOSGeometry(geometry, srid=4326)
+                instance.geometry = geometry
+                if address:
+                    instance.address = address[0]
+                    fields.add("address")
+                # locations re-reporting the same position are skipped
+                if not instance.get_dirty_fields():
+                    continue
+                instance.modified = modified
+                moved.append(instance)
+            if not moved:
+                continue
+            with transaction.atomic(using=self.db):
+                self.model.objects.using(self.db).bulk_update(
+                    moved, sorted(fields), batch_size=len(moved)
+                )
+                locations_moved.send(sender=self.model, instances=moved, using=self.db)
+            for instance in moved:
+                instance._store_initial_values(fields)
+            updated += len(moved)
+        return updated
+
+
 class AbstractLocation(TimeStampedEditableModel):
     LOCATION_TYPES = (
         ("outdoor", _("Outdoor environment (eg: street, square, garden, land)")),
@@ -44,13 +99,63 @@ class AbstractLocation(TimeStampedEditableModel):
     address = models.CharField(_("address"), db_index=True, max_length=256, blank=True)
     geometry = models.GeometryField(_("geometry"), blank=True, null=True)
 
+    objects = LocationQuerySet.as_manager()
+
     class Meta:
         abstract = True
 
     # overriding __init__ to store the initial type
+    # and the initial values used to detect changes
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._initial_type = self.type
+        self._initial_values = {}
+        self._store_initial_values()
+
+    def _store_initial_values(self, fields=None):
+        """
+        stores the values of the loaded fields (or of ``fields``)
+        """
+        if fields is not None:
+            fields = set(fields)
+        deferred = self.get_deferred_fields()
+        for field in self._meta.concrete_fields:
+            if field.attname in deferred:
+                continue
+            if fields is not None and not {field.name, field.attname} & fields:
+                continue
+            self._initial_values[field.attname] = self._freeze(
+                getattr(self, field.attname)
+            )
+
+    @staticmethod
+    def _freeze(value):
+        # geometries are mutable: their EWKB is stored (and compared),
+        # which is cheaper than cloning the geometry of each instance
+        if isinstance(value, GEOSGeometry):
+            return bytes(value.ewkb)
+        return value
+
+    def get_dirty_fields(self):
+        """
+        returns the names of the fields changed since
+        the instance has been loaded or saved
+        """
+        deferred = self.get_deferred_fields()
+        return {
+            field.attname
+            for field in self._meta.concrete_fields
+            if field.attname not in deferred
+            and (
+                field.attname not in self._initial_values
+                or self._freeze(getattr(self, field.attname))
+                != self._initial_values[field.attname]
+            )
+        }
+
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        super().refresh_from_db(using=using, fields=fields, **kwargs)
+        self._store_initial_values(fields)
 
     def __str__(self):
         return self.name
@@ -70,8 +175,33 @@ class AbstractLocation(TimeStampedEditableModel):
     def short_type(self):
         return _(self.type.capitalize())
 
+    def _get_changed_fields(self, args, kwargs):
+        """
+        returns the fields changed by ``save``, or ``None`` if the
+        changes cannot be tracked (eg: the instance is being created)
+        """
+        if (
+            args
+            or self._state.adding
+            or kwargs.get("force_insert")
+            or kwargs.get("update_fields") is not None
+            or kwargs.get("using", self._state.db) != self._state.db
+        ):
+            return None
+        dirty = self.get_dirty_fields()
+        # a changed primary key means saving another row
+        if self._meta.pk.attname in dirty:
+            return None
+        return dirty
+
     # save method is automatically wrapped in atomic transaction
     def save(self, *args, **kwargs):
+        changed = self._get_changed_fields(args, kwargs)
+        if changed is not None:
+            # saving an unchanged location is a no-op
+            if not changed:
+                return
+            kwargs["update_fields"] = changed | {"modified"}
         # if location type is changed to outdoor, remove all associated floorplans
         if (
             self.type != self._initial_type
@@ -81,7 +211,9 @@ class AbstractLocation(TimeStampedEditableModel):
         ):
             self.objectlocation_set.update(floorplan=None, indoor=None)
             self.floorplan_set.all().delete()
-        return super().save(*args, **kwargs)
+        super().save(*args, **kwargs)
+        self._store_initial_values(kwargs.get("update_fields"))
+        self._initial_type = self.type
 
 
 class AbstractFloorPlan(TimeStampedEditableModel):
@@ -208,3 +340,60 @@ class AbstractObjectLocation(TimeStampedEditableModel):
     def clean(self):
         self._clean_indoor_location()
         self._clean_indoor_position()
+
+
+class AbstractPosition(models.Model):
+    """
+    position of a mobile location at a given time (see ``history.py``)
+    """
+
+    id = models.BigAutoField(primary_key=True)
+    # covered by the (location, timestamp) index
+    location = models.ForeignKey(
+        "django_loci.Location", on_delete=models.CASCADE, db_index=False
+    )
+    timestamp = models.DateTimeField(_("timestamp"))
+    geometry = models.PointField(_("geometry"))
+
+    class Meta:
+        abstract = True
+        indexes = [
+            models.Index(
+                fields=["location", "timestamp"], name="%(app_label)s_%(class)s_lts"
+            )
+        ]
+
+    def __str__(self):
+        return "{0} {1}".format(self.location_id, self.timestamp.isoformat())
+
+
+class AbstractTraceSegment(models.Model):
+    """
+    compressed portion of the trace of a mobile location, either a stop
+    (point) or a movement (line string whose vertices were reached
+    ``offsets`` seconds after ``start``), see ``trajectory.py``
+    """
+
+    id = models.BigAutoField(primary_key=True)
+    # covered by the (location, start) index
+    location = models.ForeignKey(
+        "django_loci.Location", on_delete=models.CASCADE, db_index=False
+    )
+    is_stop = models.BooleanField(_("is stop?"), default=False)
+    start = models.DateTimeField(_("start"))
+    end = models.DateTimeField(_("end"))
+    geometry = models.GeometryField(_("geometry"))
+    offsets = models.JSONField(_("offsets"), default=list, blank=True)
+
+    class Meta:
+        abstract = True
+        indexes = [
+            models.Index(
+                fields=["location", "start"], name="%(app_label)s_%(class)s_lst"
+            )
+        ]
+
+    def __str__(self):
+        return "{0} {1} - {2}".format(
+            self.location_id, self.start.isoformat(), self.end.isoformat()
+        )
@@ -0,0 +1,60 @@
+"""
+Token bucket rate limiter whose state is stored in the django cache,
+which allows sharing the same bucket between all the worker processes.
+"""
+
+import time
+
+# the lock protecting the bucket is held only for a few cache operations,
+# processes which cannot acquire it within LOCK_WAIT seconds are limited
+LOCK_WAIT = 0.05
+LOCK_TIMEOUT = 1
+LOCK_POLL_INTERVAL = 0.005
+
+
+class RateLimitExceeded(Exception):
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+        super().__init__(f"Rate limit exceeded, retry after {retry_after:.2f} seconds")
+
+
+class TokenBucket:
+    """
+    allows on average ``rate`` operations per second
+    with bursts of at most ``burst`` operations
+    """
+
+    def __init__(self, cache, key, rate, burst):
+        self.cache = cache
+        self.key = key
+        self.rate = rate
+        self.burst = max(burst, 1)
+        # after this amount of time the bucket is full again
+        self.timeout = int(self.burst / rate) + 60
+
+    def _acquire_lock(self):
+        deadline = time.monotonic() + LOCK_WAIT
+        while not self.cache.add(f"{self.key}.lock", 1, timeout=LOCK_TIMEOUT):
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(LOCK_POLL_INTERVAL)
+        return True
+
+    def consume(self):
+        """
+        consumes one token, raises ``RateLimitExceeded``
+        if no token is available
+        """
+        if not self._acquire_lock():
+            raise RateLimitExceeded(1 / self.rate)
+        try:
+            now = time.time()
+            tokens, updated = self.cache.get(self.key) or (self.burst, now)
+            tokens = min(self.burst, tokens + max(now - updated, 0) * self.rate)
+            if tokens >= 1:
+                self.cache.set(self.key, (tokens - 1, now), timeout=self.timeout)
+                return
+            self.cache.set(self.key, (tokens, now), timeout=self.timeout)
+        finally:
+            self.cache.delete(f"{self.key}.lock")
+        raise RateLimitExceeded((1 - tokens) / self.rate)
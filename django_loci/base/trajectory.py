@@ -0,0 +1,270 @@
+"""
+Compression of the position history of mobile locations.
+
+Positions are converted into trace segments: the points where a location
+stays within ``DJANGO_LOCI_TRACE_STOP_RADIUS`` meters for at least
+``DJANGO_LOCI_TRACE_STOP_DURATION`` seconds become a single stop (a point
+having a start and an end time), while the movements between stops are
+simplified with the Douglas-Peucker algorithm and stored as line strings.
+
+The distance used by the simplification is the synchronized euclidean
+distance (the distance between a position and the point where the
+simplified trace is at the same time), hence the speed along the trace
+is preserved too, not only its shape.
+"""
+
+import math
+from datetime import datetime, timedelta
+from datetime import timezone as dt_timezone
+
+from django.contrib.gis.geos import LineString, Point
+from django.db import transaction
+
+from .. import settings as app_settings
+
+EARTH_RADIUS = 6371008.8  # meters
+# maximum number of vertices of a segment
+MAX_VERTICES = 1000
+BATCH_SIZE = 1000
+
+
+def _distance(x1, y1, x2, y2):
+    """
+    equirectangular approximation of the distance (in meters) between two
+    ``(lng, lat)`` points, accurate enough for points close to each other
+    """
+    cos_lat = math.cos(math.radians((y1 + y2) / 2))
+    dx = math.radians(x2 - x1) * cos_lat
+    dy = math.radians(y2 - y1)
+    return math.hypot(dx, dy) * EARTH_RADIUS
+
+
+def simplify(points, tolerance):
+    """
+    returns the indexes of the ``(time, lng, lat)`` points kept by
+    the Douglas-Peucker algorithm (using the synchronized euclidean
+    distance) with the given ``tolerance`` (meters)
+    """
+    count = len(points)
+    if count < 3:
+        return list(range(count))
+    keep = [False] * count
+    keep[0] = keep[-1] = True
+    stack = [(0, count - 1)]
+    while stack:
+        first, last = stack.pop()
+        t1, x1, y1 = points[first]
+        t2, x2, y2 = points[last]
+        span = t2 - t1
+        farthest, index = 0, None
+        for i in range(first + 1, last):
+            t, x, y = points[i]
+            ratio = (t - t1) / span if span else 0
+            distance = _distance(x, y, x1 + (x2 - x1) * ratio, y1 + (y2 - y1) * ratio)
+            if distance > farthest:
+                farthest, index = distance, i
+        if index is not None and farthest > tolerance:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [i for i in range(count) if keep[i]]
+
+
+def split_stops(points, radius, duration):
+    """
+    splits the ``(time, lng, lat)`` points into ``(is_stop, points)`` runs;
+    consecutive runs share their boundary point, so that the trace
+    is continuous
+    """
+    count = len(points)
+    start = i = 0
+    while i < count:
+        j = i
+        _, x, y = points[i]
+        while j + 1 < count and _distance(x, y, *points[j + 1][1:]) <= radius:
+            j += 1
+        if j > i and points[j][0] - points[i][0] >= duration:
+            # the boundary point is included in both runs
+            move_end, stop_end = i + 1, j + 1
+            if i > start:
+                yield False, points[start:move_end]
+            yield True, points[i:stop_end]
+            start = i = j
+            if j == count - 1:
+                return
+        i += 1
+    if count - start > 1:
+        yield False, points[start:]
+
+
+def split_gaps(points, max_gap):
+    """
+    splits the ``(time, lng, lat)`` points where no position
+    has been received for more than ``max_gap`` seconds
+    """
+    start = 0
+    for i in range(1, len(points)):
+        if points[i][0] - points[i - 1][0] > max_gap:
+            yield points[start:i]
+            start = i
+    if points:
+        yield points[start:]
+
+
+def _to_datetime(seconds):
+    return datetime.fromtimestamp(seconds, dt_timezone.utc)
+
+
+def build_segments(model, location_id, points):
+    """
+    returns the (unsaved) segments which compress the
+    ``(time, lng, lat)`` points of a location
+    """
+    segments = []
+    for chunk in split_gaps(points, app_settings.DJANGO_LOCI_TRACE_MAX_GAP):
+        if len(chunk) == 1:
+            t, x, y = chunk[0]
+            segments.append(
+                model(
+                    location_id=location_id,
+                    is_stop=True,
+                    start=_to_datetime(t),
+                    end=_to_datetime(t),
+                    geometry=Point(x, y, srid=4326),
+                    offsets=[],
+                )
+            )
+            continue
+        runs = split_stops(
+            chunk,
+            app_settings.DJANGO_LOCI_TRACE_STOP_RADIUS,
+            app_settings.DJANGO_LOCI_TRACE_STOP_DURATION,
+        )
+        for is_stop, run in runs:
+            if is_stop:
+                segments.append(
+                    model(
+                        location_id=location_id,
+                        is_stop=True,
+                        start=_to_datetime(run[0][0]),
+                        end=_to_datetime(run[-1][0]),
+                        geometry=Point(
+                            sum(x for _, x, _ in run) / len(run),
+                            sum(y for _, _, y in run) / len(run),
+                            srid=4326,
+                        ),
+                        offsets=[],
+                    )
+                )
+                continue
+            kept = [
+                run[i] for i in simplify(run, app_settings.DJANGO_LOCI_TRACE_TOLERANCE)
+            ]
+            # long movements are split, consecutive segments share a vertex
+            for first in range(0, len(kept) - 1, MAX_VERTICES - 1):
+                last = first + MAX_VERTICES
+                vertices = kept[first:last]
+                t0 = vertices[0][0]
+                segments.append(
+                    model(
+                        location_id=location_id,
+                        is_stop=False,
+                        start=_to_datetime(t0),
+                        end=_to_datetime(vertices[-1][0]),
+                        geometry=LineString(
+                            [(x, y) for _, x, y in vertices], srid=4326
+                        ),
+                        offsets=[round(t - t0, 3) for t, _, _ in vertices],
+                    )
+                )
+    return segments
+
+
+def _last_point(segment_model, location_id):
+    """
+    returns the last ``(time, lng, lat)`` point of the segments
+    of a location, or ``None``
+    """
+    segment = (
+        segment_model.objects.filter(location_id=location_id).order_by("-end").first()
+    )
+    if segment is None:
+        return None
+    coords = segment.geometry.coords
+    x, y = coords if segment.is_stop else coords[-1]
+    return segment.end.timestamp(), x, y
+
+
+def compress(position_model, segment_model, before):
+    """
+    replaces the positions older than ``before`` with trace segments,
+    returns the number of compressed positions and of created segments;
+    each location is compressed in its own transaction and its trace
+    starts from the last point of its previous segments (unless older than
+    ``DJANGO_LOCI_TRACE_MAX_GAP`` seconds), so that the segments created
+    by consecutive runs share their boundary point too
+    """
+    queryset = position_model.objects.filter(timestamp__lt=before)
+    location_ids = queryset.order_by().values_list("location_id", flat=True)
+    max_gap = app_settings.DJANGO_LOCI_TRACE_MAX_GAP
+    compressed = created = 0
+    for location_id in list(location_ids.distinct()):
+        rows = (
+            queryset.filter(location_id=location_id)
+            .order_by("timestamp")
+            .values_list("pk", "timestamp", "geometry")
+        )
+        pks, points = [], []
+        for pk, timestamp, geometry in rows.iterator(chunk_size=BATCH_SIZE):
+            points.append((timestamp.timestamp(), geometry.x, geometry.y))
+            pks.append(pk)
+        if not pks:
+            continue
+        last = _last_point(segment_model, location_id)
+        if last and 0 < points[0][0] - last[0] <= max_gap:
+            points.insert(0, last)
+        segments = build_segments(segment_model, location_id, points)
+        with transaction.atomic():
+            created += len(
+                segment_model.objects.bulk_create(segments, batch_size=BATCH_SIZE)
+            )
+            for start in range(0, len(pks), BATCH_SIZE):
+                end = start + BATCH_SIZE
+                batch = pks[start:end]
+                position_model.objects.filter(pk__in=batch).delete()
+        compressed += len(pks)
+    return compressed, created
+
+
+def get_trace(segment_model, location_id, start, end, position_model=None):
+    """
+    returns the ``(timestamp, point)`` tuples of the trace of a location
+    between ``start`` and ``end``, rebuilt from the segments (approximated
+    according to ``DJANGO_LOCI_TRACE_TOLERANCE``) and, if ``position_model``
+    is given, from the positions which have not been compressed yet
+    """
+    trace = []
+    segments = segment_model.objects.filter(
+        location_id=location_id, start__lte=end, end__gte=start
+    ).order_by("start")
+    for segment in segments:
+        if segment.is_stop:
+            points = [(segment.start, segment.geometry)]
+            if segment.end != segment.start:
+                points.append((segment.end, segment.geometry))
+        else:
+            points = [
+                (segment.start + timedelta(seconds=offset), Point(*coords, srid=4326))
+                for offset, coords in zip(segment.offsets, segment.geometry.coords)
+            ]
+        # consecutive segments share their boundary point
+        if trace and points[0][0] == trace[-1][0]:
+            points = points[1:]
+        trace += points
+    if position_model is not None:
+        positions = position_model.objects.filter(
+            location_id=location_id, timestamp__gte=start, timestamp__lte=end
+        ).order_by("timestamp")
+        trace += [(position.timestamp, position.geometry) for position in positions]
+        trace.sort(key=lambda item: item[0])
+    return [item for item in trace if start <= item[0] <= end]
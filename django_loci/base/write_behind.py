@@ -0,0 +1,231 @@
+"""
+Write-behind buffer for mobile locations reporting their position often.
+
+When ``DJANGO_LOCI_WRITE_BEHIND`` is enabled, ``move`` stores the latest
+position of a location in the django cache defined by
+``DJANGO_LOCI_WRITE_BEHIND_CACHE`` and broadcasts it right away (through
+``locations_moved``), while a daemon thread writes the newest position of
+each moved location to the database with a single ``bulk_update`` every
+``DJANGO_LOCI_WRITE_BEHIND_FLUSH_INTERVAL`` seconds.
+
+Readers which must see the latest position (eg: the JSON view of the
+admin and the WebSocket snapshots) use ``apply_latest`` or
+``apply_latest_many``.
+"""
+
+import atexit
+import logging
+import os
+import threading
+import time
+
+from django.contrib.gis.geos import GEOSGeometry
+from django.core.cache import caches
+from django.db import close_old_connections
+from django.utils.timezone import now
+
+from .. import settings as app_settings
+from ..signals import locations_moved
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "loci.latest"
+# positions are persisted well before their cache entries expire
+CACHE_TIMEOUT = 60 * 60 * 24
+
+
+def latest_key(pk):
+    return f"{KEY_PREFIX}.{pk}"
+
+
+class WriteBehindBuffer:
+    def __init__(self, model, cache=None, flush_interval=None):
+        self.model = model
+        self.cache = cache or caches[app_settings.DJANGO_LOCI_WRITE_BEHIND_CACHE]
+        self.flush_interval = (
+            flush_interval or app_settings.DJANGO_LOCI_WRITE_BEHIND_FLUSH_INTERVAL
+        )
+        self._lock = threading.Lock()
+        # primary key -> latest position moved by this process
+        self._pending = {}
+        self._pid = None
+
+    def _ensure_started(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            # threads do not survive forks, the flusher
+            # is started again in each child process
+            if self._pid == pid:
+                return
+            threading.Thread(
+                target=self._run, name="django-loci-write-behind", daemon=True
+            ).start()
+            self._pid = pid
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Could not store the latest positions")
+            finally:
+                close_old_connections()
+
+    def move(self, instance, geometry, address=None):
+        """
+        updates the position of ``instance`` in memory and in the cache,
+        broadcasts it right away and schedules it to be persisted
+        """
+        if not isinstance(geometry, GEOSGeometry):
+            geometry = GEOSGeometry(geometry, srid=4326)
+        instance.geometry = geometry
+        if address is not None:
+            instance.address = address
+        instance.modified = now()
+        entry = {
+            "geometry": geometry.hexewkb.decode(),
+            "address": instance.address,
+            "modified": instance.modified,
+        }
+        self.cache.set(latest_key(instance.pk), entry, CACHE_TIMEOUT)
+        with self._lock:
+            self._pending[instance.pk] = entry
+        self._ensure_started()
+        locations_moved.send(sender=self.model, instances=[instance], using=None)
+
+    def get_latest(self, pk):
+        """
+        returns the cached ``geometry``, ``address`` and
+        ``modified`` of a location, or ``None``
+        """
+        return self.cache.get(latest_key(pk))
+
+    def _apply(self, instance, entry):
+        if entry and entry["modified"] > instance.modified:
+            instance.geometry = GEOSGeometry(entry["geometry"])
+            instance.address = entry["address"]
+            instance.modified = entry["modified"]
+        return instance
+
+    def apply_latest(self, instance):
+        """
+        updates ``instance`` with its cached position, if newer
+        """
+        return self._apply(instance, self.get_latest(instance.pk))
+
+    def apply_latest_many(self, instances):
+        """
+        ``apply_latest`` for many instances (with a single cache lookup)
+        """
+        cached = self.cache.get_many([latest_key(obj.pk) for obj in instances])
+        for instance in instances:
+            self._apply(instance, cached.get(latest_key(instance.pk)))
+        return instances
+
+    def flush(self):
+        """
+        writes the newest position of each pending location,
+        returns the number of updated locations
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        try:
+            return self._write(pending)
+        except Exception:
+            # retried at the next flush, unless moved again in the meantime
+            with self._lock:
+                for pk, entry in pending.items():
+                    current = self._pending.get(pk)
+                    if current is None or current["modified"] < entry["modified"]:
+                        self._pending[pk] = entry
+            raise
+
+    def _write(self, pending):
+        # other processes may have cached a newer position
+        cached = self.cache.get_many([latest_key(pk) for pk in pending])
+        for pk, entry in pending.items():
+            newest = cached.get(latest_key(pk))
+            if newest and newest["modified"] > entry["modified"]:
+                pending[pk] = newest
+        # positions older than the stored ones (eg: the location has been
+        # saved in the meantime) and deleted locations are skipped
+        stored = self.model.objects.filter(pk__in=list(pending)).values_list(
+            "pk", "modified"
+        )
+        instances = [
+            self.model(
+                pk=pk,
+                geometry=GEOSGeometry(pending[pk]["geometry"]),
+                address=pending[pk]["address"],
+                modified=pending[pk]["modified"],
+            )
+            for pk, modified in stored
+            if pending[pk]["modified"] > modified
+        ]
+        if instances:
+            self.model.objects.bulk_update(
+                instances, ["address", "geometry", "modified"]
+            )
+        return len(instances)
+
+
+buffer = None
+
+
+def get_buffer():
+    """
+    returns the ``WriteBehindBuffer`` or ``None`` if it is disabled
+    """
+    return buffer
+
+
+def move(instance, geometry, address=None):
+    """
+    updates the position of a location through the write-behind
+    buffer, or saves it right away if the buffer is disabled
+    """
+    if buffer is not None:
+        buffer.move(instance, geometry, address)
+        return
+    if not isinstance(geometry, GEOSGeometry):
+        geometry = GEOSGeometry(geometry, srid=4326)
+    instance.geometry = geometry
+    if address is not None:
+        instance.address = address
+    instance.save()
+
+
+def apply_latest(instance):
+    """
+    updates ``instance`` with its latest (cached) position, if any
+    """
+    if buffer is not None:
+        buffer.apply_latest(instance)
+    return instance
+
+
+def apply_latest_many(instances):
+    """
+    updates ``instances`` with their latest (cached) positions, if any
+    """
+    if buffer is not None:
+        buffer.apply_latest_many(instances)
+    return instances
+
+
+def load_write_behind(model):
+    """
+    enables the write-behind buffer (if configured) when called,
+    designed to be called in AppConfig subclasses
+    """
+    global buffer
+    if not app_settings.DJANGO_LOCI_WRITE_BEHIND:
+        return
+    buffer = WriteBehindBuffer(model)
+    # positions still pending when the process exits
+    atexit.register(buffer.flush)
@@ -1,4 +1,3 @@
-from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.security.websocket import AllowedHostsOriginValidator
 from django.core.asgi import get_asgi_application
@@ -7,25 +6,36 @@ from django.urls import path
 from django_loci.channels.base import (
     common_location_broadcast_path,
     location_broadcast_path,
+    multi_location_broadcast_path,
 )
-from django_loci.channels.consumers import CommonLocationBroadcast, LocationBroadcast
+from django_loci.channels.consumers import (
+    AsyncCommonLocationBroadcast,
+    AsyncLocationBroadcast,
+    AsyncMultiLocationBroadcast,
+)
+from django_loci.channels.tokens import TokenAuthMiddleware
 
 channel_routing = ProtocolTypeRouter(
     {
         "websocket": AllowedHostsOriginValidator(
-            AuthMiddlewareStack(
+            TokenAuthMiddleware(
                 URLRouter(
                     [
                         path(
                             location_broadcast_path,
-                            LocationBroadcast.as_asgi(),
+                            AsyncLocationBroadcast.as_asgi(),
                             name="LocationChannel",
                         ),
                         path(
                             common_location_broadcast_path,
-                            CommonLocationBroadcast.as_asgi(),
+                            AsyncCommonLocationBroadcast.as_asgi(),
                             name="AllLocationChannel",
                         ),
+                        path(
+                            multi_location_broadcast_path,
+                            AsyncMultiLocationBroadcast.as_asgi(),
+                            name="MultiLocationChannel",
+                        ),
                     ]
                 )
             )
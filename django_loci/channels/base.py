@@ -1,9 +1,26 @@
-from asgiref.sync import async_to_sync
-from channels.generic.websocket import JsonWebsocketConsumer
+import uuid
+from datetime import timedelta
+from urllib.parse import parse_qs
+
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer, JsonWebsocketConsumer
 from django.core.exceptions import ValidationError
 
+from .. import settings as app_settings
+from ..base import write_behind
+from . import encoding, grid
+from .outbox import Outbox
+from .receivers import get_common_payload, get_location_payload, seq_to_datetime
+from .tokens import TokenUser
+
 location_broadcast_path = "ws/loci/location/<uuid:pk>/"
 common_location_broadcast_path = "ws/loci/location/"
+multi_location_broadcast_path = "ws/loci/locations/"
+# maximum number of locations a multiplexed connection can subscribe to
+MAX_LOCATIONS = 1000
+# maximum number of locations sent in a single snapshot frame
+SNAPSHOT_CHUNK = 500
 
 
 def _get_object_or_none(model, **kwargs):
@@ -13,7 +30,133 @@ def _get_object_or_none(model, **kwargs):
         return None
 
 
-class BaseLocationBroadcast(JsonWebsocketConsumer):
+class LocationAuthorizationMixin:
+    def get_location(self, user, pk):
+        """
+        Returns the location the user is connecting to, or ``None``;
+        the lookup is skipped if the location is in the scope of the
+        signed token of the user (see ``tokens.py``), unless
+        ``is_authorized`` is overridden (it may read the location).
+        """
+        if (
+            isinstance(user, TokenUser)
+            and user.has_location(pk)
+            and type(self).is_authorized is LocationAuthorizationMixin.is_authorized
+        ):
+            # only the primary key of this instance is set
+            return self.model(pk=pk)
+        return _get_object_or_none(self.model, pk=pk)
+
+    def is_authorized(self, user, location):
+        """
+        Check if the user has permission to receive location broadcasts.
+        Requires authentication and change or view permissions on the location.
+        """
+        perm = "{0}.change_location".format(self.model._meta.app_label)
+        # allow users with view permission
+        readperm = "{0}.view_location".format(self.model._meta.app_label)
+        authenticated = user.is_authenticated
+        is_permitted = user.has_perm(perm) or user.has_perm(readperm)
+        return authenticated and (user.is_superuser or (user.is_staff and is_permitted))
+
+
+class EncodingMixin:
+    # set when the client negotiates the compact encoding (see encoding.py)
+    encoder = None
+
+    def _negotiate_encoding(self):
+        """
+        returns the subprotocol accepted for the connection
+        """
+        self.encoder = encoding.negotiate(self.scope.get("subprotocols", []))
+        return self.encoder.subprotocol if self.encoder else None
+
+
+class SnapshotMixin:
+    """
+    Sends the current state of the locations when clients connect with
+    ``?snapshot=1`` (or only the locations updated after a sequence number
+    with ``?since=<seq>``) and when clients send::
+
+        {"type": "resync", "since": <seq>}
+
+    The state is sent in ``{"type": "snapshot", "locations": [...]}``
+    frames followed by ``{"type": "snapshot_end"}``; updates carry a
+    ``seq`` too, so clients keep the one having the highest ``seq``.
+
+    Snapshots are empty unless ``get_snapshot_queryset`` is overridden.
+    """
+
+    def get_snapshot_queryset(self, user):
+        """
+        Returns the (lazy) queryset of the locations sent in snapshots,
+        subclasses shall return only the locations ``user`` can see.
+        """
+        return self.model.objects.none()
+
+    def serialize_snapshot(self, location):
+        """
+        Returns the representation of ``location`` sent in
+        snapshots, or ``None`` to leave it out.
+        """
+        return get_location_payload(location)
+
+    def _get_connect_since(self):
+        """
+        returns the sequence number requested in the query string
+        (``0`` for a full snapshot) or ``None`` if no snapshot is requested
+        """
+        params = parse_qs(self.scope.get("query_string", b"").decode())
+        if "since" in params:
+            return self._parse_since(params["since"][0])
+        if params.get("snapshot", [""])[0] in ("1", "true"):
+            return 0
+        return None
+
+    def _get_resync_since(self, content):
+        if isinstance(content, dict) and content.get("type") == "resync":
+            return self._parse_since(content.get("since", 0))
+        return None
+
+    def _parse_since(self, value):
+        try:
+            return max(int(value), 0)
+        except (TypeError, ValueError):
+            return None
+
+    def _get_since_datetime(self, since):
+        # locations are not committed in the order of their ``modified``
+        # (which comes from the clock of each server), hence the ones
+        # updated shortly before ``since`` are sent again
+        window = timedelta(seconds=app_settings.DJANGO_LOCI_BROADCAST_RESYNC_WINDOW)
+        return seq_to_datetime(since) - window
+
+    def _get_snapshot_locations(self, since):
+        queryset = self.get_snapshot_queryset(self.scope["user"])
+        # the positions moved through the write-behind buffer may not
+        # have been stored yet, they are filtered in _get_snapshot_payloads
+        if since and write_behind.get_buffer() is None:
+            queryset = queryset.filter(modified__gt=self._get_since_datetime(since))
+        return queryset
+
+    def _get_snapshot_payloads(self, locations, since):
+        """
+        returns the payloads of ``locations`` updated after ``since``,
+        including the positions not yet written by the write-behind buffer
+        """
+        write_behind.apply_latest_many(locations)
+        if since:
+            modified = self._get_since_datetime(since)
+            locations = [
+                location for location in locations if location.modified > modified
+            ]
+        payloads = [self.serialize_snapshot(location) for location in locations]
+        return [payload for payload in payloads if payload is not None]
+
+
+class BaseLocationBroadcast(
+    EncodingMixin, SnapshotMixin, LocationAuthorizationMixin, JsonWebsocketConsumer
+):
     """
     Base WebSocket consumer for broadcasting location coordinate changes
     to authorized users (superusers or organization operators).
@@ -34,28 +177,59 @@ class BaseLocationBroadcast(JsonWebsocketConsumer):
             # (When a user tries to access without loggin in)
             self.close()
         else:
-            location = _get_object_or_none(self.model, pk=self.pk)
+            location = self.get_location(user, self.pk)
             if not location or not self.is_authorized(user, location):
                 self.close()
                 return
-            self.accept()
+            self.accept_connection()
             # Create group name once
             self.group_name = "loci.mobile-location.{}".format(self.pk)
             async_to_sync(self.channel_layer.group_add)(
                 self.group_name, self.channel_name
             )
+            # sent after joining the groups, so that no update is missed
+            self.send_snapshot(self._get_connect_since())
 
-    def is_authorized(self, user, location):
+    def accept_connection(self):
         """
-        Check if the user has permission to receive location broadcasts.
-        Requires authentication and change or view permissions on the location.
+        Accepts the connection, negotiating the encoding.
         """
-        perm = "{0}.change_location".format(self.model._meta.app_label)
-        # allow users with view permission
-        readperm = "{0}.view_location".format(self.model._meta.app_label)
-        authenticated = user.is_authenticated
-        is_permitted = user.has_perm(perm) or user.has_perm(readperm)
-        return authenticated and (user.is_superuser or (user.is_staff and is_permitted))
+        self.accept(self._negotiate_encoding())
+        if self.encoder:
+            self.send_json(self.encoder.handshake)
+
+    def send_json(self, content, close=False):
+        if self.encoder is None:
+            return super().send_json(content, close=close)
+        self.send(bytes_data=self.encoder.encode(content), close=close)
+
+    def get_snapshot_queryset(self, user):
+        return self.model.objects.filter(pk=self.pk, geometry__isnull=False)
+
+    def send_snapshot(self, since):
+        """
+        Sends the locations updated after ``since`` (``None`` = nothing).
+        """
+        if since is None:
+            return
+        chunk = []
+        locations = self._get_snapshot_locations(since)
+        for location in locations.iterator(chunk_size=SNAPSHOT_CHUNK):
+            chunk.append(location)
+            if len(chunk) == SNAPSHOT_CHUNK:
+                self._send_snapshot_chunk(chunk, since)
+                chunk = []
+        if chunk:
+            self._send_snapshot_chunk(chunk, since)
+        self.send_json({"type": "snapshot_end"})
+
+    def _send_snapshot_chunk(self, locations, since):
+        payloads = self._get_snapshot_payloads(locations, since)
+        if payloads:
+            self.send_json({"type": "snapshot", "locations": payloads})
+
+    def receive_json(self, content, **kwargs):
+        self.send_snapshot(self._get_resync_since(content))
 
     def send_message(self, event):
         """
@@ -75,13 +249,98 @@ class BaseLocationBroadcast(JsonWebsocketConsumer):
             )
 
 
-class BaseCommonLocationBroadcast(BaseLocationBroadcast):
+class BboxSubscriptionMixin:
+    """
+    Allows clients to restrict the updates they receive to one or more
+    bounding boxes by sending::
+
+        {"type": "subscribe", "bbox": [min_lng, min_lat, max_lng, max_lat]}
+
+    (a list of bounding boxes is accepted too, while ``"bbox": null``
+    restores the delivery of all the updates); bounding boxes are
+    accepted only if ``DJANGO_LOCI_BROADCAST_GRID_LEVELS`` is set.
+    """
+
+    # when True, clients subscribing to bounding boxes leave the common
+    # group and join the groups of the grid cells covering the bounding
+    # boxes; subclasses which join groups other than the common group
+    # shall set it to False (updates are still filtered by bounding box)
+    use_cell_groups = True
+
+    def _init_subscription(self):
+        self.bboxes = None
+        self.cell_groups = set()
+
+    def _is_subscription(self, content):
+        return isinstance(content, dict) and content.get("type") == "subscribe"
+
+    def _parse_subscription(self, bbox):
+        """
+        returns the bounding boxes and the cell groups to join
+        (``None`` if the groups shall not change), raises ``ValueError``
+        """
+        if bbox is not None and not app_settings.DJANGO_LOCI_BROADCAST_GRID_LEVELS:
+            raise ValueError("bbox subscriptions are disabled")
+        bboxes = grid.parse_bboxes(bbox) if bbox is not None else None
+        if not self.use_cell_groups or not hasattr(self, "group_name"):
+            return bboxes, None
+        return bboxes, (grid.covering_groups(bboxes) if bboxes else None) or set()
+
+    def _group_changes(self, cell_groups):
+        """
+        returns the groups to join and the groups to leave in order to
+        receive the updates of ``cell_groups`` (or of the common group)
+        """
+        join = cell_groups - self.cell_groups
+        leave = self.cell_groups - cell_groups
+        if cell_groups:
+            leave.add(self.group_name)
+        elif self.cell_groups:
+            join.add(self.group_name)
+        return join, leave
+
+    def _accepts(self, event):
+        point = event.get("point")
+        return self.bboxes is None or point is None or grid.contains(self.bboxes, point)
+
+    def _serialize_common_snapshot(self, location):
+        if self.bboxes is not None:
+            centroid = location.geometry.centroid
+            if not grid.contains(self.bboxes, (centroid.x, centroid.y)):
+                return None
+        return get_common_payload(location)
+
+    def _get_batch_frame(self, event):
+        """
+        returns the frame sent to the client for a batch of updates
+        (see ``DJANGO_LOCI_BROADCAST_TICK``), or ``None`` if empty
+        """
+        messages = [item["message"] for item in event["events"] if self._accepts(item)]
+        if not messages:
+            return None
+        return {"type": "batch", "locations": messages}
+
+
+class BaseCommonLocationBroadcast(BboxSubscriptionMixin, BaseLocationBroadcast):
+    """
+    Broadcasts the updates of all the mobile locations,
+    see ``BboxSubscriptionMixin`` for filtering by bounding box.
+
+    Snapshots are empty unless ``get_snapshot_queryset`` is overridden
+    to return the locations each user is allowed to see, eg::
+
+        def get_snapshot_queryset(self, user):
+            return self.model.objects.filter(
+                is_mobile=True, geometry__isnull=False
+            )
+    """
 
     def connect(self):
         """
         Override connect to handle subscription to all locations
         without requiring a specific location PK.
         """
+        self._init_subscription()
         try:
             user = self.scope["user"]
         except KeyError:
@@ -90,13 +349,332 @@ class BaseCommonLocationBroadcast(BaseLocationBroadcast):
             if not self.is_authorized(user, None):
                 self.close()
                 return
-            self.accept()
+            self.accept_connection()
             self.join_groups(user)
+            self.send_snapshot(self._get_connect_since())
 
     def join_groups(self, user):
         """
         Subscribe to broadcast groups.
         Subclasses can override to add user-specific groups (using the ``user`` argument).
         """
-        self.group_name = "loci.mobile-location.common"
+        self.group_name = grid.common_group(self.channel_name)
         async_to_sync(self.channel_layer.group_add)(self.group_name, self.channel_name)
+
+    def serialize_snapshot(self, location):
+        return self._serialize_common_snapshot(location)
+
+    def receive_json(self, content, **kwargs):
+        if self._is_subscription(content):
+            self.subscribe(content.get("bbox"))
+        else:
+            super().receive_json(content, **kwargs)
+
+    def subscribe(self, bbox):
+        """
+        Restricts the updates sent to the client to the given bounding boxes.
+        """
+        try:
+            bboxes, cell_groups = self._parse_subscription(bbox)
+        except ValueError as error:
+            self.send_json({"type": "error", "error": str(error)})
+            return
+        self.bboxes = bboxes
+        if cell_groups is not None:
+            join, leave = self._group_changes(cell_groups)
+            group_add = async_to_sync(self.channel_layer.group_add)
+            group_discard = async_to_sync(self.channel_layer.group_discard)
+            for group in join:
+                group_add(group, self.channel_name)
+            for group in leave:
+                group_discard(group, self.channel_name)
+            self.cell_groups = cell_groups
+        self.send_json({"type": "subscribed", "bbox": bbox})
+
+    def send_message(self, event):
+        if self._accepts(event):
+            super().send_message(event)
+
+    def send_batch(self, event):
+        frame = self._get_batch_frame(event)
+        if frame is not None:
+            self.send_json(frame)
+
+    def disconnect(self, close_code):
+        super().disconnect(close_code)
+        for group in self.cell_groups:
+            async_to_sync(self.channel_layer.group_discard)(group, self.channel_name)
+
+
+class BaseAsyncLocationBroadcast(
+    EncodingMixin,
+    SnapshotMixin,
+    LocationAuthorizationMixin,
+    AsyncJsonWebsocketConsumer,
+):
+    """
+    Async version of ``BaseLocationBroadcast``, connections do not
+    occupy a thread; ``is_authorized`` (which may query the database)
+    is executed in a thread by ``database_sync_to_async``.
+    """
+
+    async def connect(self):
+        self.pk = None
+        try:
+            user = self.scope["user"]
+            self.pk = self.scope["url_route"]["kwargs"]["pk"]
+        except KeyError:
+            await self.close()
+            return
+        location = await database_sync_to_async(self.get_location)(user, self.pk)
+        authorized = location is not None and await database_sync_to_async(
+            self.is_authorized
+        )(user, location)
+        if not authorized:
+            await self.close()
+            return
+        await self.accept_connection()
+        self.group_name = "loci.mobile-location.{}".format(self.pk)
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.send_snapshot(self._get_connect_since())
+
+    async def accept_connection(self):
+        size = app_settings.DJANGO_LOCI_BROADCAST_OUTBOX_SIZE
+        self.outbox = Outbox(self.send_json, size) if size else None
+        await self.accept(self._negotiate_encoding())
+        if self.encoder:
+            await self.send_json(self.encoder.handshake)
+
+    async def send_json(self, content, close=False):
+        if self.encoder is None:
+            return await super().send_json(content, close=close)
+        await self.send(bytes_data=self.encoder.encode(content), close=close)
+
+    def get_snapshot_queryset(self, user):
+        return self.model.objects.filter(pk=self.pk, geometry__isnull=False)
+
+    async def send_snapshot(self, since):
+        if since is None:
+            return
+        chunk = []
+        locations = self._get_snapshot_locations(since)
+        async for location in locations.aiterator(chunk_size=SNAPSHOT_CHUNK):
+            chunk.append(location)
+            if len(chunk) == SNAPSHOT_CHUNK:
+                await self._send_snapshot_chunk(chunk, since)
+                chunk = []
+        if chunk:
+            await self._send_snapshot_chunk(chunk, since)
+        await self.send_json({"type": "snapshot_end"})
+
+    async def _send_snapshot_chunk(self, locations, since):
+        # the write-behind buffer is read from a (blocking) cache
+        payloads = await sync_to_async(self._get_snapshot_payloads)(locations, since)
+        if payloads:
+            await self.send_json({"type": "snapshot", "locations": payloads})
+
+    async def receive_json(self, content, **kwargs):
+        await self.send_snapshot(self._get_resync_since(content))
+
+    async def send_update(self, key, frame):
+        """
+        Sends an update of the location identified by ``key``, through
+        the outbox (see ``outbox.py``) if enabled.
+        """
+        if getattr(self, "outbox", None) is None:
+            await self.send_json(frame)
+        else:
+            self.outbox.put(key, frame)
+
+    async def send_message(self, event):
+        await self.send_update(event.get("id"), event["message"])
+
+    async def disconnect(self, close_code):
+        if getattr(self, "outbox", None) is not None:
+            self.outbox.close()
+        if hasattr(self, "group_name"):
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+
+
+class BaseAsyncCommonLocationBroadcast(
+    BboxSubscriptionMixin, BaseAsyncLocationBroadcast
+):
+    """
+    Async version of ``BaseCommonLocationBroadcast``.
+    """
+
+    async def connect(self):
+        self._init_subscription()
+        try:
+            user = self.scope["user"]
+        except KeyError:
+            await self.close()
+            return
+        if not await database_sync_to_async(self.is_authorized)(user, None):
+            await self.close()
+            return
+        await self.accept_connection()
+        await self.join_groups(user)
+        await self.send_snapshot(self._get_connect_since())
+
+    async def join_groups(self, user):
+        """
+        Subscribe to broadcast groups.
+        Subclasses can override to add user-specific groups (using the ``user`` argument).
+        """
+        self.group_name = grid.common_group(self.channel_name)
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+
+    def serialize_snapshot(self, location):
+        return self._serialize_common_snapshot(location)
+
+    async def receive_json(self, content, **kwargs):
+        if self._is_subscription(content):
+            await self.subscribe(content.get("bbox"))
+        else:
+            await super().receive_json(content, **kwargs)
+
+    async def subscribe(self, bbox):
+        try:
+            bboxes, cell_groups = self._parse_subscription(bbox)
+        except ValueError as error:
+            await self.send_json({"type": "error", "error": str(error)})
+            return
+        self.bboxes = bboxes
+        if cell_groups is not None:
+            join, leave = self._group_changes(cell_groups)
+            for group in join:
+                await self.channel_layer.group_add(group, self.channel_name)
+            for group in leave:
+                await self.channel_layer.group_discard(group, self.channel_name)
+            self.cell_groups = cell_groups
+        await self.send_json({"type": "subscribed", "bbox": bbox})
+
+    async def send_message(self, event):
+        if self._accepts(event):
+            await super().send_message(event)
+
+    async def send_batch(self, event):
+        frame = self._get_batch_frame(event)
+        if frame is not None:
+            # batches are not replaced by the following ones
+            await self.send_update(object(), frame)
+
+    async def disconnect(self, close_code):
+        await super().disconnect(close_code)
+        for group in self.cell_groups:
+            await self.channel_layer.group_discard(group, self.channel_name)
+
+
+class BaseAsyncMultiLocationBroadcast(BaseAsyncLocationBroadcast):
+    """
+    Broadcasts the updates of many locations over a single connection,
+    clients manage their subscriptions by sending::
+
+        {"type": "subscribe", "locations": ["<uuid>", ...]}
+        {"type": "unsubscribe", "locations": ["<uuid>", ...]}
+
+    updates include the ``id`` of the location they refer to.
+    """
+
+    async def connect(self):
+        self.locations = set()
+        try:
+            self.user = self.scope["user"]
+        except KeyError:
+            await self.close()
+            return
+        if not await database_sync_to_async(self.is_authorized)(self.user, None):
+            await self.close()
+            return
+        await self.accept_connection()
+
+    def get_authorized_locations(self, user, pks):
+        """
+        Returns the primary keys of the locations among ``pks``
+        which ``user`` is allowed to receive (with a single query).
+        """
+        queryset = self.model.objects.filter(pk__in=pks)
+        return [
+            location.pk
+            for location in queryset.iterator()
+            if self.is_authorized(user, location)
+        ]
+
+    def _parse_locations(self, content):
+        pks = content.get("locations")
+        if not isinstance(pks, list) or len(pks) > MAX_LOCATIONS:
+            raise ValueError(
+                f"locations must be a list of at most {MAX_LOCATIONS} elements"
+            )
+        try:
+            return {uuid.UUID(str(pk)) for pk in pks}
+        except ValueError:
+            raise ValueError("locations must contain valid UUIDs")
+
+    def _group_name(self, pk):
+        return "loci.mobile-location.{}".format(pk)
+
+    async def receive_json(self, content, **kwargs):
+        if not isinstance(content, dict):
+            return
+        action = content.get("type")
+        if action not in ("subscribe", "unsubscribe"):
+            return
+        try:
+            pks = self._parse_locations(content)
+        except ValueError as error:
+            await self.send_json({"type": "error", "error": str(error)})
+            return
+        if action == "subscribe":
+            await self.subscribe(pks)
+        else:
+            await self.unsubscribe(pks)
+
+    async def subscribe(self, pks):
+        pks -= self.locations
+        if len(self.locations) + len(pks) > MAX_LOCATIONS:
+            await self.send_json(
+                {
+                    "type": "error",
+                    "error": f"at most {MAX_LOCATIONS} locations can be subscribed",
+                }
+            )
+            return
+        authorized = set(
+            await database_sync_to_async(self.get_authorized_locations)(
+                self.user, list(pks)
+            )
+        )
+        for pk in authorized:
+            await self.channel_layer.group_add(self._group_name(pk), self.channel_name)
+        self.locations |= authorized
+        await self.send_json(
+            {
+                "type": "subscribed",
+                "locations": sorted(str(pk) for pk in authorized),
+                "denied": sorted(str(pk) for pk in pks - authorized),
+            }
+        )
+
+    async def unsubscribe(self, pks):
+        pks &= self.locations
+        for pk in pks:
+            await self.channel_layer.group_discard(
+                self._group_name(pk), self.channel_name
+            )
+        self.locations -= pks
+        await self.send_json(
+            {"type": "unsubscribed", "locations": sorted(str(pk) for pk in pks)}
+        )
+
+    async def send_message(self, event):
+        await self.send_update(event["id"], {"id": event["id"], **event["message"]})
+
+    async def disconnect(self, close_code):
+        if getattr(self, "outbox", None) is not None:
+            self.outbox.close()
+        for pk in getattr(self, "locations", ()):
+            await self.channel_layer.group_discard(
+                self._group_name(pk), self.channel_name
+            )
@@ -0,0 +1,72 @@
+"""
+Fixed-tick batching of the broadcasts sent to the common location
+group (and to the grid cell groups derived from it).
+"""
+
+import time
+
+from . import grid
+
+# maximum number of updates included in a single batch event
+MAX_BATCH = 500
+
+
+class TickBatcher:
+    """
+    collects the events sent to the common groups during ``interval``
+    seconds, keeping only the latest event of each location, and emits
+    a single ``send_batch`` event per group at the end of each tick
+
+    not thread safe, it's meant to be used by the dispatcher thread
+    """
+
+    def __init__(self, interval=0, clock=None):
+        self.interval = interval
+        self.clock = clock or time.monotonic
+        self.coalesced = 0
+        # group name -> {location id: event}
+        self._pending = {}
+        self._next_tick = None
+
+    def accepts(self, group):
+        return bool(self.interval) and grid.is_common_group(group)
+
+    def add(self, group, event):
+        events = self._pending.setdefault(group, {})
+        key = event["message"]["id"]
+        if key in events:
+            self.coalesced += 1
+        # latest value wins, but the update is moved at the end
+        events.pop(key, None)
+        events[key] = event
+        if self._next_tick is None:
+            self._next_tick = self.clock() + self.interval
+
+    def next_tick_in(self):
+        """
+        returns the amount of seconds until the end of the current tick,
+        or ``None`` if no event is waiting
+        """
+        if self._next_tick is None:
+            return None
+        return max(self._next_tick - self.clock(), 0)
+
+    def pop_due(self, force=False):
+        """
+        returns the ``(group name, batch event)`` tuples to send if
+        the current tick is over (or right away if ``force`` is ``True``)
+        """
+        if self._next_tick is None:
+            return []
+        if not force and self.clock() < self._next_tick:
+            return []
+        messages = []
+        for group, events in self._pending.items():
+            events = list(events.values())
+            for start in range(0, len(events), MAX_BATCH):
+                end = start + MAX_BATCH
+                chunk = events[start:end]
+                messages.append((group, {"type": "send_batch", "events": chunk}))
+        self._pending = {}
+        self._next_tick = None
+        return messages
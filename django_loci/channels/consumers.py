@@ -1,5 +1,11 @@
 from ..models import Location
-from .base import BaseCommonLocationBroadcast, BaseLocationBroadcast
+from .base import (
+    BaseAsyncCommonLocationBroadcast,
+    BaseAsyncLocationBroadcast,
+    BaseAsyncMultiLocationBroadcast,
+    BaseCommonLocationBroadcast,
+    BaseLocationBroadcast,
+)
 
 
 class LocationBroadcast(BaseLocationBroadcast):
@@ -8,3 +14,15 @@ class LocationBroadcast(BaseLocationBroadcast):
 
 class CommonLocationBroadcast(BaseCommonLocationBroadcast):
     model = Location
+
+
+class AsyncLocationBroadcast(BaseAsyncLocationBroadcast):
+    model = Location
+
+
+class AsyncCommonLocationBroadcast(BaseAsyncCommonLocationBroadcast):
+    model = Location
+
+
+class AsyncMultiLocationBroadcast(BaseAsyncMultiLocationBroadcast):
+    model = Location
@@ -0,0 +1,272 @@
+"""
+Background dispatcher of the WebSocket broadcasts.
+
+Messages are handed to a bounded in-process queue which is consumed by a
+daemon thread running its own event loop, so that the threads saving
+locations never wait for the channel layer. When the queue is full new
+broadcasts are dropped (and counted) instead of blocking.
+
+The worker also applies the per-location throttling configured with
+``DJANGO_LOCI_BROADCAST_MIN_DISTANCE`` and
+``DJANGO_LOCI_BROADCAST_MIN_INTERVAL`` (see ``throttle.py``), dropping
+the broadcasts older than the ones already sent by other processes
+(whose ``seq`` is shared through ``DJANGO_LOCI_BROADCAST_CACHE``), and the
+batching of the common group configured with ``DJANGO_LOCI_BROADCAST_TICK``
+(see ``batching.py``).
+
+The queued and the held broadcasts are sent when the process exits, so
+that short lived processes (eg: management commands) do not lose them.
+"""
+
+import asyncio
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+import channels.layers
+from django.core.cache import caches
+
+from .. import settings as app_settings
+from .batching import TickBatcher
+from .throttle import BroadcastThrottle
+
+logger = logging.getLogger(__name__)
+
+# maximum number of queued broadcasts sent concurrently by the worker
+BATCH_SIZE = 100
+# maximum number of seconds the exit of the process waits for the broadcasts
+EXIT_TIMEOUT = 5
+SEQ_KEY_PREFIX = "loci.sent_seq"
+SEQ_TIMEOUT = 60 * 60
+
+
+async def group_send_many(channel_layer, messages):
+    """
+    sends ``(group name, message)`` tuples concurrently
+    """
+    await asyncio.gather(
+        *(channel_layer.group_send(group, message) for group, message in messages)
+    )
+
+
+def _get_seq(messages):
+    """
+    returns the ``(location id, seq)`` of a broadcast, or ``None``
+    """
+    for _, event in messages:
+        message = event.get("message")
+        if "id" in event and isinstance(message, dict) and "seq" in message:
+            return event["id"], message["seq"]
+    return None
+
+
+def discard_stale(broadcasts):
+    """
+    returns the ``broadcasts`` which are not older than the last broadcast
+    of the same location sent by any process, and stores their ``seq``
+    """
+    seqs = [_get_seq(messages) for messages in broadcasts]
+    keys = {seq[0]: f"{SEQ_KEY_PREFIX}.{seq[0]}" for seq in seqs if seq}
+    if not keys:
+        return broadcasts
+    cache = caches[app_settings.DJANGO_LOCI_BROADCAST_CACHE]
+    sent = cache.get_many(list(keys.values()))
+    fresh, latest = [], {}
+    for messages, seq in zip(broadcasts, seqs):
+        if seq is None:
+            fresh.append(messages)
+            continue
+        pk, value = seq
+        if value < sent.get(keys[pk], 0):
+            continue
+        fresh.append(messages)
+        latest[keys[pk]] = max(value, latest.get(keys[pk], 0))
+    # concurrent processes may overwrite a newer seq, which makes a
+    # stale broadcast possible only until the next update is sent
+    cache.set_many(latest, SEQ_TIMEOUT)
+    return fresh
+
+
+class BroadcastDispatcher:
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._stats = {
+            "queued": 0,
+            "sent": 0,
+            "coalesced": 0,
+            "batches": 0,
+            "dropped": 0,
+            "errors": 0,
+        }
+
+    def _incr(self, name, delta=1):
+        with self._lock:
+            self._stats[name] += delta
+
+    def _ensure_started(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            # threads do not survive forks, the worker
+            # is started again in each child process
+            if self._pid == pid:
+                return
+            maxsize = self.maxsize or app_settings.DJANGO_LOCI_BROADCAST_QUEUE_SIZE
+            self._queue = queue.Queue(maxsize)
+            thread = threading.Thread(
+                target=self._run,
+                args=(self._queue,),
+                name="django-loci-broadcast",
+                daemon=True,
+            )
+            thread.start()
+            self._pid = pid
+
+    def submit(self, messages, key=None, point=None):
+        """
+        queues a list of ``(group name, message)`` tuples, returns
+        ``False`` if they have been dropped because the queue is full;
+        ``key`` identifies the location (broadcasts without key are not
+        throttled) and ``point`` is its ``(lng, lat)`` position
+        """
+        return self.submit_many([(messages, key, point)])
+
+    def submit_many(self, broadcasts):
+        """
+        queues many ``(messages, key, point)`` broadcasts (see ``submit``)
+        as a single item of the queue, returns ``False`` if dropped
+        """
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(
+                [(key, point, messages) for messages, key, point in broadcasts]
+            )
+        except queue.Full:
+            self._incr("dropped", len(broadcasts))
+            return False
+        self._incr("queued", len(broadcasts))
+        return True
+
+    def _get_throttle(self):
+        return BroadcastThrottle(
+            min_distance=app_settings.DJANGO_LOCI_BROADCAST_MIN_DISTANCE,
+            min_interval=app_settings.DJANGO_LOCI_BROADCAST_MIN_INTERVAL,
+            max_delay=app_settings.DJANGO_LOCI_BROADCAST_MAX_DELAY,
+        )
+
+    def _get_batch(self, messages_queue, timeout):
+        try:
+            batch = [messages_queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while len(batch) < BATCH_SIZE:
+            try:
+                batch.append(messages_queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _send(self, loop, messages, broadcasts=0, batches=0):
+        try:
+            channel_layer = channels.layers.get_channel_layer()
+            loop.run_until_complete(group_send_many(channel_layer, messages))
+        except Exception:
+            logger.exception("Failed to send location broadcasts")
+            self._incr("errors", broadcasts + batches)
+        else:
+            self._incr("sent", broadcasts)
+            self._incr("batches", batches)
+
+    def _run(self, messages_queue):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        throttle = self._get_throttle()
+        batcher = TickBatcher(app_settings.DJANGO_LOCI_BROADCAST_TICK)
+        while True:
+            # wakes up when the next held broadcast or the next tick is due
+            timeouts = [throttle.next_flush_in(), batcher.next_tick_in()]
+            timeouts = [timeout for timeout in timeouts if timeout is not None]
+            batch = self._get_batch(messages_queue, min(timeouts, default=None))
+            # events queued by flush, everything held is sent right away
+            flushed = [item for item in batch if isinstance(item, threading.Event)]
+            coalesced = throttle.coalesced + batcher.coalesced
+            offered = (
+                throttle.offer(*entry)
+                for item in batch
+                if not isinstance(item, threading.Event)
+                for entry in item
+            )
+            broadcasts = [messages for messages in offered if messages is not None]
+            broadcasts += throttle.pop_due(force=bool(flushed))
+            if throttle.enabled and broadcasts:
+                try:
+                    broadcasts = discard_stale(broadcasts)
+                except Exception:
+                    logger.exception("Could not read the last broadcasts sent")
+            messages = []
+            for group, event in (item for messages in broadcasts for item in messages):
+                if batcher.accepts(group):
+                    batcher.add(group, event)
+                else:
+                    messages.append((group, event))
+            batches = batcher.pop_due(force=bool(flushed))
+            coalesced = throttle.coalesced + batcher.coalesced - coalesced
+            if coalesced:
+                self._incr("coalesced", coalesced)
+            try:
+                if broadcasts or batches:
+                    self._send(loop, messages + batches, len(broadcasts), len(batches))
+            finally:
+                for _ in batch:
+                    messages_queue.task_done()
+                for event in flushed:
+                    event.set()
+
+    def join(self):
+        """
+        blocks until all the queued broadcasts have been processed
+        (broadcasts held by the throttling may not have been sent yet,
+        see ``flush``)
+        """
+        if self._queue is not None and self._pid == os.getpid():
+            self._queue.join()
+
+    def flush(self, timeout=None):
+        """
+        sends the queued broadcasts and the ones held by the throttling
+        and by the batching, waiting at most ``timeout`` seconds;
+        returns ``False`` if they could not be sent in time
+        """
+        if self._queue is None or self._pid != os.getpid():
+            return True
+        deadline = None if timeout is None else time.monotonic() + timeout
+        done = threading.Event()
+        try:
+            self._queue.put(done, timeout=timeout)
+        except queue.Full:
+            return False
+        if deadline is not None:
+            timeout = max(deadline - time.monotonic(), 0)
+        return done.wait(timeout)
+
+    def get_stats(self):
+        """
+        returns the counters of the dispatcher (number of broadcasts
+        queued, sent, replaced by a newer one, dropped and failed,
+        plus the number of batches sent to the common groups)
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        stats["pending"] = self._queue.qsize() if self._queue is not None else 0
+        return stats
+
+
+dispatcher = BroadcastDispatcher()
+atexit.register(dispatcher.flush, EXIT_TIMEOUT)
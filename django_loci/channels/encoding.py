@@ -0,0 +1,82 @@
+"""
+Compact encoding of the location broadcasts, negotiated by clients
+through the ``loci.msgpack`` WebSocket subprotocol.
+
+Frames are encoded with MessagePack; updates use short keys,
+coordinates of points are quantized to integers (according to
+``DJANGO_LOCI_BROADCAST_PRECISION``) and the fields which rarely
+change (``address``, ``name``, ``type``, ``is_mobile``) are sent
+only when they differ from the last value sent on the connection::
+
+    {"i": "<uuid>", "s": <seq>, "c": [<lng * 10^precision>, <lat * 10^precision>],
+     "a": "<address>", "n": "<name>", "t": "<type>", "m": <is_mobile>}
+"""
+
+from .. import settings as app_settings
+
+try:
+    import msgpack
+except ImportError:  # pragma: nocover
+    msgpack = None
+
+MSGPACK_SUBPROTOCOL = "loci.msgpack"
+STATIC_FIELDS = {"address": "a", "name": "n", "type": "t", "is_mobile": "m"}
+_MISSING = object()
+
+
+def negotiate(subprotocols):
+    """
+    returns a ``CompactEncoder`` if the client requested
+    the compact encoding (and it's available), otherwise ``None``
+    """
+    if msgpack is None or MSGPACK_SUBPROTOCOL not in subprotocols:
+        return None
+    return CompactEncoder(app_settings.DJANGO_LOCI_BROADCAST_PRECISION)
+
+
+class CompactEncoder:
+    subprotocol = MSGPACK_SUBPROTOCOL
+
+    def __init__(self, precision):
+        self.precision = precision
+        self.scale = 10**precision
+        # location id -> static fields sent to the client
+        self._static = {}
+
+    @property
+    def handshake(self):
+        return {"type": "encoding", "format": "msgpack", "precision": self.precision}
+
+    def compact(self, message):
+        """
+        returns the compact representation of a location update
+        """
+        result = {}
+        key = message.get("id")
+        if key is not None:
+            result["i"] = key
+        if "seq" in message:
+            result["s"] = message["seq"]
+        geometry = message["geometry"]
+        if geometry["type"] == "Point":
+            scale = self.scale
+            result["c"] = [round(value * scale) for value in geometry["coordinates"]]
+        else:
+            result["g"] = geometry
+        sent = self._static.setdefault(key, {})
+        for field, short_name in STATIC_FIELDS.items():
+            value = message.get(field, _MISSING)
+            if value is not _MISSING and sent.get(field, _MISSING) != value:
+                result[short_name] = sent[field] = value
+        return result
+
+    def encode(self, content):
+        """
+        encodes a frame (updates are compacted, the others are kept as they are)
+        """
+        if "geometry" in content:
+            content = self.compact(content)
+        elif content.get("type") in ("snapshot", "batch"):
+            locations = [self.compact(message) for message in content["locations"]]
+            content = {**content, "locations": locations}
+        return msgpack.packb(content)
@@ -0,0 +1,147 @@
+"""
+Hierarchical grid used to deliver broadcasts only to the clients
+whose viewport (bounding box) contains the updated location.
+
+At each level of ``DJANGO_LOCI_BROADCAST_GRID_LEVELS`` the world is
+divided in ``2 ** level`` columns and ``2 ** level`` rows: updates are
+sent to the group of the cell containing the location at each level,
+while clients join the groups of the cells covering their bounding
+boxes at the finest level which needs at most ``MAX_CELLS`` groups.
+The cost of publishing an update is therefore proportional to the number
+of levels, not to the number of subscribers.
+
+The clients which are not filtering by bounding box join one of the
+``DJANGO_LOCI_COMMON_GROUP_SHARDS`` shards of the common group (chosen
+by hashing their channel name), updates are sent to every shard: with
+channels_redis each shard is a different key, hence the subscribers are
+spread among the redis hosts and each ``group_send`` iterates a smaller set.
+"""
+
+import math
+import zlib
+
+from .. import settings as app_settings
+
+COMMON_GROUP = "loci.mobile-location.common"
+MAX_CELLS = 32
+MAX_BBOXES = 10
+
+
+def _cell(lng, lat, level):
+    size = 2**level
+    x = math.floor((lng + 180) / 360 * size)
+    y = math.floor((lat + 90) / 180 * size)
+    return min(max(x, 0), size - 1), min(max(y, 0), size - 1)
+
+
+def cell_group(level, x, y):
+    return f"{COMMON_GROUP}.cell.{level}.{x}.{y}"
+
+
+def common_groups():
+    """
+    returns the names of the shards of the common group
+    """
+    shards = app_settings.DJANGO_LOCI_COMMON_GROUP_SHARDS
+    if shards <= 1:
+        return [COMMON_GROUP]
+    return [f"{COMMON_GROUP}.{index}" for index in range(shards)]
+
+
+def common_group(channel_name):
+    """
+    returns the shard of the common group joined by ``channel_name``
+    """
+    groups = common_groups()
+    return groups[zlib.crc32(channel_name.encode()) % len(groups)]
+
+
+def is_common_group(group):
+    """
+    returns ``True`` for the common group, its shards and the grid cell groups
+    """
+    return group == COMMON_GROUP or group.startswith(f"{COMMON_GROUP}.")
+
+
+def point_groups(lng, lat):
+    """
+    returns the names of the groups of the cells containing the point
+    """
+    return [
+        cell_group(level, *_cell(lng, lat, level))
+        for level in app_settings.DJANGO_LOCI_BROADCAST_GRID_LEVELS
+    ]
+
+
+def parse_bboxes(value):
+    """
+    validates a bounding box ``[min lng, min lat, max lng, max lat]``
+    or a list of bounding boxes, raises ``ValueError`` if not valid;
+    bounding boxes crossing the antimeridian (``min lng > max lng``)
+    are split in two
+    """
+    if not isinstance(value, list) or not value:
+        raise ValueError("bbox must be a non empty list")
+    if not isinstance(value[0], list):
+        value = [value]
+    if len(value) > MAX_BBOXES:
+        raise ValueError(f"at most {MAX_BBOXES} bounding boxes are allowed")
+    bboxes = []
+    for bbox in value:
+        if (
+            not isinstance(bbox, list)
+            or len(bbox) != 4
+            or not all(isinstance(n, (int, float)) and math.isfinite(n) for n in bbox)
+        ):
+            raise ValueError("bbox must contain 4 numbers")
+        min_lng, min_lat, max_lng, max_lat = bbox
+        if not (-90 <= min_lat <= max_lat <= 90):
+            raise ValueError("bbox latitudes are not valid")
+        min_lng, max_lng = _wrap(min_lng), _wrap(max_lng)
+        if min_lng <= max_lng:
+            bboxes.append((min_lng, min_lat, max_lng, max_lat))
+        else:
+            bboxes.append((min_lng, min_lat, 180, max_lat))
+            bboxes.append((-180, min_lat, max_lng, max_lat))
+    return bboxes
+
+
+def _wrap(lng):
+    if -180 <= lng <= 180:
+        return lng
+    return (lng + 180) % 360 - 180
+
+
+def covering_groups(bboxes):
+    """
+    returns the groups of the cells covering ``bboxes`` at the finest
+    level which needs at most ``MAX_CELLS`` groups, or ``None`` if
+    the bounding boxes are too big (the common group shall be used)
+    """
+    for level in sorted(app_settings.DJANGO_LOCI_BROADCAST_GRID_LEVELS, reverse=True):
+        groups = set()
+        for min_lng, min_lat, max_lng, max_lat in bboxes:
+            x1, y1 = _cell(min_lng, min_lat, level)
+            x2, y2 = _cell(max_lng, max_lat, level)
+            if len(groups) + (x2 - x1 + 1) * (y2 - y1 + 1) > MAX_CELLS:
+                groups = None
+                break
+            groups.update(
+                cell_group(level, x, y)
+                for x in range(x1, x2 + 1)
+                for y in range(y1, y2 + 1)
+            )
+        if groups is not None:
+            return groups
+    return None
+
+
+def contains(bboxes, point):
+    """
+    returns ``True`` if any bounding box contains ``point`` (``[lng, lat]``)
+    """
+    lng, lat = point
+    return any(
+        min_lng <= lng <= max_lng and min_lat <= lat <= max_lat
+        for min_lng, min_lat, max_lng, max_lat in bboxes
+    )
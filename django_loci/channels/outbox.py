@@ -0,0 +1,70 @@
+"""
+Per-connection backpressure for the async broadcast consumers.
+
+Updates are not written to the socket by the handlers of the channel
+layer events: they are put in an outbox which keeps only the latest
+update of each location and which is drained by a writer task. When a
+client cannot keep up, its outbox holds at most one (fresh) update per
+location, while the channel layer messages are consumed right away.
+"""
+
+import asyncio
+import threading
+from collections import OrderedDict
+
+_lock = threading.Lock()
+_stats = {"coalesced": 0, "dropped": 0}
+
+
+def _incr(name):
+    with _lock:
+        _stats[name] += 1
+
+
+def get_stats():
+    """
+    returns the number of updates replaced by a newer one and of updates
+    dropped because an outbox was full, among all the connections
+    """
+    with _lock:
+        return dict(_stats)
+
+
+class Outbox:
+    def __init__(self, send, maxsize):
+        self.send = send
+        self.maxsize = maxsize
+        self.coalesced = 0
+        self.dropped = 0
+        self._frames = OrderedDict()
+        self._writer = None
+
+    def __len__(self):
+        return len(self._frames)
+
+    def put(self, key, frame):
+        """
+        queues ``frame``, replacing the pending frame having the same ``key``
+        """
+        frames = self._frames
+        if key in frames:
+            # latest value wins, the position in the queue is kept
+            self.coalesced += 1
+            _incr("coalesced")
+        elif len(frames) >= self.maxsize:
+            frames.popitem(last=False)
+            self.dropped += 1
+            _incr("dropped")
+        frames[key] = frame
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.ensure_future(self._drain())
+
+    async def _drain(self):
+        while self._frames:
+            _, frame = self._frames.popitem(last=False)
+            await self.send(frame)
+
+    def close(self):
+        self._frames.clear()
+        if self._writer is not None:
+            self._writer.cancel()
@@ -1,46 +1,173 @@
 import json
+from datetime import datetime, timedelta
+from datetime import timezone as dt_timezone
 
 import channels.layers
 from asgiref.sync import async_to_sync
+from django.db import transaction
 from django.db.models.signals import post_save
 from django.dispatch import receiver
+from django.utils import timezone
+
+from .. import settings as app_settings
+from ..signals import locations_moved
+from . import grid
+from .dispatcher import dispatcher, group_send_many
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+MICROSECOND = timedelta(microseconds=1)
+# saves which do not change these fields are not broadcast
+BROADCAST_FIELDS = frozenset(("geometry", "address", "name"))
+
+
+def geometry_to_dict(geometry):
+    """
+    returns the GeoJSON representation of ``geometry`` as a dict;
+    points (the common case for mobile locations) are converted
+    directly, skipping the serialization to and from a string
+    """
+    if geometry.geom_type == "Point":
+        return {"type": "Point", "coordinates": list(geometry.coords)}
+    return json.loads(geometry.geojson)
+
+
+def get_seq(instance):
+    """
+    returns the sequence number of the last update of ``instance``,
+    which is its modification time expressed in microseconds
+    """
+    modified = instance.modified
+    if timezone.is_naive(modified):
+        modified = timezone.make_aware(modified)
+    return (modified - EPOCH) // MICROSECOND
+
+
+def seq_to_datetime(seq):
+    return EPOCH + seq * MICROSECOND
+
+
+def get_location_payload(instance):
+    """
+    returns the update of ``instance`` sent to the location specific group
+    """
+    return {
+        "geometry": geometry_to_dict(instance.geometry),
+        "address": instance.address,
+        "seq": get_seq(instance),
+    }
+
+
+def get_common_payload(instance, payload=None):
+    """
+    returns the update of ``instance`` sent to the common group,
+    ``payload`` is the result of ``get_location_payload`` (if available)
+    """
+    return {
+        "id": str(instance.pk),
+        **(payload or get_location_payload(instance)),
+        "name": instance.name,
+        "type": instance.type,
+        "is_mobile": instance.is_mobile,
+    }
+
+
+def get_location_messages(instance, point=None):
+    """
+    returns a list of ``(group name, message)`` tuples
+    describing the update of ``instance``;
+    ``point`` is the ``(lng, lat)`` position of the location
+    """
+    if point is None:
+        centroid = instance.geometry.centroid
+        point = (centroid.x, centroid.y)
+    # built once and shared by the messages of all the groups
+    payload = get_location_payload(instance)
+    common_message = {
+        "type": "send_message",
+        "message": get_common_payload(instance, payload),
+        # used by consumers to filter by bounding box
+        "point": list(point),
+        # used by the outbox of async consumers to coalesce updates
+        "id": str(instance.pk),
+    }
+    messages = [
+        (
+            f"loci.mobile-location.{instance.pk}",
+            # the id is used by multiplexed connections
+            {"type": "send_message", "message": payload, "id": str(instance.pk)},
+        ),
+    ]
+    messages += [(group, common_message) for group in grid.common_groups()]
+    messages += [(group, common_message) for group in grid.point_groups(*point)]
+    return messages
+
+
+def broadcast(messages, key=None, point=None):
+    """
+    hands ``messages`` to the background dispatcher, or sends them
+    right away if ``DJANGO_LOCI_BROADCAST_QUEUE_SIZE`` is ``0``
+    (in which case broadcasts are not throttled)
+    """
+    if app_settings.DJANGO_LOCI_BROADCAST_QUEUE_SIZE:
+        dispatcher.submit(messages, key=key, point=point)
+        return
+    channel_layer = channels.layers.get_channel_layer()
+    # a single hop to the event loop for all the groups
+    async_to_sync(group_send_many)(channel_layer, messages)
+
+
+def broadcast_many(broadcasts):
+    """
+    sends many ``(messages, key, point)`` broadcasts with a
+    single dispatch (see ``broadcast``)
+    """
+    if app_settings.DJANGO_LOCI_BROADCAST_QUEUE_SIZE:
+        dispatcher.submit_many(broadcasts)
+        return
+    channel_layer = channels.layers.get_channel_layer()
+    messages = [message for messages, _, _ in broadcasts for message in messages]
+    async_to_sync(group_send_many)(channel_layer, messages)
 
 
 def update_mobile_location(sender, instance, **kwargs):
     """
     Sends WebSocket updates when a location record is updated.
     - Sends a message to the location specific group.
-    - Sends a message to a common group for tracking all mobile location updates.
+    - Sends a message to a common group for tracking all mobile location updates
+      (to each of its shards, see ``DJANGO_LOCI_COMMON_GROUP_SHARDS``).
+    - Sends a message to the grid cells containing the location (see ``grid.py``).
+    Messages are sent only once the transaction is committed, and only if
+    the geometry, the address or the name of the location have changed.
     """
+    update_fields = kwargs.get("update_fields")
+    if update_fields is not None and not BROADCAST_FIELDS & update_fields:
+        return
     if not kwargs.get("created") and instance.geometry:
-        channel_layer = channels.layers.get_channel_layer()
-
-        # Send update to location specific group
-        async_to_sync(channel_layer.group_send)(
-            f"loci.mobile-location.{instance.pk}",
-            {
-                "type": "send_message",
-                "message": {
-                    "geometry": json.loads(instance.geometry.geojson),
-                    "address": instance.address,
-                },
-            },
+        # built right away, the instance may change before the commit
+        centroid = instance.geometry.centroid
+        key, point = instance.pk, (centroid.x, centroid.y)
+        messages = get_location_messages(instance, point)
+        transaction.on_commit(
+            lambda: broadcast(messages, key=key, point=point),
+            using=kwargs.get("using"),
         )
 
-        # Send update to common mobile location group
-        async_to_sync(channel_layer.group_send)(
-            "loci.mobile-location.common",
-            {
-                "type": "send_message",
-                "message": {
-                    "id": str(instance.pk),
-                    "geometry": json.loads(instance.geometry.geojson),
-                    "address": instance.address,
-                    "name": instance.name,
-                    "type": instance.type,
-                    "is_mobile": instance.is_mobile,
-                },
-            },
+
+def update_mobile_locations(sender, instances, **kwargs):
+    """
+    Sends the WebSocket updates of the locations moved
+    in bulk (see ``LocationQuerySet.bulk_move``) at once.
+    """
+    broadcasts = []
+    for instance in instances:
+        if instance.geometry:
+            centroid = instance.geometry.centroid
+            point = (centroid.x, centroid.y)
+            messages = get_location_messages(instance, point)
+            broadcasts.append((messages, instance.pk, point))
+    if broadcasts:
+        transaction.on_commit(
+            lambda: broadcast_many(broadcasts), using=kwargs.get("using")
         )
 
 
@@ -54,3 +181,6 @@ def load_location_receivers(sender):
     receiver(post_save, sender=sender, dispatch_uid="ws_update_mobile_location")(
         update_mobile_location
     )
+    receiver(locations_moved, sender=sender, dispatch_uid="ws_update_mobile_locations")(
+        update_mobile_locations
+    )
@@ -0,0 +1,114 @@
+"""
+Per-location throttling of the WebSocket broadcasts.
+"""
+
+import math
+import time
+
+EARTH_RADIUS = 6371008.8  # meters
+# entries of locations which have not been updated
+# for this amount of seconds are removed from memory
+PRUNE_INTERVAL = 300
+
+
+def distance(point1, point2):
+    """
+    haversine distance in meters between two ``(lng, lat)`` tuples
+    """
+    lng1, lat1 = map(math.radians, point1)
+    lng2, lat2 = map(math.radians, point2)
+    a = (
+        math.sin((lat2 - lat1) / 2) ** 2
+        + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS * math.asin(min(math.sqrt(a), 1))
+
+
+class BroadcastThrottle:
+    """
+    holds back the broadcasts of a location sent less than
+    ``min_interval`` seconds after the previous one or which moved
+    less than ``min_distance`` meters from the previous position;
+    only the latest held broadcast of each location is kept and it's
+    flushed once ``min_interval`` (or ``max_delay``, for locations
+    which did not move enough) seconds have passed since the previous
+    broadcast, so that the final position is always sent
+
+    not thread safe, it's meant to be used by the dispatcher thread
+    """
+
+    def __init__(self, min_distance=0, min_interval=0, max_delay=30, clock=None):
+        self.min_distance = min_distance
+        self.min_interval = min_interval
+        self.max_delay = max(max_delay, min_interval)
+        self.clock = clock or time.monotonic
+        self.coalesced = 0
+        # location key -> (time of the last broadcast, position)
+        self._last = {}
+        # location key -> (flush time, position, messages)
+        self._pending = {}
+        self._pruned = self.clock()
+
+    @property
+    def enabled(self):
+        return bool(self.min_distance or self.min_interval)
+
+    def _moved(self, point, last_point):
+        if not self.min_distance or point is None or last_point is None:
+            return True
+        return distance(point, last_point) >= self.min_distance
+
+    def offer(self, key, point, messages):
+        """
+        returns ``messages`` if they shall be sent right away,
+        otherwise holds them and returns ``None``
+        """
+        if not self.enabled or key is None:
+            return messages
+        now = self.clock()
+        last = self._last.get(key)
+        moved = last is None or self._moved(point, last[1])
+        if last is None or (moved and now - last[0] >= self.min_interval):
+            self._pending.pop(key, None)
+            self._last[key] = (now, point)
+            return messages
+        if key in self._pending:
+            # latest value wins
+            self.coalesced += 1
+        delay = self.min_interval if moved else self.max_delay
+        self._pending[key] = (last[0] + delay, point, messages)
+        return None
+
+    def next_flush_in(self):
+        """
+        returns the amount of seconds until the next held broadcast
+        is due, or ``None`` if no broadcast is held
+        """
+        if not self._pending:
+            return None
+        flush_at = min(pending[0] for pending in self._pending.values())
+        return max(flush_at - self.clock(), 0)
+
+    def pop_due(self, force=False):
+        """
+        returns the lists of messages of the held broadcasts which
+        are due (or of all of them if ``force`` is ``True``)
+        """
+        now = self.clock()
+        due = []
+        for key, (flush_at, point, messages) in list(self._pending.items()):
+            if force or flush_at <= now:
+                del self._pending[key]
+                self._last[key] = (now, point)
+                due.append(messages)
+        if now - self._pruned > PRUNE_INTERVAL:
+            self._prune(now)
+        return due
+
+    def _prune(self, now):
+        # missing entries are sent right away, just like stale ones
+        threshold = now - max(self.max_delay, PRUNE_INTERVAL)
+        for key, (sent_at, _) in list(self._last.items()):
+            if sent_at < threshold and key not in self._pending:
+                del self._last[key]
+        self._pruned = now
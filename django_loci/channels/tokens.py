@@ -0,0 +1,124 @@
+"""
+Signed, short lived tokens which authenticate WebSocket connections
+without loading the session and the user from the database.
+
+The admin embeds a token (see ``DJANGO_LOCI_WEBSOCKET_TOKEN_MAX_AGE``)
+carrying the rights of the user which are checked by the consumers and
+the locations the user is allowed to receive; clients append it to the
+URL of the endpoints (``?token=<token>``). Connections without a valid
+token are authenticated through the session, as usual.
+"""
+
+from urllib.parse import parse_qs
+
+from channels.auth import AuthMiddlewareStack
+from django.core import signing
+
+from .. import settings as app_settings
+
+SALT = "django_loci.channels.tokens"
+# the only permissions checked by the consumers
+LOCATION_PERMISSIONS = ("change_location", "view_location")
+
+
+class TokenUser:
+    """
+    user authenticated by a token, the rights of the
+    user are read from the token, not from the database;
+    only the location permissions are carried by the token
+    """
+
+    is_active = True
+    is_authenticated = True
+    is_anonymous = False
+
+    def __init__(self, data):
+        self.pk = self.id = data["u"]
+        self.username = data["n"]
+        self.is_superuser = data["su"]
+        self.is_staff = data["st"]
+        self.permissions = frozenset(data["p"])
+        # None means any location
+        self.locations = None if data["l"] is None else frozenset(data["l"])
+
+    def __str__(self):
+        return f"token user {self.pk}"
+
+    def get_username(self):
+        return self.username
+
+    def get_all_permissions(self, obj=None):
+        return set(self.permissions)
+
+    def has_perm(self, perm, obj=None):
+        return self.is_superuser or perm in self.permissions
+
+    def has_perms(self, perm_list, obj=None):
+        return all(self.has_perm(perm, obj) for perm in perm_list)
+
+    def has_module_perms(self, app_label):
+        return self.is_superuser or any(
+            perm.startswith(f"{app_label}.") for perm in self.permissions
+        )
+
+    def has_location(self, pk):
+        """
+        returns ``True`` if the location has been vouched for when the
+        token was issued (hence it does not need to be looked up)
+        """
+        return self.locations is not None and str(pk) in self.locations
+
+
+def make_token(user, locations=None):
+    """
+    returns a token for ``user`` restricted to ``locations``
+    (primary keys) if given, or ``""`` if tokens are disabled
+    """
+    if not app_settings.DJANGO_LOCI_WEBSOCKET_TOKEN_MAX_AGE:
+        return ""
+    permissions = [
+        perm
+        for perm in user.get_all_permissions()
+        if perm.split(".", 1)[1] in LOCATION_PERMISSIONS
+    ]
+    data = {
+        "u": str(user.pk),
+        "n": user.get_username(),
+        "su": user.is_superuser,
+        "st": user.is_staff,
+        "p": permissions,
+        "l": None if locations is None else [str(pk) for pk in locations],
+    }
+    return signing.dumps(data, salt=SALT, compress=True)
+
+
+def read_token(token):
+    """
+    returns the ``TokenUser`` of ``token`` or
+    ``None`` if the token is not valid or expired
+    """
+    max_age = app_settings.DJANGO_LOCI_WEBSOCKET_TOKEN_MAX_AGE
+    if not max_age or not token:
+        return None
+    try:
+        return TokenUser(signing.loads(token, salt=SALT, max_age=max_age))
+    except (signing.BadSignature, KeyError, TypeError):
+        return None
+
+
+class TokenAuthMiddleware:
+    """
+    sets ``scope["user"]`` from the ``token`` query string parameter,
+    connections without a valid token are handed to ``AuthMiddlewareStack``
+    """
+
+    def __init__(self, inner):
+        self.inner = inner
+        self.session_auth = AuthMiddlewareStack(inner)
+
+    async def __call__(self, scope, receive, send):
+        params = parse_qs(scope.get("query_string", b"").decode())
+        user = read_token(params.get("token", [""])[0])
+        if user is None:
+            return await self.session_auth(scope, receive, send)
+        return await self.inner(dict(scope, user=user), receive, send)
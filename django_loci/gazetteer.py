@@ -0,0 +1,299 @@
+"""
+Offline geocoder backed by a local gazetteer.
+
+The gazetteer is compiled (see the ``loci_build_gazetteer`` management
+command) into a binary file which contains an implicit, balanced KD-tree
+of the places (stored as unit vectors, so that the nearest point in the
+euclidean space is also the nearest point on the sphere) and the data
+needed to answer lookups. The file is memory mapped, hence it is loaded
+lazily by the operating system and shared between processes.
+
+File layout (native byte order)::
+
+    magic (8 bytes) | count (uint64)
+    vectors (float64, count * 3)      # KD-tree order
+    coordinates (float64, count * 2)  # lat, lng
+    name order (uint64, count)        # records sorted by normalized name
+    label offsets (uint64, count + 1)
+    name offsets (uint64, count + 1)
+    labels (utf-8) | normalized names (utf-8)
+"""
+
+import csv
+import math
+import mmap
+import struct
+from array import array
+from functools import lru_cache
+
+from django.core.exceptions import ImproperlyConfigured
+from geopy.adapters import BaseAsyncAdapter
+from geopy.location import Location
+from geopy.point import Point
+
+from . import settings as app_settings
+from .base.geocoding_cache import normalize_address
+
+MAGIC = b"LOCIGAZ1"
+HEADER = struct.Struct("=8sQ")
+EARTH_RADIUS = 6371.0088  # km
+
+
+def to_vector(lat, lng):
+    lat, lng = math.radians(lat), math.radians(lng)
+    cos_lat = math.cos(lat)
+    return (cos_lat * math.cos(lng), cos_lat * math.sin(lng), math.sin(lat))
+
+
+def chord_to_km(chord):
+    return 2 * math.asin(min(chord / 2, 1)) * EARTH_RADIUS
+
+
+def read_geonames(file):
+    """
+    yields ``(name, lat, lng, label)`` tuples from a
+    GeoNames dump (eg: ``cities500.txt``)
+    """
+    for row in csv.reader(file, delimiter="\t", quoting=csv.QUOTE_NONE):
+        if len(row) < 9:
+            continue
+        name, country = row[1], row[8]
+        label = f"{name}, {country}" if country else name
+        yield name, float(row[4]), float(row[5]), label
+
+
+def read_csv(file):
+    """
+    yields ``(name, lat, lng, label)`` tuples from a CSV file
+    having the ``name``, ``lat``, ``lng`` and (optionally)
+    ``label`` columns
+    """
+    for row in csv.DictReader(file):
+        label = row.get("label") or row["name"]
+        yield row["name"], float(row["lat"]), float(row["lng"]), label
+
+
+def _kdtree_order(vectors):
+    """
+    returns the indexes of ``vectors`` sorted in the order of an implicit
+    KD-tree: the root of each range is the median of the range, whose
+    splitting axis is defined by the depth of the range
+    """
+    order = list(range(len(vectors)))
+    stack = [(0, len(order), 0)]
+    while stack:
+        lo, hi, depth = stack.pop()
+        if hi - lo <= 1:
+            continue
+        axis = depth % 3
+        order[lo:hi] = sorted(order[lo:hi], key=lambda i: vectors[i][axis])
+        median = (lo + hi) // 2
+        stack.append((lo, median, depth + 1))
+        stack.append((median + 1, hi, depth + 1))
+    return order
+
+
+def build_gazetteer(places, path):
+    """
+    writes the gazetteer file from an iterable
+    of ``(name, lat, lng, label)`` tuples
+    """
+    places = list(places)
+    vectors = [to_vector(lat, lng) for _, lat, lng, _ in places]
+    order = _kdtree_order(vectors)
+    places = [places[i] for i in order]
+    vector_array = array("d")
+    coordinates = array("d")
+    for i in order:
+        vector_array.extend(vectors[i])
+    labels, names = bytearray(), bytearray()
+    label_offsets, name_offsets = array("Q", [0]), array("Q", [0])
+    for name, lat, lng, label in places:
+        coordinates.extend((lat, lng))
+        labels += label.encode()
+        label_offsets.append(len(labels))
+        names += normalize_address(name).encode()
+        name_offsets.append(len(names))
+
+    def name_key(i):
+        start, end = name_offsets[i], name_offsets[i + 1]
+        return names[start:end]
+
+    name_order = array("Q", sorted(range(len(places)), key=name_key))
+    with open(path, "wb") as file:
+        file.write(HEADER.pack(MAGIC, len(places)))
+        for section in (
+            vector_array,
+            coordinates,
+            name_order,
+            label_offsets,
+            name_offsets,
+        ):
+            section.tofile(file)
+        file.write(labels)
+        file.write(names)
+    return len(places)
+
+
+class GazetteerIndex:
+    """
+    read only, memory mapped gazetteer
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a valid gazetteer file")
+        self.count = count
+        view = memoryview(self._mmap)
+        offset = HEADER.size
+
+        def section(typecode, length):
+            nonlocal offset
+            size = length * 8
+            start, offset = offset, offset + size
+            return view[start:offset].cast(typecode)
+
+        self._vectors = section("d", count * 3)
+        self._coordinates = section("d", count * 2)
+        self._name_order = section("Q", count)
+        self._label_offsets = section("Q", count + 1)
+        self._name_offsets = section("Q", count + 1)
+        self._labels_start = offset
+        self._names_start = offset + self._label_offsets[count]
+
+    def _label(self, i):
+        start = self._labels_start + self._label_offsets[i]
+        end = self._labels_start + self._label_offsets[i + 1]
+        return self._mmap[start:end].decode()
+
+    def _name(self, i):
+        start = self._names_start + self._name_offsets[i]
+        end = self._names_start + self._name_offsets[i + 1]
+        return self._mmap[start:end]
+
+    def _place(self, i, distance=None):
+        lat, lng = self._coordinates[i * 2], self._coordinates[i * 2 + 1]
+        return {"label": self._label(i), "lat": lat, "lng": lng, "distance": distance}
+
+    def nearest(self, lat, lng):
+        """
+        returns the place nearest to the given coordinates
+        (``distance`` is expressed in km) or ``None``
+        """
+        if not self.count:
+            return None
+        query = to_vector(lat, lng)
+        vectors = self._vectors
+        best, best_index = math.inf, None
+        # (lo, hi, depth, squared distance from the splitting plane)
+        stack = [(0, self.count, 0, 0.0)]
+        while stack:
+            lo, hi, depth, bound = stack.pop()
+            if lo >= hi or bound >= best:
+                continue
+            median = (lo + hi) // 2
+            base = median * 3
+            dx = vectors[base] - query[0]
+            dy = vectors[base + 1] - query[1]
+            dz = vectors[base + 2] - query[2]
+            distance = dx * dx + dy * dy + dz * dz
+            if distance < best:
+                best, best_index = distance, median
+            axis = depth % 3
+            diff = query[axis] - vectors[base + axis]
+            if diff < 0:
+                near, far = (lo, median), (median + 1, hi)
+            else:
+                near, far = (median + 1, hi), (lo, median)
+            # the far side is visited last (and pruned if possible)
+            stack.append((far[0], far[1], depth + 1, diff * diff))
+            stack.append((near[0], near[1], depth + 1, 0.0))
+        return self._place(best_index, chord_to_km(math.sqrt(best)))
+
+    def search(self, name):
+        """
+        returns the first place whose normalized name matches ``name``
+        """
+        key = normalize_address(name).encode()
+        lo, hi = 0, self.count
+        while lo < hi:
+            middle = (lo + hi) // 2
+            if self._name(self._name_order[middle]) < key:
+                lo = middle + 1
+            else:
+                hi = middle
+        if lo < self.count and self._name(self._name_order[lo]) == key:
+            return self._place(self._name_order[lo])
+        return None
+
+
+@lru_cache(maxsize=None)
+def load_index(path):
+    return GazetteerIndex(path)
+
+
+class Gazetteer:
+    """
+    geopy compatible geocoder which answers lookups using the local
+    gazetteer defined in ``DJANGO_LOCI_GAZETTEER_PATH``, it can be
+    enabled by setting ``DJANGO_LOCI_GEOCODER`` to
+    ``"django_loci.gazetteer.Gazetteer"``
+    """
+
+    # lookups are not subject to the rate limit and the circuit breaker
+    is_local = True
+
+    def __init__(self, user_agent=None, path=None, adapter_factory=None, **kwargs):
+        path = path or app_settings.DJANGO_LOCI_GAZETTEER_PATH
+        if not path:
+            raise ImproperlyConfigured(
+                "DJANGO_LOCI_GAZETTEER_PATH must be defined in order "
+                "to use the gazetteer geocoder"
+            )
+        self.path = path
+        self.max_distance = app_settings.DJANGO_LOCI_GAZETTEER_MAX_DISTANCE
+        self.is_async = bool(
+            adapter_factory and issubclass(adapter_factory, BaseAsyncAdapter)
+        )
+
+    @property
+    def index(self):
+        return load_index(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    def _result(self, place):
+        location = None
+        if place:
+            location = Location(place["label"], (place["lat"], place["lng"]), place)
+        if not self.is_async:
+            return location
+
+        # async adapters return coroutines
+        async def result():
+            return location
+
+        return result()
+
+    def geocode(self, query, exactly_one=True, **kwargs):
+        return self._result(self.index.search(query))
+
+    def reverse(self, query, exactly_one=True, **kwargs):
+        point = Point(query)
+        place = self.index.nearest(point.latitude, point.longitude)
+        if place and self.max_distance and place["distance"] > self.max_distance:
+            place = None
+        return self._result(place)
@@ -0,0 +1,80 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+
+from ...gazetteer import GazetteerIndex, build_gazetteer, read_csv, read_geonames
+
+READERS = {"geonames": read_geonames, "csv": read_csv}
+
+
+class Command(BaseCommand):
+    help = "Builds the gazetteer used by the offline geocoder"
+
+    def add_arguments(self, parser):
+        parser.add_argument("source", help="GeoNames dump or CSV file")
+        parser.add_argument("output", help="path of the gazetteer file")
+        parser.add_argument(
+            "--format",
+            choices=list(READERS.keys()),
+            default="geonames",
+            help="format of the source file",
+        )
+        parser.add_argument(
+            "--benchmark",
+            type=int,
+            default=0,
+            help="number of random reverse lookups used to measure the gazetteer",
+        )
+        parser.add_argument(
+            "--compare-geopy",
+            default=None,
+            metavar="GEOCODER",
+            help="geopy geocoder (eg: ArcGIS) to benchmark for comparison",
+        )
+        parser.add_argument(
+            "--compare-count",
+            type=int,
+            default=10,
+            help="number of reverse lookups performed with the geopy geocoder",
+        )
+
+    def handle(self, *args, **options):
+        start = time.monotonic()
+        try:
+            with open(options["source"], encoding="utf-8") as file:
+                places = READERS[options["format"]](file)
+                count = build_gazetteer(places, options["output"])
+        except (OSError, KeyError, ValueError) as error:
+            raise CommandError(f"Could not build the gazetteer: {error}")
+        elapsed = time.monotonic() - start
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Stored {count} places in {options['output']} ({elapsed:.2f} seconds)"
+            )
+        )
+        if options["benchmark"]:
+            index = GazetteerIndex(options["output"])
+            self._benchmark("gazetteer", index.nearest, options["benchmark"])
+        if options["compare_geopy"]:
+            geocoder = import_string(f"geopy.geocoders.{options['compare_geopy']}")
+            geolocator = geocoder(user_agent="django_loci")
+            self._benchmark(
+                options["compare_geopy"],
+                lambda lat, lng: geolocator.reverse((lat, lng)),
+                options["compare_count"],
+            )
+
+    def _benchmark(self, name, reverse, count):
+        coordinates = [
+            (random.uniform(-90, 90), random.uniform(-180, 180)) for _ in range(count)
+        ]
+        start = time.perf_counter()
+        for lat, lng in coordinates:
+            reverse(lat, lng)
+        elapsed = time.perf_counter() - start
+        self.stdout.write(
+            f"{name}: {count} reverse lookups in {elapsed:.3f} seconds "
+            f"({elapsed / count * 1_000_000:.1f} µs per lookup)"
+        )
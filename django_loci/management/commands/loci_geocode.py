@@ -0,0 +1,6 @@
+from ...base.commands import BaseGeocodeCommand
+from ...models import Location
+
+
+class Command(BaseGeocodeCommand):
+    location_model = Location
@@ -0,0 +1,7 @@
+from ...base.commands import BasePrunePositionsCommand
+from ...models import Position, TraceSegment
+
+
+class Command(BasePrunePositionsCommand):
+    position_model = Position
+    trace_segment_model = TraceSegment
@@ -0,0 +1,40 @@
+import django.contrib.gis.db.models.fields
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [("django_loci", "0001_initial")]
+
+    operations = [
+        migrations.CreateModel(
+            name="Position",
+            fields=[
+                ("id", models.BigAutoField(primary_key=True, serialize=False)),
+                ("timestamp", models.DateTimeField(verbose_name="timestamp")),
+                (
+                    "geometry",
+                    django.contrib.gis.db.models.fields.PointField(
+                        srid=4326, verbose_name="geometry"
+                    ),
+                ),
+                (
+                    "location",
+                    models.ForeignKey(
+                        db_index=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="django_loci.location",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["location", "timestamp"],
+                        name="django_loci_position_lts",
+                    )
+                ],
+                "abstract": False,
+            },
+        ),
+    ]
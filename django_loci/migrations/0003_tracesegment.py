@@ -0,0 +1,49 @@
+import django.contrib.gis.db.models.fields
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [("django_loci", "0002_position")]
+
+    operations = [
+        migrations.CreateModel(
+            name="TraceSegment",
+            fields=[
+                ("id", models.BigAutoField(primary_key=True, serialize=False)),
+                (
+                    "is_stop",
+                    models.BooleanField(default=False, verbose_name="is stop?"),
+                ),
+                ("start", models.DateTimeField(verbose_name="start")),
+                ("end", models.DateTimeField(verbose_name="end")),
+                (
+                    "geometry",
+                    django.contrib.gis.db.models.fields.GeometryField(
+                        srid=4326, verbose_name="geometry"
+                    ),
+                ),
+                (
+                    "offsets",
+                    models.JSONField(blank=True, default=list, verbose_name="offsets"),
+                ),
+                (
+                    "location",
+                    models.ForeignKey(
+                        db_index=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="django_loci.location",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["location", "start"],
+                        name="django_loci_tracesegment_lst",
+                    )
+                ],
+                "abstract": False,
+            },
+        ),
+    ]
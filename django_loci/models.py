@@ -1,4 +1,10 @@
-from .base.models import AbstractFloorPlan, AbstractLocation, AbstractObjectLocation
+from .base.models import (
+    AbstractFloorPlan,
+    AbstractLocation,
+    AbstractObjectLocation,
+    AbstractPosition,
+    AbstractTraceSegment,
+)
 
 
 class Location(AbstractLocation):
@@ -14,3 +20,13 @@ class FloorPlan(AbstractFloorPlan):
 class ObjectLocation(AbstractObjectLocation):
     class Meta(AbstractObjectLocation.Meta):
         abstract = False
+
+
+class Position(AbstractPosition):
+    class Meta(AbstractPosition.Meta):
+        abstract = False
+
+
+class TraceSegment(AbstractTraceSegment):
+    class Meta(AbstractTraceSegment.Meta):
+        abstract = False
@@ -3,6 +3,10 @@ from django.core.exceptions import ImproperlyConfigured
 from django.utils.module_loading import import_string
 
 DJANGO_LOCI_GEOCODER = getattr(settings, "DJANGO_LOCI_GEOCODER", "ArcGIS")
+DJANGO_LOCI_GAZETTEER_PATH = getattr(settings, "DJANGO_LOCI_GAZETTEER_PATH", None)
+DJANGO_LOCI_GAZETTEER_MAX_DISTANCE = getattr(
+    settings, "DJANGO_LOCI_GAZETTEER_MAX_DISTANCE", 50
+)
 DJANGO_LOCI_GEOCODE_FAILURE_DELAY = getattr(
     settings, "DJANGO_LOCI_GEOCODE_FAILURE_DELAY", 1
 )
@@ -10,6 +14,99 @@ DJANGO_LOCI_GEOCODE_RETRIES = getattr(settings, "DJANGO_LOCI_GEOCODE_RETRIES", 3
 DJANGO_LOCI_GEOCODE_API_KEY = getattr(
     settings, "DJANGO_LOCI_GEOCODE_GOOGLE_API_KEY", None
 )
+DJANGO_LOCI_GEOCODE_RATE_LIMIT = getattr(
+    settings, "DJANGO_LOCI_GEOCODE_RATE_LIMIT", None
+)
+DJANGO_LOCI_GEOCODE_RATE_LIMIT_BURST = getattr(
+    settings, "DJANGO_LOCI_GEOCODE_RATE_LIMIT_BURST", 5
+)
+DJANGO_LOCI_GEOCODE_BREAKER_THRESHOLD = getattr(
+    settings, "DJANGO_LOCI_GEOCODE_BREAKER_THRESHOLD", 5
+)
+DJANGO_LOCI_GEOCODE_BREAKER_RESET_TIMEOUT = getattr(
+    settings, "DJANGO_LOCI_GEOCODE_BREAKER_RESET_TIMEOUT", 60
+)
+DJANGO_LOCI_GEOCODE_ASYNC = getattr(settings, "DJANGO_LOCI_GEOCODE_ASYNC", False)
+DJANGO_LOCI_GEOCODE_CHECK = getattr(settings, "DJANGO_LOCI_GEOCODE_CHECK", True)
+DJANGO_LOCI_GEOCODE_CHECK_TIMEOUT = getattr(
+    settings, "DJANGO_LOCI_GEOCODE_CHECK_TIMEOUT", 5
+)
+DJANGO_LOCI_GEOCODE_CACHE = getattr(settings, "DJANGO_LOCI_GEOCODE_CACHE", "default")
+DJANGO_LOCI_GEOCODE_CACHE_TIMEOUT = getattr(
+    settings, "DJANGO_LOCI_GEOCODE_CACHE_TIMEOUT", 60 * 60 * 24 * 30
+)
+DJANGO_LOCI_GEOCODE_CACHE_NEGATIVE_TIMEOUT = getattr(
+    settings, "DJANGO_LOCI_GEOCODE_CACHE_NEGATIVE_TIMEOUT", 60 * 60
+)
+DJANGO_LOCI_GEOCODE_CACHE_LOCK_TIMEOUT = getattr(
+    settings, "DJANGO_LOCI_GEOCODE_CACHE_LOCK_TIMEOUT", 0
+)
+DJANGO_LOCI_REVERSE_GEOCODE_CACHE_PRECISION = getattr(
+    settings, "DJANGO_LOCI_REVERSE_GEOCODE_CACHE_PRECISION", 4
+)
+DJANGO_LOCI_BROADCAST_QUEUE_SIZE = getattr(
+    settings, "DJANGO_LOCI_BROADCAST_QUEUE_SIZE", 10000
+)
+DJANGO_LOCI_BROADCAST_MIN_DISTANCE = getattr(
+    settings, "DJANGO_LOCI_BROADCAST_MIN_DISTANCE", 0
+)
+DJANGO_LOCI_BROADCAST_MIN_INTERVAL = getattr(
+    settings, "DJANGO_LOCI_BROADCAST_MIN_INTERVAL", 0
+)
+DJANGO_LOCI_BROADCAST_MAX_DELAY = getattr(
+    settings, "DJANGO_LOCI_BROADCAST_MAX_DELAY", 30
+)
+DJANGO_LOCI_BROADCAST_CACHE = getattr(
+    settings, "DJANGO_LOCI_BROADCAST_CACHE", "default"
+)
+DJANGO_LOCI_BROADCAST_TICK = getattr(settings, "DJANGO_LOCI_BROADCAST_TICK", 0)
+DJANGO_LOCI_BROADCAST_GRID_LEVELS = getattr(
+    settings, "DJANGO_LOCI_BROADCAST_GRID_LEVELS", ()
+)
+DJANGO_LOCI_BROADCAST_PRECISION = getattr(
+    settings, "DJANGO_LOCI_BROADCAST_PRECISION", 6
+)
+DJANGO_LOCI_BROADCAST_OUTBOX_SIZE = getattr(
+    settings, "DJANGO_LOCI_BROADCAST_OUTBOX_SIZE", 1000
+)
+DJANGO_LOCI_BROADCAST_RESYNC_WINDOW = getattr(
+    settings, "DJANGO_LOCI_BROADCAST_RESYNC_WINDOW", 5
+)
+DJANGO_LOCI_COMMON_GROUP_SHARDS = getattr(
+    settings, "DJANGO_LOCI_COMMON_GROUP_SHARDS", 1
+)
+DJANGO_LOCI_WEBSOCKET_TOKEN_MAX_AGE = getattr(
+    settings, "DJANGO_LOCI_WEBSOCKET_TOKEN_MAX_AGE", 0
+)
+DJANGO_LOCI_POSITION_HISTORY = getattr(settings, "DJANGO_LOCI_POSITION_HISTORY", False)
+DJANGO_LOCI_POSITION_HISTORY_BATCH_SIZE = getattr(
+    settings, "DJANGO_LOCI_POSITION_HISTORY_BATCH_SIZE", 500
+)
+DJANGO_LOCI_POSITION_HISTORY_FLUSH_INTERVAL = getattr(
+    settings, "DJANGO_LOCI_POSITION_HISTORY_FLUSH_INTERVAL", 5
+)
+DJANGO_LOCI_POSITION_HISTORY_RETENTION = getattr(
+    settings, "DJANGO_LOCI_POSITION_HISTORY_RETENTION", 30
+)
+DJANGO_LOCI_POSITION_HISTORY_DOWNSAMPLE = getattr(
+    settings, "DJANGO_LOCI_POSITION_HISTORY_DOWNSAMPLE", ((1, 60), (7, 900))
+)
+DJANGO_LOCI_POSITION_HISTORY_COMPRESS = getattr(
+    settings, "DJANGO_LOCI_POSITION_HISTORY_COMPRESS", 0
+)
+DJANGO_LOCI_TRACE_TOLERANCE = getattr(settings, "DJANGO_LOCI_TRACE_TOLERANCE", 10)
+DJANGO_LOCI_TRACE_STOP_RADIUS = getattr(settings, "DJANGO_LOCI_TRACE_STOP_RADIUS", 25)
+DJANGO_LOCI_TRACE_STOP_DURATION = getattr(
+    settings, "DJANGO_LOCI_TRACE_STOP_DURATION", 120
+)
+DJANGO_LOCI_TRACE_MAX_GAP = getattr(settings, "DJANGO_LOCI_TRACE_MAX_GAP", 600)
+DJANGO_LOCI_WRITE_BEHIND = getattr(settings, "DJANGO_LOCI_WRITE_BEHIND", False)
+DJANGO_LOCI_WRITE_BEHIND_CACHE = getattr(
+    settings, "DJANGO_LOCI_WRITE_BEHIND_CACHE", "default"
+)
+DJANGO_LOCI_WRITE_BEHIND_FLUSH_INTERVAL = getattr(
+    settings, "DJANGO_LOCI_WRITE_BEHIND_FLUSH_INTERVAL", 5
+)
 FLOORPLAN_STORAGE = getattr(
     settings, "LOCI_FLOORPLAN_STORAGE", "django_loci.storage.OverwriteStorage"
 )
@@ -0,0 +1,6 @@
+from django.dispatch import Signal
+
+# sent by ``LocationQuerySet.bulk_move`` and by the write-behind buffer
+# (neither sends ``post_save``) with the list of the moved locations
+# (``instances``) and ``using``
+locations_moved = Signal()
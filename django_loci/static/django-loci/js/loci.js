@@ -433,8 +433,11 @@ django.jQuery(function ($) {
   function listenForLocationUpdates(pk) {
     var host = window.location.host,
       protocol = window.location.protocol === "http:" ? "ws" : "wss",
+      // signed token which spares the session lookup on connect
+      token = $("#loci-websocket-token").attr("data-token"),
+      query = token ? "?token=" + encodeURIComponent(token) : "",
       ws = new ReconnectingWebSocket(
-        protocol + "://" + host + "/ws/loci/location/" + pk + "/",
+        protocol + "://" + host + "/ws/loci/location/" + pk + "/" + query,
       );
     ws.onmessage = function (e) {
       const data = JSON.parse(e.data);
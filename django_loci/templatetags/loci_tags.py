@@ -0,0 +1,18 @@
+from django import template
+
+from ..channels.tokens import make_token
+
+register = template.Library()
+
+
+@register.simple_tag(takes_context=True)
+def loci_websocket_token(context, location=None):
+    """
+    returns the token which authenticates the WebSocket connections of the
+    current user (restricted to ``location`` if given), see ``tokens.py``
+    """
+    request = context.get("request")
+    if request is None or not request.user.is_authenticated:
+        return ""
+    locations = [location.pk] if getattr(location, "pk", None) else None
+    return make_token(request.user, locations)
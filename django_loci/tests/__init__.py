@@ -210,7 +210,7 @@ class TestChannelsMixin(object):
             include_pk=False,
         )
 
-    async def _save_location(self, pk):
+    async def _save_location(self, pk, geometry="POINT (12.513124 41.897903)"):
         loc = await self.location_model.objects.aget(pk=pk)
-        loc.geometry = "POINT (12.513124 41.897903)"
+        loc.geometry = geometry
         await loc.asave()
@@ -1,10 +1,20 @@
 import json
+from unittest.mock import Mock, patch
 
 import responses
-from django.contrib.auth.models import Permission
+from asgiref.sync import async_to_sync
+from django.contrib.admin.sites import site
+from django.contrib.auth.models import AnonymousUser, Permission
 from django.contrib.humanize.templatetags.humanize import ordinal
+from django.core.cache import cache
+from django.test import RequestFactory
 from django.urls import reverse
 
+from ... import settings as app_settings
+from ...base import geocoding_cache, write_behind
+from ...base.admin import async_admin_view
+from ...base.geocoding_views import async_geocode_view, async_reverse_geocode_view
+from ...channels.tokens import read_token
 from .. import TestAdminMixin, TestLociMixin
 
 
@@ -13,6 +23,11 @@ class BaseTestAdmin(TestAdminMixin, TestLociMixin):
     geocode_url = "https://geocode.arcgis.com/arcgis/rest/services/World/GeocodeServer/"
     permission_model = Permission
 
+    def setUp(self):
+        super().setUp()
+        # geocoding results are cached
+        cache.clear()
+
     def test_location_list(self):
         self._login_as_admin()
         self._create_location(name="test-admin-location-1")
@@ -41,6 +56,23 @@ class BaseTestAdmin(TestAdminMixin, TestLociMixin):
         }
         self.assertDictEqual(r.json(), expected)
 
+    def test_location_json_view_write_behind(self):
+        self._login_as_admin()
+        loc = self._create_location(is_mobile=True)
+        buffer = write_behind.WriteBehindBuffer(self.location_model, cache=cache)
+        self.addCleanup(cache.clear)
+        with patch.object(write_behind, "buffer", buffer), patch.object(
+            buffer, "_ensure_started"
+        ):
+            buffer.move(loc, "POINT (12.6 41.9)", "Via del Corso")
+            r = self.client.get(
+                reverse("admin:django_loci_location_json", args=[loc.pk])
+            )
+        self.assertEqual(r.json()["address"], "Via del Corso")
+        self.assertEqual(
+            r.json()["geometry"], {"type": "Point", "coordinates": [12.6, 41.9]}
+        )
+
     def test_location_floorplan_json_view(self):
         self._login_as_admin()
         fl = self._create_floorplan()
@@ -71,6 +103,17 @@ class BaseTestAdmin(TestAdminMixin, TestLociMixin):
         r = self.client.get(url)
         self.assertContains(r, "test-admin-location-1")
 
+    def test_location_change_websocket_token(self):
+        self._login_as_admin()
+        loc = self._create_location(is_mobile=True)
+        url = reverse("{0}_location_change".format(self.url_prefix), args=[loc.pk])
+        r = self.client.get(url)
+        self.assertContains(r, '<span id="loci-websocket-token"\n      data-token="">')
+        with patch.object(app_settings, "DJANGO_LOCI_WEBSOCKET_TOKEN_MAX_AGE", 60):
+            r = self.client.get(url)
+            token = r.content.decode().split('data-token="')[1].split('"')[0]
+            self.assertTrue(read_token(token).has_location(loc.pk))
+
     def test_floorplan_change_image_removed(self):
         self._login_as_admin()
         loc = self._create_location(name="test-admin-location-1", type="indoor")
@@ -232,6 +275,145 @@ class BaseTestAdmin(TestAdminMixin, TestLociMixin):
         self.assertEqual(response.status_code, 400)
         self.assertEqual(response.json(), expected)
 
+    def test_reverse_geocode_invalid_coords(self):
+        self._login_as_admin()
+        url = "{0}?lat=a&lng=b".format(
+            reverse("admin:django_loci_location_reverse_geocode_api")
+        )
+        response = self.client.get(url)
+        expected = {"error": "lat or lng parameter not valid"}
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), expected)
+
+    def test_geocode_metrics(self):
+        url = reverse("admin:django_loci_location_geocode_metrics")
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 302)
+        self._login_as_admin()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["geocode"]["requests"], 0)
+        response = self.client.get(url, {"format": "prometheus"})
+        self.assertContains(response, "django_loci_geocoding_requests_total")
+
+    @responses.activate
+    def test_geocode_cache(self):
+        self._login_as_admin()
+        base_url = reverse("admin:django_loci_location_geocode_api")
+        responses.add(
+            responses.GET,
+            f"{self.geocode_url}findAddressCandidates?singleLine=Red+Square&f=json&maxLocations=1",
+            body=self._load_content("base/static/test-geocode.json"),
+            content_type="application/json",
+        )
+        response = self.client.get(f"{base_url}?address=Red Square")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(responses.calls), 1)
+        # normalized address is served from the cache
+        response = self.client.get(f"{base_url}?address= red  SQUARE,")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(round(response.json()["lat"]), 56)
+        self.assertEqual(len(responses.calls), 1)
+        stats = geocoding_cache.get_stats()
+        self.assertEqual(stats["geocode_hits"], 1)
+        self.assertEqual(stats["geocode_misses"], 1)
+
+    @responses.activate
+    def test_geocode_negative_cache(self):
+        self._login_as_admin()
+        invalid_address = "thisaddressisnotvalid123abc"
+        url = "{0}?address={1}".format(
+            reverse("admin:django_loci_location_geocode_api"), invalid_address
+        )
+        responses.add(
+            responses.GET,
+            f"{self.geocode_url}findAddressCandidates?singleLine=thisaddressisnotvalid123abc"
+            "&f=json&maxLocations=1",
+            body=self._load_content("base/static/test-geocode-invalid-address.json"),
+            content_type="application/json",
+        )
+        for _ in range(2):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 404)
+        self.assertEqual(len(responses.calls), 1)
+
+    @responses.activate
+    def test_reverse_geocode_cache(self):
+        self._login_as_admin()
+        base_url = reverse("admin:django_loci_location_reverse_geocode_api")
+        responses.add(
+            responses.GET,
+            f"{self.geocode_url}reverseGeocode?location=21.0%2C52.0&f=json&outSR=4326",
+            body=self._load_content("base/static/test-reverse-geocode.json"),
+            content_type="application/json",
+        )
+        response = self.client.get(f"{base_url}?lat=52&lng=21")
+        self.assertEqual(response.status_code, 200)
+        # coordinates are snapped to the grid of the cache
+        response = self.client.get(f"{base_url}?lat=52.00001&lng=21.00001")
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "POL")
+        self.assertEqual(len(responses.calls), 1)
+        stats = geocoding_cache.get_stats()
+        self.assertEqual(stats["reverse_geocode_hits"], 1)
+        self.assertEqual(stats["reverse_geocode_misses"], 1)
+
+    @responses.activate
+    @patch.object(app_settings, "DJANGO_LOCI_GEOCODE_CACHE", None)
+    def test_geocode_cache_disabled(self):
+        self._login_as_admin()
+        url = "{0}?address=Red Square".format(
+            reverse("admin:django_loci_location_geocode_api")
+        )
+        responses.add(
+            responses.GET,
+            f"{self.geocode_url}findAddressCandidates?singleLine=Red+Square&f=json&maxLocations=1",
+            body=self._load_content("base/static/test-geocode.json"),
+            content_type="application/json",
+        )
+        self.client.get(url)
+        self.client.get(url)
+        self.assertEqual(len(responses.calls), 2)
+        self.assertEqual(geocoding_cache.get_stats()["geocode_hits"], 0)
+
+    @patch("django_loci.base.geocoding_views.ageocode")
+    def test_async_geocode_view(self, ageocode):
+        ageocode.return_value = Mock(latitude=55.75, longitude=37.62)
+        request = RequestFactory().get("/", {"address": "Red Square"})
+        response = async_to_sync(async_geocode_view)(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content), {"lat": 55.75, "lng": 37.62})
+        # second lookup is served from the cache
+        async_to_sync(async_geocode_view)(request)
+        ageocode.assert_awaited_once_with("Red Square")
+        ageocode.return_value = None
+        request = RequestFactory().get("/", {"address": "thisaddressisnotvalid"})
+        response = async_to_sync(async_geocode_view)(request)
+        self.assertEqual(response.status_code, 404)
+
+    @patch("django_loci.base.geocoding_views.areverse_geocode")
+    def test_async_reverse_geocode_view(self, areverse_geocode):
+        areverse_geocode.return_value = [Mock(address="Warsaw, POL")]
+        request = RequestFactory().get("/", {"lat": "52", "lng": "21"})
+        response = async_to_sync(async_reverse_geocode_view)(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content), {"address": "Warsaw, POL"})
+        areverse_geocode.assert_awaited_once_with((52.0, 21.0))
+        request = RequestFactory().get("/", {"lat": "52"})
+        response = async_to_sync(async_reverse_geocode_view)(request)
+        self.assertEqual(response.status_code, 400)
+
+    def test_async_admin_view(self):
+        view = async_admin_view(site, async_geocode_view)
+        request = RequestFactory().get("/")
+        request.user = AnonymousUser()
+        response = async_to_sync(view)(request)
+        self.assertEqual(response.status_code, 302)
+        request.user = self._create_admin()
+        response = async_to_sync(view)(request)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("no-cache", response["Cache-Control"])
+
     def _get_location_add_params(self, **kwargs):
         params = {
             "name": "test location",
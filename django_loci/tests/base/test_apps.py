@@ -1,16 +1,24 @@
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.checks import Warning
+from geopy.exc import GeocoderTimedOut
 
+from ... import settings as app_settings
 from ...apps import test_geocoding
+from ...base.geocoding_views import check_geocoding
 from .. import TestLociMixin
 
 
 class BaseTestApps(TestLociMixin):
-    @patch("django_loci.apps.geocode", return_value=None)
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    @patch("django_loci.apps.check_geocoding", return_value=False)
     @patch.object(settings, "TESTING", False)
-    def test_geocode_strict(self, geocode_mocked):
+    def test_geocode_strict(self, check_mocked):
         warning = test_geocoding()
         self.assertEqual(
             warning,
@@ -20,4 +28,30 @@ class BaseTestApps(TestLociMixin):
                 )
             ],
         )
-        geocode_mocked.assert_called_once()
+        check_mocked.assert_called_once()
+
+    @patch("django_loci.apps.check_geocoding", return_value=False)
+    @patch.object(settings, "TESTING", False)
+    @patch.object(app_settings, "DJANGO_LOCI_GEOCODE_CHECK", False)
+    def test_geocode_check_disabled(self, check_mocked):
+        self.assertEqual(test_geocoding(), [])
+        check_mocked.assert_not_called()
+
+    @patch("django_loci.base.geocoding_views.get_geolocator")
+    def test_check_geocoding_cached(self, get_geolocator):
+        geolocator = get_geolocator.return_value
+        geolocator.geocode.return_value = Mock(latitude=55.7, longitude=37.6)
+        self.assertTrue(check_geocoding())
+        self.assertTrue(check_geocoding())
+        geolocator.geocode.assert_called_once_with(
+            "Red Square", timeout=app_settings.DJANGO_LOCI_GEOCODE_CHECK_TIMEOUT
+        )
+
+    @patch("django_loci.base.geocoding_views.get_geolocator")
+    def test_check_geocoding_failure(self, get_geolocator):
+        geolocator = get_geolocator.return_value
+        geolocator.geocode.side_effect = GeocoderTimedOut()
+        self.assertFalse(check_geocoding())
+        # failures are not cached
+        self.assertFalse(check_geocoding())
+        self.assertEqual(geolocator.geocode.call_count, 2)
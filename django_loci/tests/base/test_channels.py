@@ -1,14 +1,51 @@
 # use pytest
+import asyncio
+import json
+import threading
+from unittest.mock import patch
+
 import pytest
 from channels.db import database_sync_to_async
-from channels.routing import ProtocolTypeRouter
+from channels.layers import get_channel_layer
+from channels.routing import ProtocolTypeRouter, URLRouter
+from channels.testing import WebsocketCommunicator
 from django.contrib.auth.models import Permission
+from django.contrib.gis.geos import GEOSGeometry, Point
+from django.core.cache import cache
+from django.db import transaction
+from django.urls import path
 
-from django_loci.channels.consumers import CommonLocationBroadcast, LocationBroadcast
+from django_loci.channels.consumers import (
+    AsyncCommonLocationBroadcast,
+    AsyncMultiLocationBroadcast,
+    CommonLocationBroadcast,
+    LocationBroadcast,
+)
 
-from ...channels.base import _get_object_or_none
+from ... import settings as app_settings
+from ...channels import grid
+from ...channels.base import _get_object_or_none, location_broadcast_path
+from ...channels.batching import TickBatcher
+from ...channels.dispatcher import BroadcastDispatcher, dispatcher
+from ...channels.encoding import CompactEncoder
+from ...channels.outbox import Outbox
+from ...channels.outbox import get_stats as get_outbox_stats
+from ...channels.receivers import (
+    geometry_to_dict,
+    get_common_payload,
+    get_location_messages,
+    get_location_payload,
+    get_seq,
+)
+from ...channels.throttle import BroadcastThrottle, distance
+from ...channels.tokens import TokenAuthMiddleware, TokenUser, make_token, read_token
 from .. import TestAdminMixin, TestChannelsMixin, TestLociMixin
 
+# the grid is disabled by default
+grid_levels = patch.object(
+    app_settings, "DJANGO_LOCI_BROADCAST_GRID_LEVELS", (3, 6, 9, 12)
+)
+
 
 class BaseTestChannels(TestAdminMixin, TestLociMixin, TestChannelsMixin):
     """
@@ -18,6 +55,7 @@ class BaseTestChannels(TestAdminMixin, TestLociMixin, TestChannelsMixin):
 
     location_consumer = LocationBroadcast
     common_location_consumer = CommonLocationBroadcast
+    multi_location_consumer = AsyncMultiLocationBroadcast
 
     @pytest.mark.django_db(transaction=True)
     def test_object_or_none(self):
@@ -163,6 +201,7 @@ class BaseTestChannels(TestAdminMixin, TestLociMixin, TestChannelsMixin):
         assert connected
         await self._save_location(request_vars["pk"])
         response = await communicator.receive_json_from()
+        assert isinstance(response.pop("seq"), int)
         assert response == {
             "geometry": {"type": "Point", "coordinates": [12.513124, 41.897903]},
             "address": "Via del Corso, Roma, Italia",
@@ -185,6 +224,7 @@ class BaseTestChannels(TestAdminMixin, TestLociMixin, TestChannelsMixin):
         assert connected
         await self._save_location(request_vars["pk"])
         response = await communicator.receive_json_from()
+        assert isinstance(response.pop("seq"), int)
         assert response == {
             "id": str(location1.pk),
             "geometry": {"type": "Point", "coordinates": [12.513124, 41.897903]},
@@ -195,6 +235,7 @@ class BaseTestChannels(TestAdminMixin, TestLociMixin, TestChannelsMixin):
         }
         await self._save_location(location2.pk)
         response = await communicator.receive_json_from()
+        assert isinstance(response.pop("seq"), int)
         assert response == {
             "id": str(location2.pk),
             "geometry": {"type": "Point", "coordinates": [12.513124, 41.897903]},
@@ -205,6 +246,690 @@ class BaseTestChannels(TestAdminMixin, TestLociMixin, TestChannelsMixin):
         }
         await communicator.disconnect()
 
+    def test_geometry_to_dict(self):
+        for geometry in (
+            Point(12.513124, 41.897903, srid=4326),
+            Point(12.513124, 41.897903, 20.5, srid=4326),
+            GEOSGeometry("POLYGON((1 1, 1 2, 2 2, 1 1))", srid=4326),
+        ):
+            assert geometry_to_dict(geometry) == json.loads(geometry.geojson)
+
+    @grid_levels
+    def test_location_messages(self):
+        location = self.location_model(
+            name="test", geometry=Point(12.513124, 41.897903, srid=4326)
+        )
+        messages = get_location_messages(location)
+        (group, message), (common_group, common_message) = messages[:2]
+        assert group == f"loci.mobile-location.{location.pk}"
+        assert common_group == "loci.mobile-location.common"
+        # the payload is built only once
+        assert common_message["message"]["geometry"] is message["message"]["geometry"]
+        assert common_message["point"] == [12.513124, 41.897903]
+        assert [group for group, _ in messages[2:]] == grid.point_groups(
+            12.513124, 41.897903
+        )
+
+    @pytest.mark.asyncio
+    @pytest.mark.django_db(transaction=True)
+    @patch.object(app_settings, "DJANGO_LOCI_BROADCAST_RESYNC_WINDOW", 0)
+    async def test_location_snapshot(self):
+        test_user = await database_sync_to_async(self._create_admin)()
+        request_vars = await self._get_specific_location_request_dict(user=test_user)
+        request_vars["path"] += "?snapshot=1"
+        communicator = self._get_specific_location_communicator(request_vars, test_user)
+        connected, _ = await communicator.connect()
+        assert connected
+        location = await self.location_model.objects.aget(pk=request_vars["pk"])
+        response = await communicator.receive_json_from()
+        assert response == {
+            "type": "snapshot",
+            "locations": [get_location_payload(location)],
+        }
+        assert await communicator.receive_json_from() == {"type": "snapshot_end"}
+        # nothing changed since the last update
+        seq = get_seq(location)
+        await communicator.send_json_to({"type": "resync", "since": seq})
+        assert await communicator.receive_json_from() == {"type": "snapshot_end"}
+        await self._save_location(location.pk)
+        update = await communicator.receive_json_from()
+        assert update["seq"] > seq
+        await communicator.send_json_to({"type": "resync", "since": seq})
+        response = await communicator.receive_json_from()
+        assert response == {"type": "snapshot", "locations": [update]}
+        assert await communicator.receive_json_from() == {"type": "snapshot_end"}
+        await communicator.disconnect()
+
+    @pytest.mark.asyncio
+    @pytest.mark.django_db(transaction=True)
+    async def test_location_snapshot_resync_window(self):
+        test_user = await database_sync_to_async(self._create_admin)()
+        request_vars = await self._get_specific_location_request_dict(user=test_user)
+        communicator = self._get_specific_location_communicator(request_vars, test_user)
+        connected, _ = await communicator.connect()
+        assert connected
+        location = await self.location_model.objects.aget(pk=request_vars["pk"])
+        # updates committed shortly before "since" are sent again
+        await communicator.send_json_to({"type": "resync", "since": get_seq(location)})
+        response = await communicator.receive_json_from()
+        assert response == {
+            "type": "snapshot",
+            "locations": [get_location_payload(location)],
+        }
+        assert await communicator.receive_json_from() == {"type": "snapshot_end"}
+        await communicator.disconnect()
+
+    @pytest.mark.asyncio
+    @pytest.mark.django_db(transaction=True)
+    async def test_common_location_snapshot_default(self):
+        test_user = await database_sync_to_async(self._create_admin)()
+        location = await database_sync_to_async(self._create_location)(is_mobile=True)
+        request_vars = await self._get_common_location_request_dict(
+            pk=location.pk, user=test_user
+        )
+        request_vars["path"] += "?snapshot=1"
+        communicator = self._get_common_location_communicator(request_vars, test_user)
+        connected, _ = await communicator.connect()
+        assert connected
+        # snapshots are opt-in
+        assert await communicator.receive_json_from() == {"type": "snapshot_end"}
+        await communicator.disconnect()
+
+    @pytest.mark.asyncio
+    @pytest.mark.django_db(transaction=True)
+    @patch.object(app_settings, "DJANGO_LOCI_BROADCAST_RESYNC_WINDOW", 0)
+    async def test_common_location_snapshot(self):
+        test_user = await database_sync_to_async(self._create_admin)()
+        location1 = await database_sync_to_async(self._create_location)(is_mobile=True)
+        location2 = await database_sync_to_async(self._create_location)(is_mobile=True)
+        await database_sync_to_async(self._create_location)(is_mobile=False)
+        request_vars = await self._get_common_location_request_dict(
+            pk=location1.pk, user=test_user
+        )
+        request_vars["path"] += f"?since={get_seq(location1)}"
+        communicator = self._get_common_location_communicator(request_vars, test_user)
+        snapshot_queryset = patch.object(
+            self.common_location_consumer,
+            "get_snapshot_queryset",
+            lambda consumer, user: consumer.model.objects.filter(is_mobile=True),
+        )
+        with snapshot_queryset:
+            connected, _ = await communicator.connect()
+            assert connected
+            # only the locations updated after location1
+            response = await communicator.receive_json_from()
+            assert response == {
+                "type": "snapshot",
+                "locations": [get_common_payload(location2)],
+            }
+            assert await communicator.receive_json_from() == {"type": "snapshot_end"}
+            await communicator.send_json_to({"type": "resync", "since": 0})
+            response = await communicator.receive_json_from()
+            assert {location["id"] for location in response["locations"]} == {
+                str(location1.pk),
+                str(location2.pk),
+            }
+            assert await communicator.receive_json_from() == {"type": "snapshot_end"}
+            await communicator.disconnect()
+
+    def test_compact_encoder(self):
+        msgpack = pytest.importorskip("msgpack")
+        encoder = CompactEncoder(precision=5)
+        message = {
+            "id": "a",
+            "geometry": {"type": "Point", "coordinates": [12.513124, 41.897903]},
+            "address": "Via del Corso, Roma, Italia",
+            "seq": 1,
+            "name": "test",
+            "type": "outdoor",
+            "is_mobile": True,
+        }
+        assert msgpack.unpackb(encoder.encode(message)) == {
+            "i": "a",
+            "s": 1,
+            "c": [1251312, 4189790],
+            "a": "Via del Corso, Roma, Italia",
+            "n": "test",
+            "t": "outdoor",
+            "m": True,
+        }
+        # static fields are sent only when they change
+        message.update(seq=2, address="Via del Tritone")
+        assert msgpack.unpackb(encoder.encode(message)) == {
+            "i": "a",
+            "s": 2,
+            "c": [1251312, 4189790],
+            "a": "Via del Tritone",
+        }
+        frame = {"type": "batch", "locations": [{**message, "id": "b"}]}
+        assert msgpack.unpackb(encoder.encode(frame))["locations"][0]["n"] == "test"
+        assert msgpack.unpackb(encoder.encode({"type": "snapshot_end"})) == {
+            "type": "snapshot_end"
+        }
+
+    @pytest.mark.asyncio
+    @pytest.mark.django_db(transaction=True)
+    async def test_location_update_msgpack(self):
+        msgpack = pytest.importorskip("msgpack")
+        test_user = await database_sync_to_async(self._create_admin)()
+        request_vars = await self._get_specific_location_request_dict(user=test_user)
+        communicator = WebsocketCommunicator(
+            self.location_consumer.as_asgi(),
+            request_vars["path"],
+            subprotocols=["loci.msgpack"],
+        )
+        communicator.scope.update(
+            {
+                "user": test_user,
+                "session": request_vars["session"],
+                "url_route": {"kwargs": {"pk": request_vars["pk"]}},
+            }
+        )
+        connected, subprotocol = await communicator.connect()
+        assert connected
+        assert subprotocol == "loci.msgpack"
+        response = msgpack.unpackb(await communicator.receive_from())
+        assert response == {"type": "encoding", "format": "msgpack", "precision": 6}
+        await self._save_location(request_vars["pk"])
+        response = msgpack.unpackb(await communicator.receive_from())
+        assert response["c"] == [12513124, 41897903]
+        assert response["a"] == "Via del Corso, Roma, Italia"
+        await self._save_location(request_vars["pk"], "POINT (12.513125 41.897903)")
+        response = msgpack.unpackb(await communicator.receive_from())
+        assert set(response) == {"s", "c"}
+        await communicator.disconnect()
+
+    def test_tick_batcher(self):
+        clock = [0]
+        batcher = TickBatcher(interval=0.25, clock=lambda: clock[0])
+        assert not batcher.accepts("loci.mobile-location.1")
+        assert batcher.accepts(grid.COMMON_GROUP)
+        assert batcher.accepts(f"{grid.COMMON_GROUP}.cell.3.4.5")
+        assert batcher.next_tick_in() is None
+
+        def event(pk, address):
+            return {"type": "send_message", "message": {"id": pk, "address": address}}
+
+        batcher.add(grid.COMMON_GROUP, event("a", "first"))
+        batcher.add(grid.COMMON_GROUP, event("b", "first"))
+        clock[0] = 0.1
+        batcher.add(grid.COMMON_GROUP, event("a", "second"))
+        assert batcher.coalesced == 1
+        assert batcher.next_tick_in() == pytest.approx(0.15)
+        assert batcher.pop_due() == []
+        clock[0] = 0.25
+        assert batcher.pop_due() == [
+            (
+                grid.COMMON_GROUP,
+                {
+                    "type": "send_batch",
+                    "events": [event("b", "first"), event("a", "second")],
+                },
+            )
+        ]
+        assert batcher.next_tick_in() is None
+        batcher.add(grid.COMMON_GROUP, event("a", "third"))
+        assert batcher.pop_due() == []
+        assert len(batcher.pop_due(force=True)) == 1
+        assert not TickBatcher().accepts(grid.COMMON_GROUP)
+
+    @pytest.mark.asyncio
+    @pytest.mark.django_db(transaction=True)
+    @grid_levels
+    async def test_common_location_batch(self):
+        test_user = await database_sync_to_async(self._create_admin)()
+        request_vars = await self._get_common_location_request_dict(user=test_user)
+        communicator = self._get_common_location_communicator(request_vars, test_user)
+        connected, _ = await communicator.connect()
+        assert connected
+        await communicator.send_json_to(
+            {"type": "subscribe", "bbox": [12.4, 41.8, 12.6, 42]}
+        )
+        await communicator.receive_json_from()
+        rome = {"type": "send_message", "message": {"id": "1"}, "point": [12.5, 41.9]}
+        paris = {"type": "send_message", "message": {"id": "2"}, "point": [2.3, 48.8]}
+        # the client joined the cells covering the bounding box
+        await get_channel_layer().group_send(
+            grid.point_groups(12.5, 41.9)[-1],
+            {"type": "send_batch", "events": [rome, paris]},
+        )
+        response = await communicator.receive_json_from()
+        assert response == {"type": "batch", "locations": [{"id": "1"}]}
+        await communicator.disconnect()
+
+    @grid_levels
+    def test_grid(self):
+        assert grid.point_groups(12.5, 41.9) == [
+            "loci.mobile-location.common.cell.3.4.5",
+            "loci.mobile-location.common.cell.6.34.46",
+            "loci.mobile-location.common.cell.9.273.375",
+            "loci.mobile-location.common.cell.12.2190.3001",
+        ]
+        bboxes = grid.parse_bboxes([12.4, 41.8, 12.6, 42])
+        assert grid.covering_groups(bboxes) == {
+            f"loci.mobile-location.common.cell.12.{x}.{y}"
+            for x in range(2189, 2192)
+            for y in range(2999, 3004)
+        }
+        assert grid.contains(bboxes, [12.5, 41.9])
+        assert not grid.contains(bboxes, [12.5, 42.1])
+        # too big for the grid
+        assert grid.covering_groups(grid.parse_bboxes([-180, -90, 180, 90])) is None
+        # crossing the antimeridian
+        bboxes = grid.parse_bboxes([[170, -10, -170, 10]])
+        assert bboxes == [(170, -10, 180, 10), (-180, -10, -170, 10)]
+        assert grid.contains(bboxes, [-175, 0])
+        assert not grid.contains(bboxes, [0, 0])
+        for invalid in ([], [1, 2, 3], [0, 91, 1, 92], [0, 0, "a", 1], "bbox"):
+            with pytest.raises(ValueError):
+                grid.parse_bboxes(invalid)
+
+    def test_common_group_shards(self):
+        assert grid.common_groups() == [grid.COMMON_GROUP]
+        assert grid.common_group("channel") == grid.COMMON_GROUP
+        with patch.object(app_settings, "DJANGO_LOCI_COMMON_GROUP_SHARDS", 4):
+            shards = grid.common_groups()
+            assert shards == [f"{grid.COMMON_GROUP}.{index}" for index in range(4)]
+            assert all(grid.is_common_group(shard) for shard in shards)
+            groups = {grid.common_group(f"channel.{index}") for index in range(100)}
+            assert groups == set(shards)
+            # a channel always joins the same shard
+            assert grid.common_group("channel") == grid.common_group("channel")
+            location = self.location_model(
+                name="test", geometry=Point(12.513124, 41.897903, srid=4326)
+            )
+            messages = get_location_messages(location)
+            assert [group for group, _ in messages[1:5]] == shards
+
+    @pytest.mark.django_db(transaction=True)
+    def test_broadcast_on_commit(self):
+        location = self._create_location(is_mobile=True)
+        location.geometry = Point(12.513124, 41.897903, srid=4326)
+        with patch.object(dispatcher, "submit") as submit:
+            with transaction.atomic():
+                location.save()
+                submit.assert_not_called()
+            submit.assert_called_once()
+            submit.reset_mock()
+            # rolled back updates are not broadcast
+            with pytest.raises(ValueError):
+                with transaction.atomic():
+                    location.geometry = Point(12.514124, 41.897903, srid=4326)
+                    location.save()
+                    raise ValueError()
+            submit.assert_not_called()
+
+    def test_dispatcher(self):
+        started, release = threading.Event(), threading.Event()
+        sent = []
+
+        class ChannelLayer:
+            async def group_send(self, group, message):
+                started.set()
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None, release.wait, 5)
+                sent.append(group)
+
+        test_dispatcher = BroadcastDispatcher(maxsize=1)
+        with patch("channels.layers.get_channel_layer", return_value=ChannelLayer()):
+            assert test_dispatcher.submit([("first", {})])
+            # wait for the worker to start sending the first broadcast
+            assert started.wait(timeout=5)
+            assert test_dispatcher.submit([("second", {})])
+            # the queue is full
+            assert not test_dispatcher.submit([("third", {})])
+            release.set()
+            test_dispatcher.join()
+        assert sent == ["first", "second"]
+        stats = test_dispatcher.get_stats()
+        assert stats == {
+            "queued": 2,
+            "sent": 2,
+            "coalesced": 0,
+            "batches": 0,
+            "dropped": 1,
+            "errors": 0,
+            "pending": 0,
+        }
+
+    def test_dispatcher_submit_many(self):
+        sent = []
+
+        class ChannelLayer:
+            async def group_send(self, group, message):
+                sent.append(group)
+
+        test_dispatcher = BroadcastDispatcher(maxsize=1)
+        with patch("channels.layers.get_channel_layer", return_value=ChannelLayer()):
+            assert test_dispatcher.submit_many(
+                [([("first", {})], "a", None), ([("second", {})], "b", None)]
+            )
+            test_dispatcher.join()
+        assert sorted(sent) == ["first", "second"]
+        stats = test_dispatcher.get_stats()
+        assert (stats["queued"], stats["sent"]) == (2, 2)
+
+    @patch.object(app_settings, "DJANGO_LOCI_BROADCAST_MIN_INTERVAL", 60)
+    def test_dispatcher_flush(self):
+        sent = []
+
+        class ChannelLayer:
+            async def group_send(self, group, message):
+                sent.append(group)
+
+        test_dispatcher = BroadcastDispatcher(maxsize=10)
+        # nothing to send yet
+        assert test_dispatcher.flush(timeout=5)
+        with patch("channels.layers.get_channel_layer", return_value=ChannelLayer()):
+            test_dispatcher.submit([("first", {})], key="a")
+            test_dispatcher.submit([("second", {})], key="a")
+            test_dispatcher.join()
+            # the second broadcast is held by the throttling
+            assert sent == ["first"]
+            assert test_dispatcher.flush(timeout=5)
+        assert sent == ["first", "second"]
+
+    @patch.object(app_settings, "DJANGO_LOCI_BROADCAST_MIN_INTERVAL", 60)
+    def test_dispatcher_stale(self):
+        sent = []
+
+        class ChannelLayer:
+            async def group_send(self, group, message):
+                sent.append(message["message"]["seq"])
+
+        def messages(seq):
+            return [("group", {"id": "a", "message": {"seq": seq}})]
+
+        test_dispatcher = BroadcastDispatcher(maxsize=10)
+        with patch("channels.layers.get_channel_layer", return_value=ChannelLayer()):
+            test_dispatcher.submit(messages(1), key="a")
+            test_dispatcher.submit(messages(2), key="a")
+            test_dispatcher.join()
+            assert cache.get("loci.sent_seq.a") == 1
+            # a newer update has been sent by another process
+            cache.set("loci.sent_seq.a", 3)
+            assert test_dispatcher.flush(timeout=5)
+        cache.delete("loci.sent_seq.a")
+        # the held update is older, it's not sent
+        assert sent == [1]
+
+    @pytest.mark.asyncio
+    async def test_outbox(self):
+        sent = []
+        release = asyncio.Event()
+
+        async def send(frame):
+            sent.append(frame)
+            await release.wait()
+
+        stats = get_outbox_stats()
+        outbox = Outbox(send, maxsize=2)
+        outbox.put("a", "a1")
+        # the writer is now blocked sending the first frame
+        await asyncio.sleep(0)
+        outbox.put("a", "a2")
+        outbox.put("a", "a3")
+        outbox.put("b", "b1")
+        outbox.put("c", "c1")
+        assert (outbox.coalesced, outbox.dropped) == (1, 1)
+        assert len(outbox) == 2
+        release.set()
+        for _ in range(5):
+            await asyncio.sleep(0)
+        assert sent == ["a1", "b1", "c1"]
+        assert len(outbox) == 0
+        outbox.put("a", "a4")
+        await asyncio.sleep(0)
+        assert sent[-1] == "a4"
+        assert get_outbox_stats() == {
+            "coalesced": stats["coalesced"] + 1,
+            "dropped": stats["dropped"] + 1,
+        }
+        outbox.close()
+
+    @pytest.mark.asyncio
+    async def test_outbox_common_location(self):
+        sent = []
+        release = asyncio.Event()
+
+        async def send(frame):
+            sent.append(frame["id"])
+            await release.wait()
+
+        consumer = AsyncCommonLocationBroadcast()
+        consumer._init_subscription()
+        consumer.outbox = Outbox(send, maxsize=10)
+        locations = [
+            self.location_model(name=name, geometry=Point(12.5, 41.9, srid=4326))
+            for name in ("first", "second", "third")
+        ]
+        for index, location in enumerate(locations):
+            _, common_message = get_location_messages(location)[1]
+            await consumer.send_message(common_message)
+            if index == 0:
+                # the writer is now blocked sending the first update
+                await asyncio.sleep(0)
+        # the updates of different locations are not coalesced
+        assert len(consumer.outbox) == 2
+        release.set()
+        for _ in range(5):
+            await asyncio.sleep(0)
+        assert sent == [str(location.pk) for location in locations]
+        consumer.outbox.close()
+
+    def test_throttle(self):
+        clock = [0]
+        throttle = BroadcastThrottle(
+            min_distance=10, min_interval=5, max_delay=30, clock=lambda: clock[0]
+        )
+        rome, moved = (12.4829, 41.8933), (12.4831, 41.8933)
+        assert 15 < distance(rome, moved) < 20
+        assert throttle.offer("a", rome, ["first"]) == ["first"]
+        # other locations are not affected
+        assert throttle.offer("b", rome, ["other"]) == ["other"]
+        clock[0] = 1
+        assert throttle.offer("a", moved, ["second"]) is None
+        clock[0] = 2
+        assert throttle.offer("a", rome, ["third"]) is None
+        assert throttle.coalesced == 1
+        # moved back to the last broadcast position, held until max_delay
+        assert throttle.next_flush_in() == 28
+        clock[0] = 6
+        assert throttle.pop_due() == []
+        assert throttle.offer("a", moved, ["fourth"]) == ["fourth"]
+        assert throttle.next_flush_in() is None
+        clock[0] = 7
+        assert throttle.offer("a", moved, ["fifth"]) is None
+        clock[0] = 37
+        # the latest position is always sent
+        assert throttle.pop_due() == [["fifth"]]
+        assert throttle.offer("a", moved, ["sixth"]) is None
+        assert throttle.pop_due(force=True) == [["sixth"]]
+        # disabled
+        throttle = BroadcastThrottle()
+        assert throttle.offer("a", rome, ["first"]) == ["first"]
+        assert throttle.offer("a", rome, ["second"]) == ["second"]
+
+    @pytest.mark.asyncio
+    @pytest.mark.django_db(transaction=True)
+    @grid_levels
+    async def test_common_location_bbox(self):
+        test_user = await database_sync_to_async(self._create_admin)()
+        location = await database_sync_to_async(self._create_location)(is_mobile=True)
+        await database_sync_to_async(self._create_object_location)(location=location)
+        request_vars = await self._get_common_location_request_dict(
+            pk=location.pk, user=test_user
+        )
+        communicator = self._get_common_location_communicator(request_vars, test_user)
+        connected, _ = await communicator.connect()
+        assert connected
+        bbox = [12.4, 41.8, 12.6, 42]
+        await communicator.send_json_to({"type": "subscribe", "bbox": bbox})
+        response = await communicator.receive_json_from()
+        assert response == {"type": "subscribed", "bbox": bbox}
+        await self._save_location(location.pk)
+        response = await communicator.receive_json_from()
+        assert response["id"] == str(location.pk)
+        # pan to another area
+        await communicator.send_json_to({"type": "subscribe", "bbox": [[0, 0, 1, 1]]})
+        await communicator.receive_json_from()
+        await self._save_location(location.pk, "POINT (12.513125 41.897903)")
+        assert await communicator.receive_nothing(timeout=0.5)
+        await communicator.send_json_to({"type": "subscribe", "bbox": [0, 0]})
+        response = await communicator.receive_json_from()
+        assert response == {"type": "error", "error": "bbox must contain 4 numbers"}
+        # receive all the updates again
+        await communicator.send_json_to({"type": "subscribe", "bbox": None})
+        await communicator.receive_json_from()
+        await self._save_location(location.pk, "POINT (12.513126 41.897903)")
+        response = await communicator.receive_json_from()
+        assert response["id"] == str(location.pk)
+        await communicator.disconnect()
+
+    @pytest.mark.asyncio
+    @pytest.mark.django_db(transaction=True)
+    async def test_common_location_bbox_disabled(self):
+        test_user = await database_sync_to_async(self._create_admin)()
+        request_vars = await self._get_common_location_request_dict(user=test_user)
+        communicator = self._get_common_location_communicator(request_vars, test_user)
+        connected, _ = await communicator.connect()
+        assert connected
+        await communicator.send_json_to(
+            {"type": "subscribe", "bbox": [12.4, 41.8, 12.6, 42]}
+        )
+        response = await communicator.receive_json_from()
+        assert response == {"type": "error", "error": "bbox subscriptions are disabled"}
+        await communicator.disconnect()
+
+    async def _get_multi_location_communicator(self, user=None):
+        request_vars = await self._get_location_request_dict(
+            path="/ws/loci/locations/", user=user
+        )
+        return self._get_location_communicator(
+            self.multi_location_consumer, request_vars, user
+        )
+
+    @pytest.mark.asyncio
+    @pytest.mark.django_db(transaction=True)
+    async def test_multi_location_unauthenticated(self):
+        communicator = await self._get_multi_location_communicator()
+        connected, _ = await communicator.connect()
+        assert not connected
+
+    @pytest.mark.asyncio
+    @pytest.mark.django_db(transaction=True)
+    async def test_multi_location_update(self):
+        test_user = await database_sync_to_async(self._create_admin)()
+        location1 = await database_sync_to_async(self._create_location)(is_mobile=True)
+        location2 = await database_sync_to_async(self._create_location)(is_mobile=True)
+        missing = str(self.location_model().pk)
+        communicator = await self._get_multi_location_communicator(test_user)
+        connected, _ = await communicator.connect()
+        assert connected
+        pks = [str(location1.pk), str(location2.pk), missing]
+        await communicator.send_json_to({"type": "subscribe", "locations": pks})
+        response = await communicator.receive_json_from()
+        assert response == {
+            "type": "subscribed",
+            "locations": sorted(pks[:2]),
+            "denied": [missing],
+        }
+        await self._save_location(location2.pk)
+        response = await communicator.receive_json_from()
+        assert isinstance(response.pop("seq"), int)
+        assert response == {
+            "id": str(location2.pk),
+            "geometry": {"type": "Point", "coordinates": [12.513124, 41.897903]},
+            "address": "Via del Corso, Roma, Italia",
+        }
+        await communicator.send_json_to(
+            {"type": "unsubscribe", "locations": [str(location2.pk)]}
+        )
+        response = await communicator.receive_json_from()
+        assert response == {"type": "unsubscribed", "locations": [str(location2.pk)]}
+        await self._save_location(location2.pk, "POINT (12.513125 41.897903)")
+        assert await communicator.receive_nothing(timeout=0.5)
+        await self._save_location(location1.pk)
+        response = await communicator.receive_json_from()
+        assert response["id"] == str(location1.pk)
+        await communicator.send_json_to({"type": "subscribe", "locations": ["a"]})
+        response = await communicator.receive_json_from()
+        assert response == {
+            "type": "error",
+            "error": "locations must contain valid UUIDs",
+        }
+        await communicator.disconnect()
+
+    @pytest.mark.django_db(transaction=True)
+    def test_websocket_token(self):
+        user = self._create_admin()
+        location = self._create_location(is_mobile=True)
+        assert make_token(user) == ""
+        with patch.object(app_settings, "DJANGO_LOCI_WEBSOCKET_TOKEN_MAX_AGE", 60):
+            token = make_token(user, [location.pk])
+            token_user = read_token(token)
+            assert isinstance(token_user, TokenUser)
+            assert token_user.pk == str(user.pk)
+            assert token_user.get_username() == user.get_username()
+            assert token_user.is_authenticated and token_user.is_superuser
+            assert token_user.has_perms(["django_loci.view_location"])
+            assert token_user.has_location(location.pk)
+            assert not token_user.has_location(self.location_model().pk)
+            assert not read_token(make_token(user)).has_location(location.pk)
+            assert read_token(f"{token}x") is None
+            assert read_token("") is None
+        # tokens are not accepted when disabled
+        assert read_token(token) is None
+
+    @pytest.mark.django_db(transaction=True)
+    def test_token_get_location(self):
+        user = self._create_admin()
+        location = self._create_location(is_mobile=True)
+        with patch.object(app_settings, "DJANGO_LOCI_WEBSOCKET_TOKEN_MAX_AGE", 60):
+            token_user = read_token(make_token(user, [location.pk]))
+        lookup_path = "django_loci.channels.base._get_object_or_none"
+        with patch(lookup_path) as lookup:
+            self.location_consumer().get_location(token_user, location.pk)
+        lookup.assert_not_called()
+
+        class MobileLocationBroadcast(self.location_consumer):
+            def is_authorized(self, user, location):
+                return location.is_mobile
+
+        # overrides of is_authorized get the stored location
+        consumer = MobileLocationBroadcast()
+        found = consumer.get_location(token_user, location.pk)
+        assert found == location
+        assert consumer.is_authorized(token_user, found)
+
+    @pytest.mark.asyncio
+    @pytest.mark.django_db(transaction=True)
+    async def test_consumer_token(self):
+        test_user = await database_sync_to_async(self._create_admin)()
+        location = await database_sync_to_async(self._create_location)(is_mobile=True)
+        application = TokenAuthMiddleware(
+            URLRouter([path(location_broadcast_path, self.location_consumer.as_asgi())])
+        )
+        with patch.object(app_settings, "DJANGO_LOCI_WEBSOCKET_TOKEN_MAX_AGE", 60):
+            token = await database_sync_to_async(make_token)(test_user, [location.pk])
+            with patch("django_loci.channels.base._get_object_or_none") as lookup:
+                communicator = WebsocketCommunicator(
+                    application, f"/ws/loci/location/{location.pk}/?token={token}"
+                )
+                connected, _ = await communicator.connect()
+                assert connected
+                lookup.assert_not_called()
+            await self._save_location(location.pk)
+            response = await communicator.receive_json_from()
+            assert response["address"] == "Via del Corso, Roma, Italia"
+            await communicator.disconnect()
+            # invalid tokens fall back to the session
+            communicator = WebsocketCommunicator(
+                application, f"/ws/loci/location/{location.pk}/?token={token}x"
+            )
+            connected, _ = await communicator.connect()
+            assert not connected
+
     def test_routing(self):
         from django_loci.channels.asgi import channel_routing
 
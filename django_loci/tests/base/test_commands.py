@@ -0,0 +1,92 @@
+import json
+import os
+import tempfile
+from io import StringIO
+from unittest.mock import Mock, patch
+
+from django.core.cache import cache
+from django.core.management import call_command
+
+from ... import settings as app_settings
+from .. import TestLociMixin
+
+
+def fake_geocode(address, **kwargs):
+    if address == "unknown":
+        return None
+    return Mock(latitude=41.9, longitude=12.5)
+
+
+def fake_reverse_geocode(query, **kwargs):
+    return [Mock(address="Via del Corso, Roma, Italia")]
+
+
+class BaseTestCommands(TestLociMixin):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    def _create_locations(self, addresses):
+        return [
+            self._create_location(
+                name=address, address=address, geometry=None, is_mobile=True
+            )
+            for address in addresses
+        ]
+
+    def _call_command(self, *args, **kwargs):
+        out = StringIO()
+        kwargs.setdefault("rate", 0)
+        call_command("loci_geocode", *args, stdout=out, **kwargs)
+        return out.getvalue()
+
+    @patch("django_loci.base.geocoding_views.geocode", side_effect=fake_geocode)
+    def test_geocode(self, geocode):
+        self._create_locations(["Rome", "Rome", "unknown", "Milan"])
+        output = self._call_command(batch_size=2, workers=2)
+        self.assertIn("Updated 3 of 4 locations", output)
+        queryset = self.location_model.objects.filter(geometry__isnull=False)
+        self.assertEqual(queryset.count(), 3)
+        self.assertEqual(queryset.first().geometry.coords, (12.5, 41.9))
+        # repeated addresses are geocoded only once
+        self.assertEqual(geocode.call_count, 3)
+        # locations which already have a geometry are not processed
+        output = self._call_command()
+        self.assertIn("Updated 0 of 1 locations", output)
+
+    @patch(
+        "django_loci.base.geocoding_views.reverse_geocode",
+        side_effect=fake_reverse_geocode,
+    )
+    def test_reverse_geocode(self, reverse_geocode):
+        self._create_location(address="")
+        self._create_location(address="Piazza Venezia, Roma")
+        output = self._call_command(reverse=True)
+        self.assertIn("Updated 1 of 1 locations", output)
+        self.assertEqual(
+            self.location_model.objects.filter(
+                address="Via del Corso, Roma, Italia"
+            ).count(),
+            1,
+        )
+        reverse_geocode.assert_called_once_with(
+            (41.898903, 12.512124), retries=app_settings.DJANGO_LOCI_GEOCODE_RETRIES
+        )
+
+    @patch("django_loci.base.geocoding_views.geocode", side_effect=fake_geocode)
+    def test_checkpoint(self, geocode):
+        locations = self._create_locations(["Rome", "Milan", "Turin"])
+        locations.sort(key=lambda location: str(location.pk))
+        checkpoint = os.path.join(tempfile.mkdtemp(), "checkpoint.json")
+        self._call_command(limit=1, checkpoint=checkpoint)
+        with open(checkpoint) as file:
+            data = json.load(file)
+        self.assertEqual(data, {"mode": "geocode", "last_pk": str(locations[0].pk)})
+        output = self._call_command(checkpoint=checkpoint)
+        self.assertIn(f"Resuming after location {locations[0].pk}", output)
+        self.assertIn("Updated 2 of 2 locations", output)
+        self.assertFalse(
+            self.location_model.objects.filter(geometry__isnull=True).exists()
+        )
+        # checkpoint is removed once all the locations have been processed
+        self.assertFalse(os.path.exists(checkpoint))
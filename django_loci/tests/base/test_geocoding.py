@@ -0,0 +1,400 @@
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+from io import StringIO
+from unittest.mock import Mock, patch
+
+from asgiref.sync import async_to_sync
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import RequestFactory
+from geopy.exc import GeocoderTimedOut
+
+from ... import settings as app_settings
+from ...base import geocoding_cache, geocoding_metrics, geocoding_views
+from ...base.circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+from ...base.rate_limit import RateLimitExceeded, TokenBucket
+from ...gazetteer import Gazetteer, GazetteerIndex
+from .. import TestLociMixin
+
+
+class BaseTestGeocoding(TestLociMixin):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    def _run_threads(self, target, count=5):
+        threads = [threading.Thread(target=target) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def test_single_flight(self):
+        single_flight = geocoding_cache.SingleFlight()
+        release = threading.Event()
+        results = []
+
+        def lookup():
+            release.wait(timeout=5)
+            return {"lat": 1, "lng": 2}
+
+        lookup = Mock(side_effect=lookup)
+        threads = self._run_threads(
+            lambda: results.append(single_flight.do("key", lookup))
+        )
+        # give time to the other threads to wait on the first lookup
+        time.sleep(0.2)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(lookup.call_count, 1)
+        self.assertEqual(results, [{"lat": 1, "lng": 2}] * 5)
+        # once completed, the key can be looked up again
+        single_flight.do("key", lookup)
+        self.assertEqual(lookup.call_count, 2)
+
+    def test_single_flight_error(self):
+        single_flight = geocoding_cache.SingleFlight()
+        release = threading.Event()
+        errors = []
+
+        def lookup():
+            release.wait(timeout=5)
+            raise ValueError("failure")
+
+        def target():
+            try:
+                single_flight.do("key", lookup)
+            except ValueError as error:
+                errors.append(error)
+
+        threads = self._run_threads(target, count=3)
+        time.sleep(0.2)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(errors), 3)
+
+    def test_async_single_flight(self):
+        single_flight = geocoding_cache.AsyncSingleFlight()
+        calls = []
+
+        async def lookup():
+            calls.append(1)
+            await asyncio.sleep(0.1)
+            return {"address": "Red Square"}
+
+        async def run():
+            return await asyncio.gather(
+                *[single_flight.do("key", lookup) for _ in range(5)]
+            )
+
+        results = async_to_sync(run)()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{"address": "Red Square"}] * 5)
+
+    @patch.dict("sys.modules", {"aiohttp": Mock()})
+    @patch("django_loci.base.geocoding_views._build_geolocator")
+    def test_async_geolocator_per_loop(self, build_geolocator):
+        build_geolocator.side_effect = lambda **kwargs: Mock()
+
+        async def get_geolocators():
+            return (
+                geocoding_views.get_async_geolocator(),
+                geocoding_views.get_async_geolocator(),
+            )
+
+        first, second = asyncio.run(get_geolocators())
+        # reused by the requests served by the same event loop
+        self.assertIs(first, second)
+        other, _ = asyncio.run(get_geolocators())
+        self.assertIsNot(other, first)
+        self.assertEqual(build_geolocator.call_count, 2)
+
+    @patch("django_loci.base.geocoding_views.geocode")
+    def test_cached_geocode_coalescing(self, geocode):
+        release = threading.Event()
+
+        def slow_geocode(address):
+            release.wait(timeout=5)
+            return Mock(latitude=55.75, longitude=37.62)
+
+        geocode.side_effect = slow_geocode
+        threads = self._run_threads(
+            lambda: geocoding_views.cached_geocode("Red Square")
+        )
+        time.sleep(0.2)
+        release.set()
+        for thread in threads:
+            thread.join()
+        geocode.assert_called_once_with("Red Square", retries=0)
+
+    @patch.object(app_settings, "DJANGO_LOCI_GEOCODE_CACHE_LOCK_TIMEOUT", 2)
+    def test_cache_lock(self):
+        key = geocoding_cache.geocode_key("Red Square")
+        # simulate another worker holding the lock
+        self.assertTrue(geocoding_cache.acquire_lock(key))
+        self.assertFalse(geocoding_cache.acquire_lock(key))
+        threading.Timer(
+            0.2, lambda: geocoding_cache.set_cached(key, {"lat": 1, "lng": 2})
+        ).start()
+        lookup = Mock(return_value={"lat": 3, "lng": 4})
+        result = geocoding_views._locked_lookup(key, lookup)
+        self.assertEqual(result, {"lat": 1, "lng": 2})
+        lookup.assert_not_called()
+        geocoding_cache.release_lock(key)
+        self.assertTrue(geocoding_cache.acquire_lock(key))
+        geocoding_cache.release_lock(key)
+
+    @patch.object(app_settings, "DJANGO_LOCI_GEOCODE_CACHE_LOCK_TIMEOUT", 0.3)
+    def test_cache_lock_timeout(self):
+        key = geocoding_cache.geocode_key("Red Square")
+        geocoding_cache.acquire_lock(key)
+        lookup = Mock(return_value={"lat": 3, "lng": 4})
+        # the lookup is performed anyway if the lock is not released in time
+        result = geocoding_views._locked_lookup(key, lookup)
+        self.assertEqual(result, {"lat": 3, "lng": 4})
+        lookup.assert_called_once()
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(cache, "test.bucket", rate=1, burst=2)
+        bucket.consume()
+        bucket.consume()
+        with self.assertRaises(RateLimitExceeded) as context:
+            bucket.consume()
+        self.assertGreater(context.exception.retry_after, 0)
+        self.assertLessEqual(context.exception.retry_after, 1)
+        # the bucket is shared by instances using the same key
+        with self.assertRaises(RateLimitExceeded):
+            TokenBucket(cache, "test.bucket", rate=1, burst=2).consume()
+        TokenBucket(cache, "test.other-bucket", rate=1, burst=2).consume()
+
+    def test_token_bucket_refill(self):
+        bucket = TokenBucket(cache, "test.bucket", rate=20, burst=1)
+        bucket.consume()
+        with self.assertRaises(RateLimitExceeded):
+            bucket.consume()
+        time.sleep(0.1)
+        bucket.consume()
+
+    def test_token_bucket_locked(self):
+        bucket = TokenBucket(cache, "test.bucket", rate=1, burst=5)
+        # simulate another process holding the lock
+        cache.add("test.bucket.lock", 1)
+        with self.assertRaises(RateLimitExceeded):
+            bucket.consume()
+
+    @patch.object(app_settings, "DJANGO_LOCI_GEOCODE_RATE_LIMIT", 1)
+    @patch.object(app_settings, "DJANGO_LOCI_GEOCODE_RATE_LIMIT_BURST", 1)
+    @patch("django_loci.base.geocoding_views._get_rate_limiter")
+    def test_geocode_view_rate_limited(self, get_rate_limiter):
+        get_rate_limiter.return_value = Mock(
+            return_value=Mock(latitude=55.75, longitude=37.62)
+        )
+        factory = RequestFactory()
+        response = geocoding_views.geocode_view(
+            factory.get("/", {"address": "Red Square"})
+        )
+        self.assertEqual(response.status_code, 200)
+        # cached results do not consume the rate limit
+        response = geocoding_views.geocode_view(
+            factory.get("/", {"address": "Red Square"})
+        )
+        self.assertEqual(response.status_code, 200)
+        response = geocoding_views.geocode_view(
+            factory.get("/", {"address": "Piazza Venezia"})
+        )
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response["Retry-After"], "1")
+        response = geocoding_views.reverse_geocode_view(
+            factory.get("/", {"lat": "52", "lng": "21"})
+        )
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(get_rate_limiter.return_value.call_count, 1)
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker(cache, "test.breaker", threshold=2, reset_timeout=60)
+        self.assertEqual(breaker.state, CLOSED)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, OPEN)
+        self.assertEqual(breaker.failures, 2)
+        self.assertFalse(breaker.allow())
+        with patch("time.time", return_value=time.time() + 61):
+            self.assertEqual(breaker.state, HALF_OPEN)
+            # only one probe is let through
+            self.assertTrue(breaker.allow())
+            self.assertFalse(breaker.allow())
+            breaker.record_failure()
+            self.assertFalse(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, CLOSED)
+        self.assertEqual(breaker.failures, 0)
+
+    @patch.object(app_settings, "DJANGO_LOCI_GEOCODE_BREAKER_THRESHOLD", 2)
+    @patch("django_loci.base.geocoding_views._get_rate_limiter")
+    def test_geocode_view_circuit_breaker(self, get_rate_limiter):
+        get_rate_limiter.return_value = Mock(side_effect=GeocoderTimedOut())
+        factory = RequestFactory()
+        for _ in range(2):
+            response = geocoding_views.geocode_view(
+                factory.get("/", {"address": "Red Square"})
+            )
+            # failures are not cached
+            self.assertEqual(response.status_code, 503)
+        self.assertEqual(get_rate_limiter.return_value.call_count, 2)
+        # requests are not retried
+        get_rate_limiter.assert_called_with("geocode", 0)
+        self.assertEqual(geocoding_views.get_circuit_breaker().state, OPEN)
+        response = geocoding_views.reverse_geocode_view(
+            factory.get("/", {"lat": "52", "lng": "21"})
+        )
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], "60")
+        # the geocoding service is not queried while the breaker is open
+        self.assertEqual(get_rate_limiter.return_value.call_count, 2)
+        self.assertFalse(geocoding_views.check_geocoding())
+        metrics = geocoding_metrics.get_metrics(geocoding_views.get_circuit_breaker())
+        self.assertEqual(metrics["geocode"]["requests"], 2)
+        self.assertEqual(metrics["geocode"]["errors"], 2)
+        self.assertEqual(metrics["reverse_geocode"]["rejected"], 1)
+        self.assertEqual(metrics["circuit_breaker"]["state"], OPEN)
+
+    @patch.object(app_settings, "DJANGO_LOCI_GEOCODE_BREAKER_THRESHOLD", 1)
+    @patch("django_loci.base.geocoding_views._get_rate_limiter")
+    def test_circuit_breaker_probe_rate_limited(self, get_rate_limiter):
+        get_rate_limiter.return_value = Mock(side_effect=GeocoderTimedOut())
+        with self.assertRaises(geocoding_views.GeocodingUnavailable):
+            geocoding_views.geocode("Red Square")
+        breaker = geocoding_views.get_circuit_breaker()
+        self.assertEqual(breaker.state, OPEN)
+        get_rate_limiter.return_value = Mock(return_value=None)
+        with patch("time.time", return_value=time.time() + 61):
+            self.assertEqual(breaker.state, HALF_OPEN)
+            # rate limited calls do not take the half-open probe
+            with patch(
+                "django_loci.base.geocoding_views.consume_rate_limit",
+                side_effect=RateLimitExceeded(1),
+            ), self.assertRaises(RateLimitExceeded):
+                geocoding_views.geocode("Red Square")
+            geocoding_views.geocode("Red Square")
+        self.assertEqual(breaker.state, CLOSED)
+
+    @patch.object(app_settings, "DJANGO_LOCI_GEOCODE_BREAKER_THRESHOLD", 0)
+    @patch("django_loci.base.geocoding_views._get_rate_limiter")
+    def test_circuit_breaker_disabled(self, get_rate_limiter):
+        get_rate_limiter.return_value = Mock(side_effect=GeocoderTimedOut())
+        self.assertIsNone(geocoding_views.get_circuit_breaker())
+        for _ in range(10):
+            with self.assertRaises(geocoding_views.GeocodingUnavailable):
+                geocoding_views.geocode("Red Square")
+        self.assertEqual(get_rate_limiter.return_value.call_count, 10)
+
+    @patch("django_loci.base.geocoding_views._get_rate_limiter")
+    def test_metrics_view(self, get_rate_limiter):
+        get_rate_limiter.return_value = Mock(
+            return_value=Mock(latitude=55.75, longitude=37.62)
+        )
+        factory = RequestFactory()
+        for _ in range(2):
+            geocoding_views.geocode_view(factory.get("/", {"address": "Red Square"}))
+        response = geocoding_views.metrics_view(factory.get("/"))
+        metrics = json.loads(response.content)
+        self.assertEqual(metrics["geocode"]["requests"], 1)
+        self.assertEqual(metrics["geocode"]["errors"], 0)
+        self.assertEqual(metrics["geocode"]["cache_hits"], 1)
+        self.assertEqual(metrics["geocode"]["cache_misses"], 1)
+        self.assertEqual(metrics["geocode"]["latency"]["count"], 1)
+        self.assertEqual(metrics["geocode"]["latency"]["buckets"]["+Inf"], 1)
+        self.assertEqual(metrics["reverse_geocode"]["requests"], 0)
+        self.assertEqual(metrics["circuit_breaker"]["state"], CLOSED)
+        response = geocoding_views.metrics_view(
+            factory.get("/", {"format": "prometheus"})
+        )
+        self.assertTrue(response["Content-Type"].startswith("text/plain"))
+        content = response.content.decode()
+        self.assertIn('django_loci_geocoding_requests_total{kind="geocode"} 1', content)
+        self.assertIn(
+            'django_loci_geocoding_latency_seconds_bucket{kind="geocode",le="+Inf"} 1',
+            content,
+        )
+        self.assertIn("django_loci_geocoding_circuit_breaker_open 0", content)
+
+    _gazetteer_csv = (
+        "name,lat,lng,label\n"
+        'Rome,41.8933,12.4829,"Rome, IT"\n'
+        'Milan,45.4643,9.1895,"Milan, IT"\n'
+        'Warsaw,52.2298,21.0118,"Warsaw, PL"\n'
+        'Sydney,-33.8679,151.2073,"Sydney, AU"\n'
+        'Anchorage,61.2181,-149.9003,"Anchorage, US"\n'
+    )
+
+    def _build_gazetteer(self, **kwargs):
+        directory = tempfile.mkdtemp()
+        source = os.path.join(directory, "places.csv")
+        with open(source, "w") as file:
+            file.write(self._gazetteer_csv)
+        output = os.path.join(directory, "places.bin")
+        out = StringIO()
+        call_command(
+            "loci_build_gazetteer", source, output, format="csv", stdout=out, **kwargs
+        )
+        return output, out.getvalue()
+
+    def test_build_gazetteer(self):
+        path, output = self._build_gazetteer(benchmark=10)
+        self.assertIn("Stored 5 places", output)
+        self.assertIn("gazetteer: 10 reverse lookups", output)
+        index = GazetteerIndex(path)
+        self.assertEqual(index.count, 5)
+        place = index.nearest(52.2, 21.0)
+        self.assertEqual(place["label"], "Warsaw, PL")
+        self.assertLess(place["distance"], 5)
+        # nearest point across the antimeridian
+        self.assertEqual(index.nearest(60, 179)["label"], "Anchorage, US")
+        self.assertEqual(index.search(" MILAN")["label"], "Milan, IT")
+        self.assertIsNone(index.search("Turin"))
+
+    def test_gazetteer_geocoder(self):
+        path, _ = self._build_gazetteer()
+        geolocator = Gazetteer(path=path)
+        location = geolocator.reverse((41.9, 12.5))
+        self.assertEqual(location.address, "Rome, IT")
+        self.assertEqual(location.latitude, 41.8933)
+        self.assertEqual(geolocator.reverse("45.46, 9.19").address, "Milan, IT")
+        # places farther than DJANGO_LOCI_GAZETTEER_MAX_DISTANCE are ignored
+        self.assertIsNone(geolocator.reverse((0, 0)))
+        self.assertEqual(geolocator.geocode("rome").address, "Rome, IT")
+        self.assertIsNone(geolocator.geocode("Turin"))
+
+    @patch.object(app_settings, "DJANGO_LOCI_GEOCODE_RATE_LIMIT", 1)
+    @patch.object(app_settings, "DJANGO_LOCI_GEOCODE_RATE_LIMIT_BURST", 1)
+    def test_gazetteer_geocoder_views(self):
+        path, _ = self._build_gazetteer()
+        geocoding_views.get_geolocator.cache_clear()
+        geocoding_views._get_rate_limiter.cache_clear()
+        self.addCleanup(geocoding_views.get_geolocator.cache_clear)
+        self.addCleanup(geocoding_views._get_rate_limiter.cache_clear)
+        with patch.object(
+            app_settings, "DJANGO_LOCI_GEOCODER", "django_loci.gazetteer.Gazetteer"
+        ), patch.object(app_settings, "DJANGO_LOCI_GAZETTEER_PATH", path):
+            response = geocoding_views.reverse_geocode_view(
+                RequestFactory().get("/", {"lat": "-33.87", "lng": "151.2"})
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(json.loads(response.content), {"address": "Sydney, AU"})
+            # local lookups do not consume the rate limit
+            response = geocoding_views.reverse_geocode_view(
+                RequestFactory().get("/", {"lat": "41.9", "lng": "12.5"})
+            )
+            self.assertEqual(json.loads(response.content), {"address": "Rome, IT"})
+            response = geocoding_views.geocode_view(
+                RequestFactory().get("/", {"address": "Warsaw"})
+            )
+            self.assertEqual(
+                json.loads(response.content), {"lat": 52.2298, "lng": 21.0118}
+            )
@@ -0,0 +1,234 @@
+from datetime import timedelta
+from io import StringIO
+from unittest.mock import patch
+
+from django.contrib.gis.geos import Point
+from django.core.management import call_command
+from django.db.models.signals import post_save
+from django.utils.timezone import now
+
+from ... import settings as app_settings
+from ...base import history, trajectory
+from ...signals import locations_moved
+from .. import TestLociMixin
+
+
+class BaseTestHistory(TestLociMixin):
+    def _create_position(self, location, timestamp, lng=12.5):
+        return self.position_model.objects.create(
+            location=location, timestamp=timestamp, geometry=Point(lng, 41.9)
+        )
+
+    def test_recorder(self):
+        location = self._create_location(is_mobile=True)
+        recorder = history.PositionRecorder(self.position_model, batch_size=3)
+        with patch.object(recorder, "_ensure_started") as ensure_started:
+            recorder.add(location.pk, location.modified, location.geometry)
+            recorder.add(location.pk, now(), Point(12.6, 41.9, srid=4326))
+        ensure_started.assert_called()
+        self.assertEqual(self.position_model.objects.count(), 0)
+        self.assertEqual(recorder.flush(), 2)
+        self.assertEqual(recorder.flush(), 0)
+        positions = self.position_model.objects.order_by("timestamp")
+        self.assertEqual(positions.count(), 2)
+        self.assertEqual(positions.first().geometry.coords, (12.512124, 41.898903))
+        self.assertEqual(positions.first().timestamp, location.modified)
+
+    @patch.object(app_settings, "DJANGO_LOCI_POSITION_HISTORY", True)
+    @patch.object(app_settings, "DJANGO_LOCI_POSITION_HISTORY_BATCH_SIZE", 1)
+    def test_record_on_save(self):
+        with patch("atexit.register") as register:
+            history.load_history_receivers(self.location_model, self.position_model)
+        register.assert_called_once_with(history.get_recorder().flush)
+        self.addCleanup(setattr, history, "recorder", None)
+        self.addCleanup(
+            post_save.disconnect,
+            sender=self.location_model,
+            dispatch_uid="loci_record_position",
+        )
+        self.addCleanup(
+            locations_moved.disconnect,
+            sender=self.location_model,
+            dispatch_uid="loci_record_positions",
+        )
+        self.assertIsNotNone(history.get_recorder())
+        with self.captureOnCommitCallbacks(execute=True):
+            location = self._create_location(is_mobile=True)
+            self._create_location(is_mobile=False)
+        with self.captureOnCommitCallbacks(execute=True):
+            location.geometry = Point(12.6, 41.9, srid=4326)
+            location.save()
+        positions = self.position_model.objects.filter(location=location)
+        self.assertEqual(
+            [p.geometry.x for p in positions.order_by("timestamp")], [12.512124, 12.6]
+        )
+        self.assertEqual(self.position_model.objects.count(), 2)
+
+    def test_history_disabled(self):
+        history.load_history_receivers(self.location_model, self.position_model)
+        self.assertIsNone(history.get_recorder())
+
+    def test_prune(self):
+        location = self._create_location(is_mobile=True)
+        self._create_position(location, now() - timedelta(days=31))
+        recent = self._create_position(location, now() - timedelta(days=29))
+        self._create_position(location, now() - timedelta(days=32))
+        with patch.object(history, "DELETE_BATCH_SIZE", 1):
+            self.assertEqual(history.prune(self.position_model, 30), 2)
+        self.assertEqual(list(self.position_model.objects.all()), [recent])
+
+    def test_downsample(self):
+        location = self._create_location(is_mobile=True)
+        other = self._create_location(is_mobile=True)
+        start = (now() - timedelta(days=2)).replace(second=0, microsecond=0)
+        for seconds in (0, 20, 40, 60):
+            self._create_position(location, start + timedelta(seconds=seconds))
+        self._create_position(other, start)
+        recent = now() - timedelta(hours=1)
+        self._create_position(location, recent)
+        self._create_position(location, recent + timedelta(seconds=1))
+        self.assertEqual(history.downsample(self.position_model, 1, 60), 2)
+        timestamps = self.position_model.objects.filter(location=location).order_by(
+            "timestamp"
+        )
+        self.assertEqual(
+            [position.timestamp for position in timestamps],
+            [
+                start + timedelta(seconds=40),
+                start + timedelta(seconds=60),
+                recent,
+                recent + timedelta(seconds=1),
+            ],
+        )
+        self.assertEqual(self.position_model.objects.filter(location=other).count(), 1)
+
+    def test_downsample_window(self):
+        location = self._create_location(is_mobile=True)
+        start = (now() - timedelta(days=5)).replace(second=0, microsecond=0)
+        for seconds in (0, 20):
+            self._create_position(location, start + timedelta(seconds=seconds))
+        # older than the window (expected to be thinned by a previous run)
+        self.assertEqual(history.downsample(self.position_model, 1, 60, 2), 0)
+        self.assertEqual(history.downsample(self.position_model, 1, 60, 5), 1)
+
+    def test_prune_command(self):
+        location = self._create_location(is_mobile=True)
+        self._create_position(location, now() - timedelta(days=31))
+        start = (now() - timedelta(days=2)).replace(second=0, microsecond=0)
+        self._create_position(location, start)
+        self._create_position(location, start + timedelta(seconds=1))
+        out = StringIO()
+        call_command("loci_prune_positions", stdout=out)
+        self.assertIn("Deleted 1 expired positions and 1 downsampled", out.getvalue())
+        self.assertEqual(self.position_model.objects.count(), 1)
+
+    def _create_trace(self, location, start):
+        # moves east for 200 seconds, stops for 300 seconds, moves north
+        positions = [(i * 10, 12.5 + i * 0.0005, 41.9) for i in range(21)]
+        positions += [(200 + i * 10, 12.51, 41.9) for i in range(1, 31)]
+        positions += [(500 + i * 10, 12.51, 41.9 + i * 0.0005) for i in range(1, 21)]
+        for seconds, lng, lat in positions:
+            self.position_model.objects.create(
+                location=location,
+                timestamp=start + timedelta(seconds=seconds),
+                geometry=Point(lng, lat),
+            )
+        return positions
+
+    def test_simplify(self):
+        line = [(i, 12.5 + i * 0.001, 41.9) for i in range(10)]
+        self.assertEqual(trajectory.simplify(line, 10), [0, 9])
+        # a detour of about 110 meters
+        line[5] = (5, line[5][1], 41.901)
+        self.assertEqual(trajectory.simplify(line, 10), [0, 4, 5, 6, 9])
+        self.assertEqual(trajectory.simplify(line, 200), [0, 9])
+        # same shape, different speed
+        line = [(0, 12.5, 41.9), (9, 12.501, 41.9), (10, 12.502, 41.9)]
+        self.assertEqual(trajectory.simplify(line, 10), [0, 1, 2])
+
+    def test_split_stops(self):
+        points = [(i * 10, 12.5 + i * 0.001, 41.9) for i in range(5)]
+        points += [(40 + i * 10, 12.504, 41.9) for i in range(1, 20)]
+        runs = list(trajectory.split_stops(points, 25, 120))
+        self.assertEqual([is_stop for is_stop, _ in runs], [False, True])
+        self.assertEqual(runs[0][1][-1], runs[1][1][0])
+        self.assertEqual(runs[1][1][-1], points[-1])
+        # too short to be a stop
+        runs = list(trajectory.split_stops(points[:8], 25, 120))
+        self.assertEqual(runs, [(False, points[:8])])
+
+    def test_compress(self):
+        location = self._create_location(is_mobile=True)
+        start = (now() - timedelta(days=1)).replace(microsecond=0)
+        positions = self._create_trace(location, start)
+        compressed, created = trajectory.compress(
+            self.position_model, self.trace_segment_model, now()
+        )
+        self.assertEqual((compressed, created), (len(positions), 3))
+        self.assertEqual(self.position_model.objects.count(), 0)
+        segments = self.trace_segment_model.objects.order_by("start")
+        self.assertEqual(
+            [segment.is_stop for segment in segments], [False, True, False]
+        )
+        stop = segments[1]
+        self.assertAlmostEqual(stop.geometry.x, 12.51)
+        self.assertAlmostEqual(stop.geometry.y, 41.9)
+        self.assertEqual(stop.end, start + timedelta(seconds=500))
+        trace = trajectory.get_trace(
+            self.trace_segment_model, location.pk, start, start + timedelta(hours=1)
+        )
+        self.assertLess(len(trace), len(positions) / 10)
+        self.assertEqual(trace[0][0], start)
+        self.assertEqual(trace[-1][0], start + timedelta(seconds=700))
+        self.assertAlmostEqual(trace[-1][1].y, 41.91)
+        # positions which have not been compressed yet are included
+        latest = self.position_model.objects.create(
+            location=location, timestamp=now(), geometry=Point(12.6, 41.9)
+        )
+        trace = trajectory.get_trace(
+            self.trace_segment_model,
+            location.pk,
+            start + timedelta(seconds=300),
+            now(),
+            position_model=self.position_model,
+        )
+        # the end of the stop is the first point in the time window
+        self.assertEqual(trace[0][0], start + timedelta(seconds=500))
+        self.assertEqual(trace[-1][0], latest.timestamp)
+        self.assertEqual(trace[-1][1].coords, (12.6, 41.9))
+
+    def test_compress_runs(self):
+        location = self._create_location(is_mobile=True)
+        start = (now() - timedelta(days=1)).replace(microsecond=0)
+        positions = self._create_trace(location, start)
+        # the first run ends during the stop
+        first = trajectory.compress(
+            self.position_model,
+            self.trace_segment_model,
+            start + timedelta(seconds=345),
+        )
+        second = trajectory.compress(
+            self.position_model, self.trace_segment_model, now()
+        )
+        self.assertEqual(first, (35, 2))
+        self.assertEqual(second, (len(positions) - 35, 2))
+        segments = list(self.trace_segment_model.objects.order_by("start"))
+        # the segments of the second run start where the first run stopped
+        self.assertEqual(segments[2].start, segments[1].end)
+        self.assertEqual(segments[1].end, start + timedelta(seconds=340))
+        trace = trajectory.get_trace(
+            self.trace_segment_model, location.pk, start, start + timedelta(hours=1)
+        )
+        timestamps = [timestamp for timestamp, _ in trace]
+        self.assertEqual(timestamps, sorted(set(timestamps)))
+
+    @patch.object(app_settings, "DJANGO_LOCI_POSITION_HISTORY_COMPRESS", 1)
+    def test_prune_command_compress(self):
+        location = self._create_location(is_mobile=True)
+        positions = self._create_trace(location, now() - timedelta(days=2))
+        out = StringIO()
+        call_command("loci_prune_positions", stdout=out)
+        self.assertIn(f"Compressed {len(positions)} positions into 3", out.getvalue())
+        self.assertEqual(self.trace_segment_model.objects.count(), 3)
+        call_command("loci_prune_positions", retention=1, stdout=out)
+        self.assertEqual(self.trace_segment_model.objects.count(), 0)
@@ -1,4 +1,9 @@
+from unittest.mock import patch
+
+from django.contrib.gis.geos import Point
 from django.core.exceptions import ValidationError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
 from .. import TestLociMixin
 
@@ -85,6 +90,89 @@ class BaseTestModels(TestLociMixin):
         except ValidationError:
             self.fail("Unexpected ValidationError raised")
 
+    @patch("django_loci.channels.receivers.broadcast_many")
+    def test_bulk_move(self, broadcast_many):
+        l1 = self._create_location(is_mobile=True)
+        l2 = self._create_location(is_mobile=True)
+        l3 = self._create_location(is_mobile=True)
+        modified = l1.modified
+        moves = [
+            (l1.pk, Point(12.5, 41.9, srid=4326)),
+            (str(l2.pk), "POINT (12.6 41.8)", "Piazza Venezia, Roma"),
+            (self.location_model().pk, Point(1, 1, srid=4326)),
+            # not moved
+            (l3.pk, Point(12.512124, 41.898903, srid=4326)),
+        ]
+        with self.captureOnCommitCallbacks(execute=True):
+            updated = self.location_model.objects.bulk_move(moves, batch_size=2)
+        self.assertEqual(updated, 2)
+        l1.refresh_from_db()
+        l2.refresh_from_db()
+        self.assertEqual(l1.geometry.coords, (12.5, 41.9))
+        self.assertEqual(l1.address, "Via del Corso, Roma, Italia")
+        self.assertGreater(l1.modified, modified)
+        self.assertEqual(l2.geometry.coords, (12.6, 41.8))
+        self.assertEqual(l2.address, "Piazza Venezia, Roma")
+        self.assertEqual(
+            self.location_model.objects.get(pk=l3.pk).geometry.coords,
+            (12.512124, 41.898903),
+        )
+        # a single dispatch for each batch
+        broadcast_many.assert_called_once()
+        broadcasts = {item[1]: item for item in broadcast_many.call_args[0][0]}
+        self.assertEqual(set(broadcasts), {l1.pk, l2.pk})
+        messages, _, point = broadcasts[l2.pk]
+        self.assertEqual(point, (12.6, 41.8))
+        self.assertEqual(messages[0][0], f"loci.mobile-location.{l2.pk}")
+        self.assertEqual(messages[0][1]["message"]["address"], "Piazza Venezia, Roma")
+
+    def test_location_dirty_fields(self):
+        location = self._create_location(is_mobile=True)
+        self.assertEqual(location.get_dirty_fields(), set())
+        # unchanged locations are not saved
+        with self.assertNumQueries(0):
+            location.save()
+        location.geometry = Point(12.512124, 41.898903, srid=4326)
+        self.assertEqual(location.get_dirty_fields(), set())
+        location.geometry.x = 12.6
+        location.name = "moved"
+        self.assertEqual(location.get_dirty_fields(), {"geometry", "name"})
+        with CaptureQueriesContext(connection) as context:
+            location.save()
+        self.assertEqual(len(context.captured_queries), 1)
+        sql = context.captured_queries[0]["sql"]
+        self.assertIn('"name"', sql)
+        self.assertNotIn('"address"', sql)
+        self.assertEqual(location.get_dirty_fields(), set())
+        location.refresh_from_db()
+        self.assertEqual(location.get_dirty_fields(), set())
+        self.assertEqual(location.geometry.x, 12.6)
+        # changes made in place to the loaded geometry
+        location.geometry.y = 41.9
+        self.assertEqual(location.get_dirty_fields(), {"geometry"})
+        location.refresh_from_db()
+        # deferred fields
+        location = self.location_model.objects.only("name").get(pk=location.pk)
+        self.assertEqual(location.address, "Via del Corso, Roma, Italia")
+        self.assertEqual(location.get_dirty_fields(), set())
+        location.address = "Piazza Venezia, Roma"
+        location.save()
+        location.refresh_from_db()
+        self.assertEqual(location.address, "Piazza Venezia, Roma")
+
+    @patch("django_loci.channels.receivers.broadcast")
+    def test_location_broadcast_changed_fields(self, broadcast):
+        location = self._create_location(is_mobile=True)
+        with self.captureOnCommitCallbacks(execute=True):
+            location.save()
+            location.is_mobile = False
+            location.save()
+        broadcast.assert_not_called()
+        with self.captureOnCommitCallbacks(execute=True):
+            location.name = "moved"
+            location.save()
+        broadcast.assert_called_once()
+
     # changing location type from indoor to outdoor, deletes floorplans
     def test_location_change_indoor_to_outdoor(self):
         fl = self._create_floorplan()
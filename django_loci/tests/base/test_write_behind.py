@@ -0,0 +1,134 @@
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.contrib.gis.geos import Point
+from django.core.cache import cache
+from django.db import DatabaseError
+
+from ... import settings as app_settings
+from ...base import write_behind
+from ...channels.consumers import CommonLocationBroadcast
+from ...channels.receivers import get_seq
+from ...signals import locations_moved
+from .. import TestLociMixin
+
+
+class BaseTestWriteBehind(TestLociMixin):
+    def _get_buffer(self):
+        buffer = write_behind.WriteBehindBuffer(self.location_model, cache=cache)
+        patcher = patch.object(buffer, "_ensure_started")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(cache.clear)
+        return buffer
+
+    def test_move(self):
+        location = self._create_location(is_mobile=True)
+        buffer = self._get_buffer()
+        moved = []
+
+        def receiver(sender, instances, **kwargs):
+            moved.extend(instances)
+
+        locations_moved.connect(receiver, sender=self.location_model)
+        self.addCleanup(locations_moved.disconnect, receiver, self.location_model)
+        buffer.move(location, Point(12.6, 41.9, srid=4326), "Via del Corso")
+        buffer.move(location, "POINT (12.7 41.9)")
+        buffer._ensure_started.assert_called()
+        self.assertEqual(moved, [location, location])
+        # not persisted yet
+        stored = self.location_model.objects.get(pk=location.pk)
+        self.assertEqual(stored.geometry.x, 12.512124)
+        self.assertEqual(buffer.apply_latest(stored).geometry.x, 12.7)
+        self.assertEqual(stored.address, "Via del Corso")
+        self.assertEqual(buffer.flush(), 1)
+        self.assertEqual(buffer.flush(), 0)
+        location.refresh_from_db()
+        self.assertEqual(location.geometry.coords, (12.7, 41.9))
+        self.assertEqual(location.address, "Via del Corso")
+        self.assertEqual(location.modified, stored.modified)
+
+    def test_flush_skips_stale_positions(self):
+        location = self._create_location(is_mobile=True)
+        deleted = self._create_location(is_mobile=True)
+        buffer = self._get_buffer()
+        buffer.move(location, Point(12.6, 41.9, srid=4326))
+        buffer.move(deleted, Point(12.6, 41.9, srid=4326))
+        deleted.delete()
+        # saved after the move
+        self.location_model.objects.filter(pk=location.pk).update(
+            modified=location.modified + timedelta(seconds=1)
+        )
+        self.assertEqual(buffer.flush(), 0)
+        location.refresh_from_db()
+        self.assertEqual(location.geometry.x, 12.512124)
+
+    def test_flush_newest_cached_position(self):
+        location = self._create_location(is_mobile=True)
+        buffer = self._get_buffer()
+        other = self._get_buffer()
+        buffer.move(location, Point(12.6, 41.9, srid=4326))
+        # moved later by another process
+        other.move(
+            self.location_model.objects.get(pk=location.pk),
+            Point(12.7, 41.9, srid=4326),
+        )
+        self.assertEqual(buffer.flush(), 1)
+        location.refresh_from_db()
+        self.assertEqual(location.geometry.x, 12.7)
+
+    def test_flush_failure(self):
+        location = self._create_location(is_mobile=True)
+        buffer = self._get_buffer()
+        buffer.move(location, Point(12.6, 41.9, srid=4326))
+
+        def bulk_update(*args, **kwargs):
+            # moved again while the positions are being written
+            buffer.move(location, Point(12.7, 41.9, srid=4326))
+            raise DatabaseError()
+
+        with patch.object(
+            self.location_model.objects, "bulk_update", side_effect=bulk_update
+        ):
+            with self.assertRaises(DatabaseError):
+                buffer.flush()
+        # the newest position is kept and written by the next flush
+        self.assertEqual(buffer.flush(), 1)
+        location.refresh_from_db()
+        self.assertEqual(location.geometry.x, 12.7)
+
+    @patch.object(app_settings, "DJANGO_LOCI_BROADCAST_RESYNC_WINDOW", 0)
+    def test_snapshot(self):
+        location = self._create_location(is_mobile=True)
+        since = get_seq(self._create_location(is_mobile=True))
+        buffer = self._get_buffer()
+        buffer.move(location, Point(12.6, 41.9, srid=4326))
+        consumer = CommonLocationBroadcast()
+        consumer.scope = {"user": None}
+        consumer._init_subscription()
+        consumer.get_snapshot_queryset = lambda user: self.location_model.objects.all()
+        with patch.object(write_behind, "buffer", buffer):
+            locations = list(consumer._get_snapshot_locations(since))
+            payloads = consumer._get_snapshot_payloads(locations, since)
+        # moved but not stored yet
+        self.assertEqual([payload["id"] for payload in payloads], [str(location.pk)])
+        self.assertEqual(payloads[0]["geometry"]["coordinates"], [12.6, 41.9])
+
+    def test_write_behind_disabled(self):
+        write_behind.load_write_behind(self.location_model)
+        self.assertIsNone(write_behind.get_buffer())
+        location = self._create_location(is_mobile=True)
+        write_behind.move(location, "POINT (12.6 41.9)", "Via del Corso")
+        location.refresh_from_db()
+        self.assertEqual(location.geometry.x, 12.6)
+        self.assertEqual(location.address, "Via del Corso")
+        self.assertIs(write_behind.apply_latest(location), location)
+
+    @patch.object(app_settings, "DJANGO_LOCI_WRITE_BEHIND", True)
+    def test_load_write_behind(self):
+        with patch("atexit.register") as register:
+            write_behind.load_write_behind(self.location_model)
+        self.addCleanup(setattr, write_behind, "buffer", None)
+        buffer = write_behind.get_buffer()
+        self.assertIsInstance(buffer, write_behind.WriteBehindBuffer)
+        register.assert_called_once_with(buffer.flush)
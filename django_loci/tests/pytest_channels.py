@@ -1,5 +1,6 @@
 from django.contrib.auth import get_user_model
 
+from ..channels.consumers import AsyncCommonLocationBroadcast, AsyncLocationBroadcast
 from ..models import Location, ObjectLocation
 from .base.test_channels import BaseTestChannels
 from .testdeviceapp.models import Device
@@ -10,3 +11,8 @@ class TestChannels(BaseTestChannels):
     location_model = Location
     object_location_model = ObjectLocation
     user_model = get_user_model()
+
+
+class TestAsyncChannels(TestChannels):
+    location_consumer = AsyncLocationBroadcast
+    common_location_consumer = AsyncCommonLocationBroadcast
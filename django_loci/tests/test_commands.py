@@ -0,0 +1,8 @@
+from django.test import TestCase
+
+from ..models import Location
+from .base.test_commands import BaseTestCommands
+
+
+class TestCommands(BaseTestCommands, TestCase):
+    location_model = Location
@@ -0,0 +1,7 @@
+from django.test import TestCase
+
+from .base.test_geocoding import BaseTestGeocoding
+
+
+class TestGeocoding(BaseTestGeocoding, TestCase):
+    pass
@@ -0,0 +1,10 @@
+from django.test import TestCase
+
+from ..models import Location, Position, TraceSegment
+from .base.test_history import BaseTestHistory
+
+
+class TestHistory(BaseTestHistory, TestCase):
+    location_model = Location
+    position_model = Position
+    trace_segment_model = TraceSegment
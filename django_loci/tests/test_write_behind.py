@@ -0,0 +1,8 @@
+from django.test import TestCase
+
+from ..models import Location
+from .base.test_write_behind import BaseTestWriteBehind
+
+
+class TestWriteBehind(BaseTestWriteBehind, TestCase):
+    location_model = Location